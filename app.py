@@ -1,33 +1,59 @@
+import contextlib
+import functools
+import gzip
+import heapq
+import hmac
 import json
-from flask import Flask, render_template, jsonify, request, redirect, url_for, make_response
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, render_template, jsonify, request, redirect, url_for, make_response
 import math
+import multiprocessing
+import numpy as np
 import os
+import queue
 import redis
+from redis.client import Pipeline
 from redis.connection import SSLConnection
 import uuid
 import random
+import signal
 import string
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 import noise  # Import the noise library
+import metrics
+from river import RiverGeometry
+from terrain_creator import BakedTerrain
 
-app = Flask(__name__)
+try:
+    import brotli  # Optional: enables 'br' encoding of columnar and raster responses
+except ImportError:
+    brotli = None
 
-# Set up Redis connection with SSL parameters
-redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
-if redis_url.startswith('redis://'):
-    redis_url = redis_url.replace('redis://', 'rediss://', 1)
+app = Flask(__name__)
 
-redis_client = redis.Redis.from_url(
-    redis_url,
-    connection_class=SSLConnection,
-    ssl_cert_reqs=None
-)
+# State backend: 'redis' (default), or 'memory' to keep sessions and lobbies
+# in-process for single-process deployments and load tests
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'redis')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+REDIS_TLS = os.environ.get('REDIS_TLS', '1') != '0'  # Upgrade redis:// URLs to TLS
+REDIS_SSL_CERT_REQS = os.environ.get('REDIS_SSL_CERT_REQS')  # e.g. 'required'; unset skips verification
+REDIS_MAX_CONNECTIONS = int(os.environ['REDIS_MAX_CONNECTIONS']) if os.environ.get('REDIS_MAX_CONNECTIONS') else None
 
 # Horizon calculation parameters
 VIEWER_HEIGHT_FT = 6
 SQUARE_SIZE_MILES = 0.1
+MAX_TILT_DEGREES = 15  # Ground tilt beyond this does not further skew the visibility range
 
 # Terrain types
 TERRAIN_MOUNTAINS = 'mountains' 
+WORLD_COORDINATE_LIMIT = 2**24  # Cells from the origin; float32 terrain math cannot tell farther cells apart
 
 # Define the scale for Perlin noise
 PERLIN_SCALE = 0.05  # Adjust as needed
@@ -35,11 +61,19 @@ PERLIN_SCALE = 0.05  # Adjust as needed
 # Define parameters for the mountain terrain
 MOUNTAIN_PEAK_HEIGHT = 500  # Increased height of the mountain peaks
 MOUNTAIN_SCALE = 0.01  # Controls the size of the mountains
+MOUNTAIN_PEAK_SPREAD = 50  # Standard deviation of each peak in cells
+MOUNTAIN_PEAKS = [
+    {'x': 100, 'y': 100, 'height': MOUNTAIN_PEAK_HEIGHT},
+    {'x': -150, 'y': 50, 'height': MOUNTAIN_PEAK_HEIGHT * 0.8},
+    {'x': 200, 'y': -200, 'height': MOUNTAIN_PEAK_HEIGHT * 1.2},
+]
 
 # River parameters
 RIVER_WIDTH = 10  # Increased width of the river in cells
 RIVER_CENTER_X = 0  # X-coordinate for the center of the river path
 RIVER_FLOW_DIRECTION = 'south'  # Direction the river flows ('south' for this example)
+RIVER_MEANDER_AMPLITUDE = 20  # Controls how much the river meanders
+RIVER_MEANDER_FREQUENCY = 0.05  # Controls the frequency of meanders
 
 # Vegetation parameters
 MAX_VEG_HEIGHT = 50  # Maximum vegetation height in feet
@@ -61,43 +95,112 @@ VEG_SOUND_RANGE_FAR = 30     # Cells
 ENEMY_SOUND_RANGE_MIN = 50  # Minimum range in cells
 ENEMY_SOUND_RANGE_MAX = 65  # Maximum range in cells
 
+# Enemy parameters
+ENEMY_FOV_ANGLE = 60  # Degrees
+ENEMY_FOV_RANGE = 25  # Cells
+ENEMY_HEARING_RANGE = 15  # Cells
+ENEMIES_PER_LOBBY = 2  # Default number of enemies spawned with a lobby
+MAX_ENEMIES_PER_LOBBY = 500
+
+# Enemy simulation parameters
+ENEMY_TICK_SECONDS = float(os.environ.get('ENEMY_TICK_SECONDS', 1.0))  # 0 disables the tick engine
+ENEMY_PATROL_RADIUS = 30  # Cells an enemy strays from its post before heading back
+ENEMY_TURN_JITTER = 20  # Largest random heading change per tick while patrolling, in degrees
+ENEMY_ALERT_TICKS = 10  # Ticks an enemy keeps pursuing after losing track of the player
+
+# Path planning parameters
+PATH_SLOPE_COST = 0.2  # Extra cost per foot of rise per cell of the terrain slope
+PATH_VEGETATION_COST = 1.0  # Extra cost of the tallest vegetation
+PATH_PLAN_MARGIN = 16  # Cells around a leg's bounding box the route may detour through
+PATH_MAX_LEG_DISTANCE = 200  # Largest Manhattan distance between consecutive waypoints
+PATH_MAX_WAYPOINTS = 16
+PATH_COST_CACHE_TILES = 512  # Cached traversal-cost tiles per worker
+PATH_PLAN_CACHE_SIZE = 256  # Cached routes per worker
+
+# Viewshed parameters (defaults; lobbies may override them)
+VIEWSHED_ANGLE_STEP = 2  # Degrees between rays
+VIEWSHED_MAX_RANGE = None  # Cap on ray length in cells (None uses the horizon distance only)
+VIEWSHED_MIN_ANGLE_STEP = 0.1  # Finest per-lobby ray spacing, in degrees (3600 rays)
+VIEWSHED_MAX_ANGLE_STEP = 45
+VIEWSHED_RANGE_LIMIT = 200  # Largest per-lobby max range, in cells: the 20 mile horizon cap
+VIEWSHED_CHUNK_SIZE = 32  # Samples evaluated per ray per batch
+VIEWSHED_CACHE_MAX_MB = float(os.environ.get('VIEWSHED_CACHE_MAX_MB', 128))  # Cached viewsheds per worker, ~1.3 MB each
+INTERVISIBILITY_MAX_PAIRS = 1000  # Sightlines per /intervisibility request
+LOBBY_VIEW_CACHE_SIZE = 64  # Lobbies whose players' views are cached per worker
+VIEW_FOOTPRINT_CACHE_SIZE = 512  # Viewpoints whose visible cells are remembered for view ETags
+
+# Terrain tile cache parameters (configured per gunicorn worker)
+TERRAIN_TILE_SIZE = 64  # Cells per tile side
+TERRAIN_CACHE_MAX_MB = float(os.environ.get('TERRAIN_CACHE_MAX_MB', 64))  # In-process LRU cap
+TERRAIN_CACHE_DIR = os.environ.get('TERRAIN_CACHE_DIR')  # Optional on-disk tile store
+TERRAIN_BAKED_PATH = os.environ.get('TERRAIN_BAKED_PATH')  # Optional world baked by terrain_creator.py
+SLOPE_FIELD_CACHE_TILES = 512  # Cached slope field tiles per worker
+
+# View stream parameters
+VIEW_STREAM_KEEPALIVE_SECONDS = 15  # Idle time before a keep-alive comment is sent
+VIEW_DELTA_ELEVATION_TOLERANCE = 5.0  # Feet; smaller elevation changes are not resent
+VIEW_DELTA_VEGETATION_TOLERANCE = 1.0  # Feet; smaller vegetation height changes are not resent
+
+# View worker pool parameters (0 workers computes views in the request handler)
+# Every gunicorn worker (WEB_CONCURRENCY of them) starts its own pool, so by
+# default they share the cores between them.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+VIEW_POOL_WORKERS = int(os.environ.get('VIEW_POOL_WORKERS', max((os.cpu_count() or 1) // max(WEB_CONCURRENCY, 1), 1)))
+VIEW_POLL_INTERVAL_SECONDS = 1.0  # How often the game page polls its view
+VIEW_COST_ESTIMATE_SECONDS = 0.025  # Typical time to compute a view
+# Queued or running views per worker: as many as it computes between two polls
+# of a client. A view queued behind more would arrive after the client's next
+# poll, so those requests are shed instead.
+VIEW_POOL_MAX_PENDING = int(os.environ.get('VIEW_POOL_MAX_PENDING',
+                                           math.ceil(VIEW_POLL_INTERVAL_SECONDS / VIEW_COST_ESTIMATE_SECONDS)))
+VIEW_REQUEST_TIMEOUT_SECONDS = float(os.environ.get('VIEW_REQUEST_TIMEOUT_SECONDS', 5))
+VIEW_RETRY_AFTER_SECONDS = 1  # Retry-After sent when the pool sheds load
+
+# Instrumentation parameters
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') != '0'  # Send stage timings in a Server-Timing header
+# /metrics answers loopback clients, or anyone sending this as a bearer token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+SLOW_REQUEST_PROFILE_SECONDS = float(os.environ.get('SLOW_REQUEST_PROFILE_SECONDS', 0))  # 0 disables the profiler
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005  # CPU time between stack samples
+PROFILE_TOP_STACKS = 20  # Most frequent stacks logged per slow request
+VIEW_CELLS_BUCKETS = (250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+river_geometry = RiverGeometry(RIVER_WIDTH, RIVER_MEANDER_AMPLITUDE, RIVER_MEANDER_FREQUENCY)
+
 def is_river(x, y):
     """
     Determines if the cell at (x, y) is part of the river.
     For simplicity, the river flows south along the x=0 axis with a sinusoidal meander.
     """
-    meander_amplitude = 20  # Controls how much the river meanders
-    meander_frequency = 0.05  # Controls the frequency of meanders
-
     # Calculate the river's central y-coordinate based on x
-    central_y = int(meander_amplitude * math.sin(meander_frequency * x))
+    central_y = int(RIVER_MEANDER_AMPLITUDE * math.sin(RIVER_MEANDER_FREQUENCY * x))
 
     # Check if the cell is within the river's width around the central path
     return abs(y - central_y) < (RIVER_WIDTH // 2)
 
 def terrain_height_mountains(x, y):
-    A = MOUNTAIN_PEAK_HEIGHT
     scale = MOUNTAIN_SCALE
     base_height = noise.pnoise2(x * scale, y * scale)
-    peaks = [
-        {'x': 100, 'y': 100, 'height': A},
-        {'x': -150, 'y': 50, 'height': A * 0.8},
-        {'x': 200, 'y': -200, 'height': A * 1.2},
-    ]
     peak_height = 0
-    for peak in peaks:
+    for peak in MOUNTAIN_PEAKS:
         distance_sq = (x - peak['x'])**2 + (y - peak['y'])**2
-        peak_height += peak['height'] * math.exp(-distance_sq / (2 * (50**2)))
+        peak_height += peak['height'] * math.exp(-distance_sq / (2 * (MOUNTAIN_PEAK_SPREAD**2)))
     terrain_elevation = base_height * 500 + peak_height + 500  # Add 500 ft offset
     return terrain_elevation
 
 def terrain_gradient_mountains(x, y):
-    delta = 0.01
-    h_center = terrain_height_mountains(x, y)
-    h_x1 = terrain_height_mountains(x + delta, y)
-    h_y1 = terrain_height_mountains(x, y + delta)
-    dh_dx = (h_x1 - h_center) / delta
-    dh_dy = (h_y1 - h_center) / delta
+    # Analytic: the noise gradient plus the derivatives of the Gaussian peaks
+    dn_dx, dn_dy = pnoise2_gradient(x * MOUNTAIN_SCALE, y * MOUNTAIN_SCALE)
+    dh_dx = dn_dx * 500 * MOUNTAIN_SCALE
+    dh_dy = dn_dy * 500 * MOUNTAIN_SCALE
+    spread_sq = MOUNTAIN_PEAK_SPREAD**2
+    for peak in MOUNTAIN_PEAKS:
+        offset_x = x - peak['x']
+        offset_y = y - peak['y']
+        falloff = peak['height'] * math.exp(-(offset_x**2 + offset_y**2) / (2 * spread_sq)) / spread_sq
+        dh_dx -= falloff * offset_x
+        dh_dy -= falloff * offset_y
     return dh_dx, dh_dy
 
 def terrain_height(x, y, terrain_type):
@@ -114,6 +217,432 @@ def terrain_gradient(x, y, terrain_type):
         # Default to mountains gradient if unknown terrain type
         return terrain_gradient_mountains(x, y)
 
+# Batch terrain evaluation
+#
+# The scalar functions above evaluate a single point per call. The functions
+# below take coordinate arrays and return arrays with the same values, so hot
+# paths can evaluate whole rays or sampling lattices in one call.
+
+# Permutation table used by noise.pnoise2, repeated twice to avoid wrapping
+_NOISE_PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247,
+    120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32, 57,
+    177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175, 74,
+    165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+    200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3,
+    64, 52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85,
+    212, 207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170,
+    213, 119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43,
+    172, 9, 129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185,
+    112, 104, 218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191,
+    179, 162, 241, 81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31,
+    181, 199, 106, 157, 184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150,
+    254, 138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195,
+    78, 66, 215, 61, 156, 180,
+] * 2, dtype=np.intp)
+
+# x and y components of the gradient vectors used by noise.pnoise2
+_NOISE_GRAD_X = np.array([1, -1, 1, -1, 1, -1, 1, -1, 0, 0, 0, 0, 1, -1, 0, 0], dtype=np.float32)
+_NOISE_GRAD_Y = np.array([1, 1, -1, -1, 0, 0, 0, 0, 1, -1, 1, -1, 0, 0, -1, 1], dtype=np.float32)
+
+def _noise_grad2(hash_index, x, y):
+    h = _NOISE_PERM[hash_index] & 15
+    return x * _NOISE_GRAD_X[h] + y * _NOISE_GRAD_Y[h]
+
+def _noise_lattice(x, y, repeatx, repeaty):
+    """
+    Locates points in noise.pnoise2's lattice. Returns the single-precision
+    offsets within the lattice cell and the gradient hash indices of its
+    (0, 0), (1, 0), (0, 1) and (1, 1) corners.
+    """
+    x = np.asarray(x, dtype=np.float64).astype(np.float32)
+    y = np.asarray(y, dtype=np.float64).astype(np.float32)
+    repeatx = np.float32(repeatx)
+    repeaty = np.float32(repeaty)
+
+    i = np.floor(np.fmod(x, repeatx)).astype(np.intp)
+    j = np.floor(np.fmod(y, repeaty)).astype(np.intp)
+    ii = np.fmod((i + 1).astype(np.float32), repeatx).astype(np.intp) & 255
+    jj = np.fmod((j + 1).astype(np.float32), repeaty).astype(np.intp) & 255
+    i &= 255
+    j &= 255
+
+    A = _NOISE_PERM[i]
+    B = _NOISE_PERM[ii]
+    corners = (_NOISE_PERM[A + j], _NOISE_PERM[B + j], _NOISE_PERM[A + jj], _NOISE_PERM[B + jj])
+    return x - np.floor(x), y - np.floor(y), corners
+
+def pnoise2_array(x, y, repeatx=1024, repeaty=1024):
+    """
+    Array version of noise.pnoise2 (single octave, base 0).
+    Mirrors the library's single-precision arithmetic so results are bit-identical.
+    """
+    x, y, (aa, ba, ab, bb) = _noise_lattice(x, y, repeatx, repeaty)
+    fx = x * x * x * (x * (x * np.float32(6) - np.float32(15)) + np.float32(10))
+    fy = y * y * y * (y * (y * np.float32(6) - np.float32(15)) + np.float32(10))
+
+    x1 = x - np.float32(1)
+    y1 = y - np.float32(1)
+
+    g_aa = _noise_grad2(aa, x, y)
+    g_ba = _noise_grad2(ba, x1, y)
+    g_ab = _noise_grad2(ab, x, y1)
+    g_bb = _noise_grad2(bb, x1, y1)
+
+    lower = g_aa + fx * (g_ba - g_aa)
+    upper = g_ab + fx * (g_bb - g_ab)
+    return (lower + fy * (upper - lower)).astype(np.float64)
+
+def _noise_interpolation_gradient(x, y, gx, gy):
+    """
+    Partial derivatives of the noise interpolation at offsets x, y within a
+    lattice cell, given the gradient components gx, gy of the cell's (0, 0),
+    (1, 0), (0, 1) and (1, 1) corners. Works on floats and arrays alike.
+    """
+    g_aa = x * gx[0] + y * gy[0]
+    g_ba = (x - 1) * gx[1] + y * gy[1]
+    g_ab = x * gx[2] + (y - 1) * gy[2]
+    g_bb = (x - 1) * gx[3] + (y - 1) * gy[3]
+    fx = x * x * x * (x * (x * 6 - 15) + 10)
+    fy = y * y * y * (y * (y * 6 - 15) + 10)
+    dfx = 30 * x * x * (x - 1) * (x - 1)
+    dfy = 30 * y * y * (y - 1) * (y - 1)
+
+    lower = g_aa + fx * (g_ba - g_aa)
+    upper = g_ab + fx * (g_bb - g_ab)
+    dlower_dx = gx[0] + fx * (gx[1] - gx[0]) + dfx * (g_ba - g_aa)
+    dupper_dx = gx[2] + fx * (gx[3] - gx[2]) + dfx * (g_bb - g_ab)
+    dlower_dy = gy[0] + fx * (gy[1] - gy[0])
+    dupper_dy = gy[2] + fx * (gy[3] - gy[2])
+    return (dlower_dx + fy * (dupper_dx - dlower_dx),
+            dlower_dy + fy * (dupper_dy - dlower_dy) + dfy * (upper - lower))
+
+def pnoise2_gradient_array(x, y, repeatx=1024, repeaty=1024):
+    """
+    Exact partial derivatives of pnoise2_array with respect to x and y,
+    differentiating its interpolation in double precision. The noise is
+    continuously differentiable, as the fade curve is flat at the lattice.
+    """
+    x, y, corners = _noise_lattice(x, y, repeatx, repeaty)
+    hashes = [_NOISE_PERM[corner] & 15 for corner in corners]
+    return _noise_interpolation_gradient(
+        x.astype(np.float64), y.astype(np.float64),
+        [_NOISE_GRAD_X[h].astype(np.float64) for h in hashes],
+        [_NOISE_GRAD_Y[h].astype(np.float64) for h in hashes]
+    )
+
+_NOISE_PERM_LIST = _NOISE_PERM.tolist()
+_NOISE_GRAD_LIST = list(zip(_NOISE_GRAD_X.tolist(), _NOISE_GRAD_Y.tolist()))
+
+def pnoise2_gradient(x, y, repeatx=1024, repeaty=1024):
+    """Scalar version of pnoise2_gradient_array, without NumPy's per-call overhead."""
+    i = math.floor(math.fmod(x, repeatx))
+    j = math.floor(math.fmod(y, repeaty))
+    ii = int(math.fmod(i + 1, repeatx)) & 255
+    jj = int(math.fmod(j + 1, repeaty)) & 255
+    i &= 255
+    j &= 255
+    perm = _NOISE_PERM_LIST
+    A = perm[i]
+    B = perm[ii]
+    gradients = [_NOISE_GRAD_LIST[perm[perm[corner]] & 15] for corner in (A + j, B + j, A + jj, B + jj)]
+    return _noise_interpolation_gradient(x - math.floor(x), y - math.floor(y),
+                                         [g[0] for g in gradients], [g[1] for g in gradients])
+
+def is_river_array(xs, ys):
+    """Array version of is_river for integer cell coordinates."""
+    return river_geometry.is_water(xs, ys)
+
+def terrain_height_mountains_array(xs, ys):
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    base_height = pnoise2_array(xs * MOUNTAIN_SCALE, ys * MOUNTAIN_SCALE)
+    peak_height = np.zeros_like(base_height)
+    for peak in MOUNTAIN_PEAKS:
+        distance_sq = (xs - peak['x'])**2 + (ys - peak['y'])**2
+        peak_height += peak['height'] * np.exp(-distance_sq / (2 * (MOUNTAIN_PEAK_SPREAD**2)))
+    return base_height * 500 + peak_height + 500
+
+def terrain_height_array(xs, ys, terrain_type):
+    """
+    Returns terrain elevations for arrays of x and y coordinates.
+    Values match terrain_height up to floating-point rounding.
+    """
+    if terrain_type == TERRAIN_MOUNTAINS:
+        return terrain_height_mountains_array(xs, ys)
+    else:
+        # Default to mountains if unknown terrain type
+        return terrain_height_mountains_array(xs, ys)
+
+def terrain_gradient_mountains_array(xs, ys):
+    """
+    Analytic gradient of terrain_height_mountains_array: the noise gradient
+    plus the derivatives of the Gaussian peaks.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    dn_dx, dn_dy = pnoise2_gradient_array(xs * MOUNTAIN_SCALE, ys * MOUNTAIN_SCALE)
+    dh_dx = dn_dx * (500 * MOUNTAIN_SCALE)
+    dh_dy = dn_dy * (500 * MOUNTAIN_SCALE)
+    spread_sq = MOUNTAIN_PEAK_SPREAD**2
+    for peak in MOUNTAIN_PEAKS:
+        offset_x = xs - peak['x']
+        offset_y = ys - peak['y']
+        falloff = peak['height'] * np.exp(-(offset_x**2 + offset_y**2) / (2 * spread_sq)) / spread_sq
+        dh_dx -= falloff * offset_x
+        dh_dy -= falloff * offset_y
+    return dh_dx, dh_dy
+
+def terrain_gradient_array(xs, ys, terrain_type):
+    """
+    Returns the terrain gradient (dh/dx, dh/dy) in feet per cell for arrays
+    of points, evaluated analytically.
+    """
+    if terrain_type == TERRAIN_MOUNTAINS:
+        return terrain_gradient_mountains_array(xs, ys)
+    else:
+        # Default to mountains gradient if unknown terrain type
+        return terrain_gradient_mountains_array(xs, ys)
+
+def terrain_slope_aspect_array(xs, ys, terrain_type):
+    """
+    Returns the slope (radians from horizontal) and aspect (direction of
+    steepest ascent, radians as from np.arctan2) for arrays of points.
+    """
+    dh_dx, dh_dy = terrain_gradient_array(xs, ys, terrain_type)
+    return np.arctan(np.hypot(dh_dx, dh_dy)), np.arctan2(dh_dy, dh_dx)
+
+def vegetation_height_array(xs, ys, elevation):
+    """
+    Returns vegetation heights for arrays of coordinates and their terrain elevations.
+    Values match vegetation_height up to floating-point rounding.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    base_density = pnoise2_array(xs * VEG_SCALE, ys * VEG_SCALE, repeatx=1000, repeaty=1000)
+    base_density = np.clip(base_density + 0.5, 0.0, 1.0) ** VEG_DISTRIBUTION_COEF
+    elevation_factor = np.clip(1 - (np.asarray(elevation) - 500) / ELEVATION_VEG_COEF, 0.0, 1.0)
+    vegetation_density = np.clip(base_density * elevation_factor, MIN_VEG_DENSITY, MAX_VEG_DENSITY)
+    return vegetation_density * MAX_VEG_HEIGHT
+
+# Terrain tile cache
+#
+# Terrain is a deterministic function of (x, y, terrain_type), so integer cells
+# are computed once per tile and then served from memory (or from disk).
+
+TERRAIN_TILE_DTYPE = np.dtype([
+    ('elevation', '<f8'),
+    ('vegetation_height', '<f8'),
+    ('water', '?'),
+])
+
+def compute_terrain_tile(terrain_type, tile_x, tile_y, tile_size=TERRAIN_TILE_SIZE):
+    """
+    Computes elevation, vegetation height and the river mask for one tile.
+    Arrays are indexed [x - x0, y - y0] where (x0, y0) is the tile origin.
+    """
+    offsets = np.arange(tile_size)
+    xs, ys = np.meshgrid(tile_x * tile_size + offsets, tile_y * tile_size + offsets, indexing='ij')
+    tile = np.empty((tile_size, tile_size), dtype=TERRAIN_TILE_DTYPE)
+    tile['elevation'] = terrain_height_array(xs, ys, terrain_type)
+    tile['vegetation_height'] = vegetation_height_array(xs, ys, tile['elevation'])
+    tile['water'] = is_river_array(xs, ys)
+    return tile
+
+class TerrainTileCache:
+    """
+    Bounded LRU of terrain tiles with an optional memory-mapped on-disk store.
+    Tiles found on disk are mapped read-only, so workers sharing a cache
+    directory also share the page cache. Tiles inside a baked world are
+    served straight from its mapping and bypass the LRU.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, tile_size=TERRAIN_TILE_SIZE, baked=None):
+        self.max_bytes = int(max_bytes)
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+        self.baked = baked
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self.baked_hits = 0
+
+    def _tile_path(self, terrain_type, tile_x, tile_y):
+        return os.path.join(self.cache_dir, f'{terrain_type}_{self.tile_size}_{tile_x}_{tile_y}.npy')
+
+    def _load_or_compute(self, terrain_type, tile_x, tile_y):
+        if not self.cache_dir:
+            return compute_terrain_tile(terrain_type, tile_x, tile_y, self.tile_size)
+
+        path = self._tile_path(terrain_type, tile_x, tile_y)
+        if os.path.exists(path):
+            self.disk_hits += 1
+            return np.load(path, mmap_mode='r')
+
+        tile = compute_terrain_tile(terrain_type, tile_x, tile_y, self.tile_size)
+        # Write to a temporary file and rename so concurrent workers never see partial tiles
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, tile)
+        os.replace(tmp_path, path)
+        self.disk_writes += 1
+        return tile
+
+    def get_tile(self, terrain_type, tile_x, tile_y):
+        if self.baked is not None and self.baked.terrain_type == terrain_type:
+            tile = self.baked.tile(tile_x, tile_y, self.tile_size)
+            if tile is not None:
+                self.baked_hits += 1
+                return tile
+
+        key = (terrain_type, tile_x, tile_y)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        tile = self._load_or_compute(terrain_type, tile_x, tile_y)
+
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self._bytes += tile.nbytes
+            while self._bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+        return tile
+
+    def window(self, x0, y0, width, height, terrain_type):
+        """
+        Returns a (width, height) structured array of terrain for the
+        rectangle starting at integer cell (x0, y0).
+        """
+        size = self.tile_size
+        result = np.empty((width, height), dtype=TERRAIN_TILE_DTYPE)
+        for tile_x in range(x0 // size, (x0 + width - 1) // size + 1):
+            for tile_y in range(y0 // size, (y0 + height - 1) // size + 1):
+                tile = self.get_tile(terrain_type, tile_x, tile_y)
+                # Overlap of this tile with the requested window, in world cells
+                wx0 = max(x0, tile_x * size)
+                wy0 = max(y0, tile_y * size)
+                wx1 = min(x0 + width, (tile_x + 1) * size)
+                wy1 = min(y0 + height, (tile_y + 1) * size)
+                result[wx0 - x0:wx1 - x0, wy0 - y0:wy1 - y0] = \
+                    tile[wx0 - tile_x * size:wx1 - tile_x * size, wy0 - tile_y * size:wy1 - tile_y * size]
+        return result
+
+    def sample(self, xs, ys, terrain_type):
+        """
+        Returns a structured array of terrain at arbitrary integer cells.
+        """
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        result = np.empty(xs.shape, dtype=TERRAIN_TILE_DTYPE)
+        if xs.size == 0:
+            return result
+        size = self.tile_size
+        flat_xs = xs.ravel()
+        flat_ys = ys.ravel()
+        tile_xs = flat_xs // size
+        tile_ys = flat_ys // size
+
+        # Group points by tile with a single sort
+        min_tile_y = tile_ys.min()
+        tile_keys = tile_xs * (tile_ys.max() - min_tile_y + 1) + (tile_ys - min_tile_y)
+        _, first_index, inverse, counts = np.unique(tile_keys, return_index=True, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        flat_result = result.reshape(-1)
+        group_start = 0
+        for first, count in zip(first_index.tolist(), counts.tolist()):
+            indices = order[group_start:group_start + count]
+            group_start += count
+            tile_x = int(tile_xs[first])
+            tile_y = int(tile_ys[first])
+            tile = self.get_tile(terrain_type, tile_x, tile_y)
+            flat_result[indices] = tile[flat_xs[indices] - tile_x * size, flat_ys[indices] - tile_y * size]
+        return result
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'tiles': len(self._tiles),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_hits': self.disk_hits,
+                'disk_writes': self.disk_writes,
+                'baked_hits': self.baked_hits,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+
+baked_terrain = BakedTerrain(TERRAIN_BAKED_PATH) if TERRAIN_BAKED_PATH else None
+
+terrain_tile_cache = TerrainTileCache(
+    max_bytes=TERRAIN_CACHE_MAX_MB * 1024 * 1024,
+    cache_dir=TERRAIN_CACHE_DIR,
+    baked=baked_terrain
+)
+
+# Slope field
+#
+# Slope and aspect of integer cells, computed per terrain tile from the
+# analytic gradient and cached, so tilt-dependent quantities (visibility
+# ranges, traversal costs) are looked up instead of recomputed.
+
+SLOPE_FIELD_DTYPE = np.dtype([
+    ('slope', '<f4'),  # Radians from horizontal
+    ('aspect', '<f4'),  # Direction of steepest ascent, radians as from np.arctan2
+])
+
+@functools.lru_cache(maxsize=SLOPE_FIELD_CACHE_TILES)
+def slope_field_tile(terrain_type, tile_x, tile_y):
+    """Returns the read-only slope field of a terrain tile, indexed like the tile."""
+    size = terrain_tile_cache.tile_size
+    offsets = np.arange(size)
+    xs, ys = np.meshgrid(tile_x * size + offsets, tile_y * size + offsets, indexing='ij')
+    field = np.empty((size, size), dtype=SLOPE_FIELD_DTYPE)
+    field['slope'], field['aspect'] = terrain_slope_aspect_array(xs, ys, terrain_type)
+    field.flags.writeable = False
+    return field
+
+def slope_field(xs, ys, terrain_type):
+    """Returns a SLOPE_FIELD_DTYPE array of the slope field at integer cells."""
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    size = terrain_tile_cache.tile_size
+    if xs.ndim == 0 and ys.ndim == 0:
+        (tile_x, x), (tile_y, y) = divmod(int(xs), size), divmod(int(ys), size)
+        return slope_field_tile(terrain_type, tile_x, tile_y)[x, y]
+    tile_xs = xs // size
+    tile_ys = ys // size
+    result = np.empty(xs.shape, dtype=SLOPE_FIELD_DTYPE)
+    for tile_x, tile_y in set(zip(tile_xs.ravel().tolist(), tile_ys.ravel().tolist())):
+        in_tile = (tile_xs == tile_x) & (tile_ys == tile_y)
+        result[in_tile] = slope_field_tile(terrain_type, tile_x, tile_y)[
+            xs[in_tile] - tile_x * size, ys[in_tile] - tile_y * size]
+    return result
+
 def horizon_distance(viewer_elevation_ft):
     # Set minimum viewer elevation to VIEWER_HEIGHT_FT (6 ft)
     viewer_elevation_ft = max(viewer_elevation_ft, VIEWER_HEIGHT_FT)
@@ -123,105 +652,485 @@ def horizon_distance(viewer_elevation_ft):
     max_horizon_distance = 20  # in miles
     return min(calculated_distance, max_horizon_distance)
 
-def compute_sound_levels(x, y, center_x, center_y):
+def compute_viewsheds(centers, terrain_type, angle_step=VIEWSHED_ANGLE_STEP, max_range=VIEWSHED_MAX_RANGE):
     """
-    Computes the sound levels for different sound sources at a given cell.
-    Returns a dictionary of sound sources and their levels.
+    Casts all rays from every viewpoint in centers, a list of (x, y) cells,
+    together.
+
+    Rays advance in windows of VIEWSHED_CHUNK_SIZE samples; the windows of
+    all active rays are evaluated as one batch and tested against the running
+    maximum elevation angle along each ray. A ray stops at its first sample
+    that does not rise above that maximum, and only rays still rising are
+    extended by another window. Batching the rays of several viewpoints
+    shares the per-window overhead between them.
+
+    Rays are not accelerated with the baked max-elevation pyramid: a ray ends
+    at its first non-rising sample, usually a small dip that block maxima
+    cannot rule out, so every sample up to the stop is evaluated anyway and
+    the bounds only added work.
+
+    Returns one dict of arrays per viewpoint describing its visible samples
+    in ray order.
     """
-    sound_sources = {}
-
-    # Sound from river
-    if is_river(x, y):
-        dx = x - center_x
-        dy = y - center_y
-        distance_to_player = math.sqrt(dx**2 + dy**2)
-        if distance_to_player <= RIVER_SOUND_RANGE_NEAR:
-            sound_sources['river'] = 2  # Near level
-        elif distance_to_player <= RIVER_SOUND_RANGE_FAR:
-            sound_sources['river'] = 1  # Far level
-
-    return sound_sources
-
-def line_of_sight_visibility(center_x, center_y, terrain_type):
     VERTICAL_SCALE = 1  # Adjust vertical exaggeration
 
-    visible_cells = []
-
-    # Get viewer elevation in feet (include vegetation at viewer's location)
-    viewer_terrain_elevation = terrain_height(center_x, center_y, terrain_type)
-    viewer_veg_height = vegetation_height(center_x, center_y, viewer_terrain_elevation)
-    viewer_elevation = viewer_terrain_elevation + viewer_veg_height + VIEWER_HEIGHT_FT
-
-    # Calculate horizon distance in miles
-    max_view_distance_miles = horizon_distance(viewer_elevation)
-    max_view_distance_squares = int(max_view_distance_miles / SQUARE_SIZE_MILES)
-
-    # Ensure we have at least one square to look at
-    if max_view_distance_squares < 1:
-        max_view_distance_squares = 1
-
-    # Cast rays in all directions
-    for angle_deg in range(0, 360, 2):
-        angle_rad = math.radians(angle_deg)
-        sin_theta = math.sin(angle_rad)
-        cos_theta = math.cos(angle_rad)
-
-        prev_max_angle = -math.inf
-
-        for d in range(0, max_view_distance_squares + 1):
-            x = center_x + d * cos_theta
-            y = center_y + d * sin_theta
+    angles_rad = [math.radians(angle_deg) for angle_deg in np.arange(0, 360, angle_step).tolist()]
+    cos_angles = np.array([math.cos(angle_rad) for angle_rad in angles_rad])
+    sin_angles = np.array([math.sin(angle_rad) for angle_rad in angles_rad])
+    rays_per_viewer = len(angles_rad)
+    num_viewers = len(centers)
+    num_rays = num_viewers * rays_per_viewer
+
+    viewer_elevations = []
+    max_distances = []
+    for center_x, center_y in centers:
+        # Get viewer elevation in feet (include vegetation at viewer's location)
+        viewer_terrain_elevation = terrain_height(center_x, center_y, terrain_type)
+        viewer_veg_height = vegetation_height(center_x, center_y, viewer_terrain_elevation)
+        viewer_elevation = viewer_terrain_elevation + viewer_veg_height + VIEWER_HEIGHT_FT
+
+        # Calculate horizon distance in miles
+        max_view_distance_miles = horizon_distance(viewer_elevation)
+        max_view_distance_squares = int(max_view_distance_miles / SQUARE_SIZE_MILES)
+        if max_range is not None:
+            max_view_distance_squares = min(max_view_distance_squares, int(max_range))
+
+        # Ensure we have at least one square to look at
+        if max_view_distance_squares < 1:
+            max_view_distance_squares = 1
+        viewer_elevations.append(viewer_elevation)
+        max_distances.append(max_view_distance_squares)
+
+    # Rays are numbered viewer by viewer
+    ray_center_x = np.repeat(np.array([center[0] for center in centers]), rays_per_viewer)
+    ray_center_y = np.repeat(np.array([center[1] for center in centers]), rays_per_viewer)
+    ray_viewer_elevation = np.repeat(np.array(viewer_elevations), rays_per_viewer)
+    ray_max_distance = np.repeat(np.array(max_distances, dtype=np.int64), rays_per_viewer)
+    cos_theta = np.tile(cos_angles, num_viewers)
+    sin_theta = np.tile(sin_angles, num_viewers)
+
+    running_max_angle = np.full(num_rays, -np.inf)
+    next_distance = np.zeros(num_rays, dtype=np.int64)
+    active_rays = np.arange(num_rays)
+    chunks = []
+
+    while active_rays.size:
+        # Lay out each active ray's window of samples back to back in flat arrays
+        window_counts = np.minimum(VIEWSHED_CHUNK_SIZE, ray_max_distance[active_rays] + 1 - next_distance[active_rays])
+        segment_starts = np.cumsum(window_counts) - window_counts
+        sample_rays = np.repeat(active_rays, window_counts)
+        sample_distances = next_distance[sample_rays] + (np.arange(window_counts.sum()) - np.repeat(segment_starts, window_counts))
+
+        xs = ray_center_x[sample_rays] + sample_distances * cos_theta[sample_rays]
+        ys = ray_center_y[sample_rays] + sample_distances * sin_theta[sample_rays]
+        elevations = terrain_height_array(xs, ys, terrain_type)
+        veg_heights = vegetation_height_array(xs, ys, elevations)
+
+        delta_h = (elevations + veg_heights - ray_viewer_elevation[sample_rays]) * VERTICAL_SCALE
+        distances_ft = np.maximum(sample_distances * SQUARE_SIZE_MILES * 5280, 1)  # Convert miles to feet
+        elevation_angles = np.degrees(np.arctan2(delta_h, distances_ft))
+
+        # Each sample must rise above the running maximum angle of its ray. Within
+        # the visible prefix the angles strictly increase, so that maximum is the
+        # previous sample's angle, or the maximum carried over from earlier windows.
+        previous_max = np.empty_like(elevation_angles)
+        previous_max[1:] = elevation_angles[:-1]
+        previous_max[segment_starts] = running_max_angle[active_rays]
+        occluded = np.cumsum(elevation_angles <= previous_max)
+        occluded_before_segment = occluded[segment_starts] - (elevation_angles[segment_starts] <= previous_max[segment_starts])
+        visible = occluded == np.repeat(occluded_before_segment, window_counts)
+        visible_counts = np.add.reduceat(visible, segment_starts, dtype=np.int64)
+
+        chunks.append((sample_rays[visible], sample_distances[visible], xs[visible], ys[visible],
+                       elevations[visible], veg_heights[visible]))
+
+        has_visible = visible_counts > 0
+        last_visible = segment_starts[has_visible] + visible_counts[has_visible] - 1
+        running_max_angle[active_rays[has_visible]] = elevation_angles[last_visible]
+        next_distance[active_rays] += visible_counts
+
+        # Rays whose whole window was visible continue with another window
+        continuing = (visible_counts == window_counts) & (next_distance[active_rays] <= ray_max_distance[active_rays])
+        active_rays = active_rays[continuing]
+
+    rays, sample_distances, xs, ys, elevations, veg_heights = (np.concatenate(column) for column in zip(*chunks))
+    order = np.lexsort((sample_distances, rays))
+    rays = rays[order]
+    # Every ray has at least its first sample, so each viewer's samples form one run
+    viewer_starts = np.searchsorted(rays, np.arange(num_viewers + 1) * rays_per_viewer)
+
+    viewsheds = []
+    for viewer in range(num_viewers):
+        samples = order[viewer_starts[viewer]:viewer_starts[viewer + 1]]
+        viewer_xs = xs[samples]
+        viewer_ys = ys[samples]
+        viewsheds.append({
+            'viewer_elevation': viewer_elevations[viewer],
+            'max_distance': max_distances[viewer],
+            'ray': rays[viewer_starts[viewer]:viewer_starts[viewer + 1]] - viewer * rays_per_viewer,
+            'distance': sample_distances[samples],
+            'x': viewer_xs,
+            'y': viewer_ys,
+            'x_int': np.rint(viewer_xs).astype(np.int64),
+            'y_int': np.rint(viewer_ys).astype(np.int64),
+            'elevation': elevations[samples],
+            'vegetation_height': veg_heights[samples],
+        })
+    return viewsheds
 
-            x_int = int(round(x))
-            y_int = int(round(y))
+def intervisibility(viewer_xs, viewer_ys, target_xs, target_ys, terrain_type, max_range=VIEWSHED_MAX_RANGE):
+    """
+    Whether each viewer sees its target, for all pairs at once.
 
-            target_terrain_elevation = terrain_height(x, y, terrain_type)
-            target_veg_height = vegetation_height(x, y, target_terrain_elevation)
-            target_total_elevation = target_terrain_elevation + target_veg_height
+    Uses the viewshed's model: the viewer's eye is VIEWER_HEIGHT_FT above
+    the terrain and vegetation, the target must lie within the viewer's
+    horizon (and max_range), and the sightline is sampled once per cell of
+    distance, ending at the target. The target is visible when the elevation
+    angle of every sample rises above all the samples before it, exactly as
+    a viewshed ray would reach it. Sightlines are evaluated in windows of
+    VIEWSHED_CHUNK_SIZE samples and each stops at its first occluding sample.
 
-            # Determine if the cell is part of the river
-            target_water = is_river(x_int, y_int) if terrain_type == TERRAIN_MOUNTAINS else False
+    Returns a boolean array with one entry per pair.
+    """
+    viewer_xs = np.atleast_1d(np.asarray(viewer_xs, dtype=np.float64))
+    viewer_ys = np.atleast_1d(np.asarray(viewer_ys, dtype=np.float64))
+    dx = np.atleast_1d(np.asarray(target_xs, dtype=np.float64)) - viewer_xs
+    dy = np.atleast_1d(np.asarray(target_ys, dtype=np.float64)) - viewer_ys
+    num_pairs = viewer_xs.size
+    if num_pairs == 0:
+        return np.zeros(0, dtype=bool)
+
+    viewer_terrain_elevation = terrain_height_array(viewer_xs, viewer_ys, terrain_type)
+    viewer_elevation = (viewer_terrain_elevation + vegetation_height_array(viewer_xs, viewer_ys, viewer_terrain_elevation)
+                        + VIEWER_HEIGHT_FT)
+    # Vectorized horizon_distance, in squares
+    horizon_miles = np.minimum(1.22 * np.sqrt(np.maximum(viewer_elevation, VIEWER_HEIGHT_FT)), 20)
+    max_distance = (horizon_miles / SQUARE_SIZE_MILES).astype(np.int64)
+    if max_range is not None:
+        max_distance = np.minimum(max_distance, int(max_range))
+    max_distance = np.maximum(max_distance, 1)
+
+    # Samples 0, 1, ... up to the last whole cell short of the target, then
+    # the target (a target a whole number of cells away, up to rounding, is
+    # its own last sample)
+    lengths = np.hypot(dx, dy)
+    sample_counts = np.ceil(lengths - 1e-9).astype(np.int64) + 1
+    with np.errstate(invalid='ignore'):
+        step_x = np.where(lengths > 0, dx / lengths, 0)
+        step_y = np.where(lengths > 0, dy / lengths, 0)
+
+    visible = lengths <= max_distance
+    running_max_angle = np.full(num_pairs, -np.inf)
+    next_sample = np.zeros(num_pairs, dtype=np.int64)
+    active_pairs = np.flatnonzero(visible)
+
+    while active_pairs.size:
+        window_counts = np.minimum(VIEWSHED_CHUNK_SIZE, sample_counts[active_pairs] - next_sample[active_pairs])
+        segment_starts = np.cumsum(window_counts) - window_counts
+        sample_pairs = np.repeat(active_pairs, window_counts)
+        sample_indices = next_sample[sample_pairs] + (np.arange(window_counts.sum()) - np.repeat(segment_starts, window_counts))
+        sample_distances = np.where(sample_indices == sample_counts[sample_pairs] - 1,
+                                    lengths[sample_pairs], sample_indices)
+
+        xs = viewer_xs[sample_pairs] + sample_distances * step_x[sample_pairs]
+        ys = viewer_ys[sample_pairs] + sample_distances * step_y[sample_pairs]
+        elevations = terrain_height_array(xs, ys, terrain_type)
+        veg_heights = vegetation_height_array(xs, ys, elevations)
+        delta_h = elevations + veg_heights - viewer_elevation[sample_pairs]
+        distances_ft = np.maximum(sample_distances * SQUARE_SIZE_MILES * 5280, 1)
+        elevation_angles = np.degrees(np.arctan2(delta_h, distances_ft))
+
+        previous_max = np.empty_like(elevation_angles)
+        previous_max[1:] = elevation_angles[:-1]
+        previous_max[segment_starts] = running_max_angle[active_pairs]
+        occluded = np.add.reduceat(elevation_angles <= previous_max, segment_starts) > 0
+        visible[active_pairs[occluded]] = False
+
+        running_max_angle[active_pairs] = elevation_angles[segment_starts + window_counts - 1]
+        next_sample[active_pairs] += window_counts
+        active_pairs = active_pairs[~occluded & (next_sample[active_pairs] < sample_counts[active_pairs])]
+
+    return visible
+
+def viewshed_nbytes(viewshed):
+    """Bytes held by the arrays of a viewshed, including its visible cells."""
+    total = sum(value.nbytes for value in viewshed.values() if isinstance(value, np.ndarray))
+    cells = viewshed.get('cells')
+    if cells is not None:
+        total += cells.nbytes
+    return total
+
+class ViewshedCache:
+    """
+    Bounded LRU of viewshed results keyed by viewpoint and viewshed settings.
+    Shared by every lobby served by this process. Entries vary in size with
+    the horizon distance and ray spacing, so the cache is bounded by bytes.
+    """
 
-            delta_h = (target_total_elevation - viewer_elevation) * VERTICAL_SCALE
-            distance_ft = max(d * SQUARE_SIZE_MILES * 5280, 1)  # Convert miles to feet
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, viewshed):
+        size = viewshed_nbytes(viewshed)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (viewshed, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+viewshed_cache = ViewshedCache(VIEWSHED_CACHE_MAX_MB * 1024 * 1024)
+
+def get_viewsheds(centers, terrain_type, angle_step=VIEWSHED_ANGLE_STEP, max_range=VIEWSHED_MAX_RANGE):
+    """
+    Returns the viewsheds from each (x, y) cell in centers, reusing cached
+    results. Viewpoints missing from the cache are computed in one batch.
+    Cached results are shared between callers and must not be modified.
 
-            elevation_angle = math.degrees(math.atan2(delta_h, distance_ft))
+    A viewer that moved is cast in full: its ray samples fall on new points
+    of the continuous terrain, so nothing of its previous viewshed can be
+    reused exactly.
+    """
+    viewsheds = {}
+    missing = []
+    for center_x, center_y in centers:
+        if (center_x, center_y) in viewsheds:
+            continue
+        viewshed = viewshed_cache.get((terrain_type, center_x, center_y, angle_step, max_range))
+        viewsheds[(center_x, center_y)] = viewshed
+        if viewshed is None:
+            missing.append((center_x, center_y))
+
+    if missing:
+        computed = compute_viewsheds(missing, terrain_type, angle_step, max_range)
+        # One tile lookup for the cells of all new viewsheds
+        water = terrain_tile_cache.sample(np.concatenate([viewshed['x_int'] for viewshed in computed]),
+                                          np.concatenate([viewshed['y_int'] for viewshed in computed]),
+                                          terrain_type)['water']
+        water_ends = np.cumsum([len(viewshed['x_int']) for viewshed in computed])
+        for (center_x, center_y), viewshed, river in zip(missing, computed, np.split(water, water_ends[:-1])):
+            # Per-cell attributes only depend on the viewpoint, so they are cached with it
+            x_ints = viewshed['x_int']
+            y_ints = viewshed['y_int']
+            viewshed['water'] = river if terrain_type == TERRAIN_MOUNTAINS else np.zeros_like(river)
+
+            # Sound from river, by distance to the player
+            distance_to_player = np.sqrt((x_ints - center_x)**2 + (y_ints - center_y)**2)
+            river_levels = np.where(distance_to_player <= RIVER_SOUND_RANGE_NEAR, 2,
+                                    np.where(distance_to_player <= RIVER_SOUND_RANGE_FAR, 1, 0))
+            river_levels[~river] = 0
+            viewshed['river_level'] = river_levels
+
+            viewshed['cells'] = VisibleCells.from_viewshed(viewshed, center_x, center_y)
+
+            viewshed_cache.put((terrain_type, center_x, center_y, angle_step, max_range), viewshed)
+            viewsheds[(center_x, center_y)] = viewshed
+    return [viewsheds[center] for center in centers]
+
+def get_viewshed(center_x, center_y, terrain_type, angle_step=VIEWSHED_ANGLE_STEP, max_range=VIEWSHED_MAX_RANGE):
+    """Returns the viewshed from (center_x, center_y); see get_viewsheds."""
+    return get_viewsheds([(center_x, center_y)], terrain_type, angle_step, max_range)[0]
+
+class VisibleCells:
+    """
+    Deduplicated visible cells around a viewer, indexed by relative coordinate.
 
-            if elevation_angle > prev_max_angle:
-                # Point is visible
-                cell_elevation = target_terrain_elevation
-                cell_vegetation_height = target_veg_height
+    Cell attributes are parallel arrays; `index` is a (2 * radius + 1) square
+    grid holding each cell's position in those arrays, or -1 where nothing is
+    visible. Attribute arrays are shared with the viewshed cache; only the
+    enemy flag arrays belong to a single request.
+    """
 
-                # Compute sound levels for the cell
-                sound_sources = compute_sound_levels(x_int, y_int, center_x, center_y)
+    __slots__ = ('radius', 'index', 'x', 'y', 'elevation', 'vegetation_height', 'water', 'river_level',
+                 'enemy', 'enemy_fov', 'enemy_hearing')
+
+    def __init__(self, radius, index, x, y, elevation, vegetation_height, water, river_level):
+        self.radius = radius
+        self.index = index
+        self.x = x
+        self.y = y
+        self.elevation = elevation
+        self.vegetation_height = vegetation_height
+        self.water = water
+        self.river_level = river_level
+        self.enemy = np.zeros(len(x), dtype=bool)
+        self.enemy_fov = np.zeros(len(x), dtype=bool)
+        self.enemy_hearing = np.zeros(len(x), dtype=bool)
+
+    @classmethod
+    def from_viewshed(cls, viewshed, center_x, center_y):
+        radius = viewshed['max_distance']
+        side = 2 * radius + 1
+        rel_x = viewshed['x_int'] - center_x
+        rel_y = viewshed['y_int'] - center_y
+        flat = (rel_x + radius) * side + (rel_y + radius)
+
+        # Several ray samples can round to the same cell; keep the last one,
+        # which is the one clients used when they mapped cells by coordinate
+        _, first_in_reversed = np.unique(flat[::-1], return_index=True)
+        keep = np.sort(len(flat) - 1 - first_in_reversed)
+
+        index = np.full(side * side, -1, dtype=np.int32)
+        index[flat[keep]] = np.arange(len(keep), dtype=np.int32)
+        return cls(
+            radius,
+            index.reshape(side, side),
+            rel_x[keep],
+            rel_y[keep],
+            viewshed['elevation'][keep],
+            viewshed['vegetation_height'][keep],
+            viewshed['water'][keep],
+            viewshed['river_level'][keep]
+        )
+
+    def copy(self):
+        """Returns a view of the same cells with fresh enemy flags."""
+        return VisibleCells(self.radius, self.index, self.x, self.y, self.elevation,
+                            self.vegetation_height, self.water, self.river_level)
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the index and the shared attribute arrays."""
+        return sum(getattr(self, name).nbytes for name in
+                   ('index', 'x', 'y', 'elevation', 'vegetation_height', 'water', 'river_level'))
+
+    def find(self, dx, dy):
+        """Returns the position of cell (dx, dy) in the attribute arrays, or -1."""
+        if abs(dx) > self.radius or abs(dy) > self.radius:
+            return -1
+        return int(self.index[dx + self.radius, dy + self.radius])
+
+    def find_many(self, dxs, dys):
+        """Array version of find."""
+        dxs = np.asarray(dxs)
+        dys = np.asarray(dys)
+        inside = (np.abs(dxs) <= self.radius) & (np.abs(dys) <= self.radius)
+        positions = np.full(dxs.shape, -1, dtype=np.int32)
+        positions[inside] = self.index[dxs[inside] + self.radius, dys[inside] + self.radius]
+        return positions
+
+    def contains(self, dxs, dys):
+        """Whether each cell (dx, dy) is visible."""
+        return self.find_many(dxs, dys) >= 0
+
+    def to_dicts(self, positions=None):
+        """
+        Returns the cells in the list-of-dicts form used by the JSON API,
+        optionally only those at the given array positions.
+        """
+        if positions is None:
+            positions = slice(None)
+        cells = []
+        for x, y, elevation, veg_height, water, river_level, enemy, enemy_fov, enemy_hearing in zip(
+                self.x[positions].tolist(), self.y[positions].tolist(),
+                self.elevation[positions].tolist(), self.vegetation_height[positions].tolist(),
+                self.water[positions].tolist(), self.river_level[positions].tolist(),
+                self.enemy[positions].tolist(), self.enemy_fov[positions].tolist(),
+                self.enemy_hearing[positions].tolist()):
+            cell = {
+                'x': x,
+                'y': y,
+                'elevation': elevation,
+                'vegetation_height': veg_height,
+                'water': water,
+                'sound_sources': {'river': river_level} if river_level else {}  # Include sound sources
+            }
+            if enemy:
+                cell['enemy'] = True
+            if enemy_fov:
+                cell['enemy_fov'] = True
+            if enemy_hearing:
+                cell['enemy_hearing'] = True
+            cells.append(cell)
+        return cells
+
+class EnemyOverlay:
+    """
+    A lobby's enemies as seen by the views of all its players: enemy
+    positions as arrays, and the absolute cells of each enemy's field of
+    vision and hearing range, built the first time a view sees the enemy.
+    """
 
-                visible_cells.append({
-                    'x': x_int - center_x,
-                    'y': y_int - center_y,
-                    'elevation': cell_elevation,
-                    'vegetation_height': cell_vegetation_height,
-                    'water': target_water,
-                    'sound_sources': sound_sources  # Include sound sources
-                })
-                prev_max_angle = elevation_angle
-            else:
-                break
+    def __init__(self, enemies):
+        self.enemies = enemies
+        self.x = np.array([enemy['x'] for enemy in enemies], dtype=np.int64)
+        self.y = np.array([enemy['y'] for enemy in enemies], dtype=np.int64)
+        self._stencils = {}
+
+    def stencils(self, index):
+        """Returns the (fov, hearing) absolute cell arrays of enemy index."""
+        cells = self._stencils.get(index)
+        if cells is None:
+            fov_cells, hearing_cells = enemy_stencils(self.enemies[index]['direction'])
+            position = (self.x[index], self.y[index])
+            cells = self._stencils[index] = (fov_cells + position, hearing_cells + position)
+        return cells
+
+def tag_enemies(visible_cells, overlay, center_x, center_y):
+    """
+    Flags visible enemies and the visible cells inside their field of vision
+    or hearing range. Cost is proportional to the stencil sizes, not to the
+    number of visible cells.
+    """
+    if not overlay.enemies:
+        return
 
-    return visible_cells
+    # The view's grid index locates all enemies with a single lookup
+    enemy_cells = visible_cells.find_many(overlay.x - center_x, overlay.y - center_y)
 
-def tilt_angle(x, y, terrain_type):
-    dh_dx, dh_dy = terrain_gradient(x, y, terrain_type)
-    gradient_magnitude = math.sqrt(dh_dx**2 + dh_dy**2)
-    theta = math.atan(gradient_magnitude)
-    max_tilt_radians = math.radians(15)
-    if theta > max_tilt_radians:
-        theta = max_tilt_radians
-    return theta
+    # Enemies that are not visible do not include FOV and hearing ranges
+    visible_enemies = np.flatnonzero(enemy_cells >= 0)
+    if not visible_enemies.size:
+        return
+    # Mark the enemies' positions
+    visible_cells.enemy[enemy_cells[visible_enemies]] = True
+    fov_cells, hearing_cells = zip(*(overlay.stencils(index) for index in visible_enemies.tolist()))
 
-def tilt_direction(x, y, terrain_type):
-    dh_dx, dh_dy = terrain_gradient(x, y, terrain_type)
-    phi = math.atan2(dh_dy, dh_dx)
-    return phi
+    for cells, flags in ((fov_cells, visible_cells.enemy_fov), (hearing_cells, visible_cells.enemy_hearing)):
+        cells = np.concatenate(cells)
+        positions = visible_cells.find_many(cells[:, 0] - center_x, cells[:, 1] - center_y)
+        flags[positions[positions >= 0]] = True
 
 def vegetation_height(x, y, elevation):
     # Generate base vegetation density using Perlin noise
@@ -248,10 +1157,31 @@ def vegetation_height(x, y, elevation):
     veg_height = vegetation_density * MAX_VEG_HEIGHT
     return veg_height
 
-def compute_sounds(center_x, center_y, terrain_type, previous_positions):
+def sound_rng(lobby_code, game_state, player_index=0):
+    """
+    Random generator for a player's sounds, seeded by the lobby, its state
+    version and the player: sounds are stable while the state is unchanged
+    (so cached views and ETags stay consistent) and re-rolled on every change.
+    Enemy moves leave the version, and so the rolls, unchanged.
     """
-    Computes the sounds to be displayed on the client.
+    return np.random.default_rng([zlib.crc32(lobby_code.encode()), game_state.get('version', 0), player_index])
+
+def compute_sounds(center_x, center_y, terrain_type, previous_positions, enemies, rng=None):
     """
+    Computes the sounds to be displayed on the client: the ambient sounds,
+    then the enemies'.
+    """
+    return (compute_ambient_sounds(center_x, center_y, terrain_type, previous_positions, rng)
+            + compute_enemy_sounds(center_x, center_y, enemies))
+
+def compute_ambient_sounds(center_x, center_y, terrain_type, previous_positions, rng=None):
+    """
+    Computes the sounds that do not come from enemies.
+    Each kind of sound is evaluated as arrays over its sampling lattice;
+    rng (a NumPy Generator) drives the random vegetation sounds.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
     sounds = []
 
     # 1. River Sounds
@@ -259,18 +1189,12 @@ def compute_sounds(center_x, center_y, terrain_type, previous_positions):
     RIVER_SOUND_RANGE = 50  # in cells
 
     # Sample river cells every 10 cells within range
-    for dx in range(-RIVER_SOUND_RANGE, RIVER_SOUND_RANGE + 1, 10):
-        for dy in range(-RIVER_SOUND_RANGE, RIVER_SOUND_RANGE + 1, 10):
-            x = center_x + dx
-            y = center_y + dy
-            if is_river(x, y):
-                distance = math.sqrt(dx**2 + dy**2)
-                if distance <= RIVER_SOUND_RANGE:
-                    sounds.append({
-                        'x': dx,
-                        'y': dy,
-                        'color': 'blue'
-                    })
+    river_offsets = np.arange(-RIVER_SOUND_RANGE, RIVER_SOUND_RANGE + 1, 10)
+    dxs, dys = np.meshgrid(river_offsets, river_offsets, indexing='ij')
+    in_range = np.sqrt(dxs**2 + dys**2) <= RIVER_SOUND_RANGE
+    river_hits = terrain_tile_cache.sample(center_x + dxs, center_y + dys, terrain_type)['water'] & in_range
+    sounds.extend({'x': dx, 'y': dy, 'color': 'blue'}
+                  for dx, dy in zip(dxs[river_hits].tolist(), dys[river_hits].tolist()))
 
     # 2. Center Dot Sound (Player's Position)
     sounds.append({
@@ -282,92 +1206,808 @@ def compute_sounds(center_x, center_y, terrain_type, previous_positions):
     # 3. Previous Movements Sounds
     # Limit to last 10 movements to avoid clutter
     recent_positions = previous_positions[-10:]
-    for pos in recent_positions:
-        dx = pos['x'] - center_x
-        dy = pos['y'] - center_y
-        sounds.append({
-            'x': dx,
-            'y': dy,
-            'color': 'yellow'
-        })
+    sounds.extend({'x': pos['x'] - center_x, 'y': pos['y'] - center_y, 'color': 'yellow'}
+                  for pos in recent_positions)
 
     # 4. Random Sounds Based on Vegetation Density
     # Use the same distribution as vegetation
     RANDOM_SOUND_RANGE = 100  # in cells
-    for dx in range(-RANDOM_SOUND_RANGE, RANDOM_SOUND_RANGE + 1, 5):
-        for dy in range(-RANDOM_SOUND_RANGE, RANDOM_SOUND_RANGE + 1, 5):
-            x = center_x + dx
-            y = center_y + dy
-            # Probability based on vegetation density
-            veg_height = vegetation_height(x, y, terrain_height(x, y, terrain_type))
-            veg_density = veg_height / MAX_VEG_HEIGHT  # Normalize to [0,1]
-            if random.random() < veg_density * 0.05:  # 5% base probability
-                sounds.append({
-                    'x': dx,
-                    'y': dy,
-                    'color': 'green'
-                })
+    random_offsets = np.arange(-RANDOM_SOUND_RANGE, RANDOM_SOUND_RANGE + 1, 5)
+    dxs, dys = np.meshgrid(random_offsets, random_offsets, indexing='ij')
+    veg_heights = terrain_tile_cache.sample(center_x + dxs, center_y + dys, terrain_type)['vegetation_height']
+    veg_densities = veg_heights / MAX_VEG_HEIGHT  # Normalize to [0,1]
+    # Probability based on vegetation density, 5% base probability
+    rustles = rng.random(veg_densities.shape) < veg_densities * 0.05
+    sounds.extend({'x': dx, 'y': dy, 'color': 'green'}
+                  for dx, dy in zip(dxs[rustles].tolist(), dys[rustles].tolist()))
+    return sounds
 
+def compute_enemy_sounds(center_x, center_y, enemies):
+    """Computes the sounds of the enemies within earshot."""
     # 5. Enemy Sounds
-    for enemy in enemies:
-        dx = enemy['x'] - center_x
-        dy = enemy['y'] - center_y
-        distance = math.sqrt(dx**2 + dy**2)
-        if distance <= ENEMY_SOUND_RANGE_MAX:
-            # Compute intensity based on distance
-            if distance <= ENEMY_SOUND_RANGE_MIN:
-                intensity = 1.0  # Maximum intensity
-            else:
-                intensity = (ENEMY_SOUND_RANGE_MAX - distance) / (ENEMY_SOUND_RANGE_MAX - ENEMY_SOUND_RANGE_MIN)
-            # Convert intensity to color (red with varying opacity)
-            color = f'rgba(255, 0, 0, {intensity})'
-            sounds.append({
-                'x': dx,
-                'y': dy,
-                'color': color
-            })
+    sounds = []
+    if enemies:
+        enemy_dxs = np.array([enemy['x'] for enemy in enemies]) - center_x
+        enemy_dys = np.array([enemy['y'] for enemy in enemies]) - center_y
+        distances = np.sqrt(enemy_dxs**2 + enemy_dys**2)
+        audible = distances <= ENEMY_SOUND_RANGE_MAX
+        # Maximum intensity up to the minimum range, fading out to the maximum range
+        intensities = np.where(
+            distances <= ENEMY_SOUND_RANGE_MIN, 1.0,
+            (ENEMY_SOUND_RANGE_MAX - distances) / (ENEMY_SOUND_RANGE_MAX - ENEMY_SOUND_RANGE_MIN)
+        )
+        # Convert intensity to color (red with varying opacity)
+        sounds.extend({'x': dx, 'y': dy, 'color': f'rgba(255, 0, 0, {intensity})'}
+                      for dx, dy, intensity in zip(enemy_dxs[audible].tolist(), enemy_dys[audible].tolist(),
+                                                   intensities[audible].tolist()))
 
     return sounds
 
-def compute_enemy_fov(enemy_x, enemy_y, enemy_direction, fov_angle=60, fov_range=25):
+def compute_enemy_fov(enemy_x, enemy_y, enemy_direction, fov_angle=ENEMY_FOV_ANGLE, fov_range=ENEMY_FOV_RANGE):
     """
     Computes the cells within the enemy's field of vision cone.
     Returns a set of (dx, dy) tuples relative to the enemy's position.
     """
-    fov_cells = set()
     half_angle = fov_angle / 2
     start_angle = enemy_direction - half_angle
     end_angle = enemy_direction + half_angle
+    return set(_fov_cone(int(start_angle), int(end_angle), fov_range))
 
-    for angle in range(int(start_angle), int(end_angle) + 1):
+@functools.lru_cache(maxsize=1024)
+def _fov_cone(start_angle, end_angle, fov_range):
+    # The cone only depends on the whole degrees it spans, so it is cached by them
+    fov_cells = set()
+    for angle in range(start_angle, end_angle + 1):
         angle_rad = math.radians(angle % 360)
         for d in range(1, fov_range + 1):
             dx = int(round(d * math.cos(angle_rad)))
             dy = int(round(d * math.sin(angle_rad)))
             fov_cells.add((dx, dy))
-    return fov_cells
+    return frozenset(fov_cells)
 
-def compute_enemy_hearing(enemy_x, enemy_y, hearing_range=15):
+def compute_enemy_hearing(enemy_x, enemy_y, hearing_range=ENEMY_HEARING_RANGE):
     """
     Computes the cells within the enemy's hearing circle.
     Returns a set of (dx, dy) tuples relative to the enemy's position.
     """
+    return set(_hearing_disc(hearing_range))
+
+@functools.lru_cache(maxsize=None)
+def _hearing_disc(hearing_range):
     hearing_cells = set()
     for dx in range(-hearing_range, hearing_range + 1):
         for dy in range(-hearing_range, hearing_range + 1):
             if dx**2 + dy**2 <= hearing_range**2:
                 hearing_cells.add((dx, dy))
-    return hearing_cells
+    return frozenset(hearing_cells)
+
+def enemy_stencils(enemy_direction, fov_angle=ENEMY_FOV_ANGLE, fov_range=ENEMY_FOV_RANGE,
+                   hearing_range=ENEMY_HEARING_RANGE):
+    """
+    Returns the enemy's field of vision and the rest of its hearing circle
+    as (n, 2) arrays of (dx, dy) offsets. Shared between callers; do not modify.
+    """
+    half_angle = fov_angle / 2
+    return _enemy_stencils(int(enemy_direction - half_angle), int(enemy_direction + half_angle),
+                           fov_range, hearing_range)
+
+@functools.lru_cache(maxsize=1024)
+def _enemy_stencils(start_angle, end_angle, fov_range, hearing_range):
+    fov_cells = _fov_cone(start_angle, end_angle, fov_range)
+    hearing_cells = _hearing_disc(hearing_range) - fov_cells
+    stencils = []
+    for cells in (fov_cells, hearing_cells):
+        offsets = np.array(sorted(cells), dtype=np.int64).reshape(-1, 2)
+        offsets.setflags(write=False)
+        stencils.append(offsets)
+    return tuple(stencils)
 
 def get_visibility_range(x, y, terrain_type):
-    theta = tilt_angle(x, y, terrain_type)
+    if isinstance(x, (int, np.integer)) and isinstance(y, (int, np.integer)):
+        field = slope_field(x, y, terrain_type)
+        slope, phi = float(field['slope']), float(field['aspect'])
+    else:
+        slope, phi = terrain_slope_aspect_array(x, y, terrain_type)
+    theta = min(float(slope), math.radians(MAX_TILT_DEGREES))
     sin_theta = math.sin(theta)
     d_downhill_miles = 1.22 * math.sqrt(VIEWER_HEIGHT_FT * (1 + sin_theta))
     d_uphill_miles = 1.22 * math.sqrt(VIEWER_HEIGHT_FT * (1 - sin_theta))
     a_squares = int(d_downhill_miles / SQUARE_SIZE_MILES)
     b_squares = int(d_uphill_miles / SQUARE_SIZE_MILES)
-    phi = tilt_direction(x, y, terrain_type)
-    return a_squares, b_squares, phi
+    return a_squares, b_squares, float(phi)
+
+# Columnar wire format for /visible_cells
+#
+# Clients that send `Accept: application/vnd.behind-enemy-lines.columnar` (or
+# `?format=columnar`) receive little-endian column buffers instead of JSON:
+#
+#   header   magic 'BELV', u8 version, u8 reserved, u16 reserved, u32 cell count,
+#            f32 elevation offset, f32 elevation step, f32 vegetation step,
+#            u32 metadata length
+#   int16    x[count], y[count]             relative cell coordinates
+#   uint16   elevation[count]               offset + value * step feet
+#   uint8    vegetation[count]              value * step feet
+#   uint8    flags[count]                   bit 0 water, 1 enemy, 2 enemy FOV,
+#                                           3 enemy hearing, bits 4-5 river sound level
+#   bytes    metadata                       UTF-8 JSON with the remaining response fields
+
+COLUMNAR_MIMETYPE = 'application/vnd.behind-enemy-lines.columnar'
+COLUMNAR_MAGIC = b'BELV'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sBBHIfffI')
+COLUMNAR_MIN_ELEVATION_STEP = 0.01  # Feet
+COLUMNAR_COMPRESSION_MIN_BYTES = 1024
+
+def requested_view_format():
+    """The /visible_cells format the client asked for: 'json', 'columnar' or 'raster'."""
+    requested = request.args.get('format')
+    if requested in ('columnar', 'raster'):
+        return requested
+    best = request.accept_mimetypes.best_match(['application/json', COLUMNAR_MIMETYPE, RASTER_MIMETYPE])
+    return {COLUMNAR_MIMETYPE: 'columnar', RASTER_MIMETYPE: 'raster'}.get(best, 'json')
+
+def _quantize_view(elevation, vegetation_height):
+    """
+    Quantizes elevations to uint16 steps above an offset and vegetation
+    heights to uint8 steps. Returns (elevation offset, elevation step,
+    vegetation step, elevations, vegetation heights).
+    """
+    if elevation.size:
+        elevation_offset = float(np.floor(elevation.min()))
+        elevation_step = max(float(elevation.max() - elevation_offset) / 65535, COLUMNAR_MIN_ELEVATION_STEP)
+    else:
+        elevation_offset = 0.0
+        elevation_step = COLUMNAR_MIN_ELEVATION_STEP
+    vegetation_step = MAX_VEG_HEIGHT / 255
+
+    # Quantize with the same float32 constants the client will read back
+    elevation_offset = float(np.float32(elevation_offset))
+    elevation_step = float(np.float32(elevation_step))
+    quantized_elevation = np.clip(np.rint((elevation - elevation_offset) / elevation_step), 0, 65535).astype('<u2')
+    quantized_vegetation = np.clip(np.rint(vegetation_height / vegetation_step), 0, 255).astype(np.uint8)
+    # Sparse vegetation stays vegetation rather than rounding down to bare ground
+    quantized_vegetation[(vegetation_height > 0) & (quantized_vegetation == 0)] = 1
+    return elevation_offset, elevation_step, vegetation_step, quantized_elevation, quantized_vegetation
+
+def encode_columnar_view(visible_cells, metadata):
+    """Packs VisibleCells and the JSON-serializable metadata into the columnar format."""
+    count = len(visible_cells)
+    elevation_offset, elevation_step, vegetation_step, quantized_elevation, quantized_vegetation = \
+        _quantize_view(visible_cells.elevation, visible_cells.vegetation_height)
+
+    flags = (visible_cells.water.astype(np.uint8)
+             | (visible_cells.enemy.astype(np.uint8) << 1)
+             | (visible_cells.enemy_fov.astype(np.uint8) << 2)
+             | (visible_cells.enemy_hearing.astype(np.uint8) << 3)
+             | (visible_cells.river_level.astype(np.uint8) << 4))
+
+    metadata_bytes = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    header = COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, 0, 0, count,
+                                  elevation_offset, elevation_step, vegetation_step, len(metadata_bytes))
+    return b''.join([
+        header,
+        visible_cells.x.astype('<i2').tobytes(),
+        visible_cells.y.astype('<i2').tobytes(),
+        quantized_elevation.tobytes(),
+        quantized_vegetation.tobytes(),
+        flags.tobytes(),
+        metadata_bytes,
+    ])
+
+# Raster wire format for /visible_cells
+#
+# Clients that send `Accept: application/vnd.behind-enemy-lines.raster` (or
+# `?format=raster`) receive the viewport as a dense square of side `size`
+# centered on the player, so it can be drawn without placing cells one by
+# one. Channels are row-major: the cell (x, y) relative to the player is at
+# (y + size // 2) * size + (x + size // 2).
+#
+#   header   magic 'BELR', u8 version, u8 reserved, u16 size,
+#            f32 elevation offset, f32 elevation step, f32 vegetation step,
+#            u32 metadata length
+#   uint16   elevation[size * size]         offset + value * step feet
+#   uint8    vegetation[size * size]        value * step feet
+#   uint8    flags[size * size]             bit 0 visible, 1 water, 2 enemy, 3 enemy FOV,
+#                                           4 enemy hearing, bits 5-6 river sound level,
+#                                           7 previous position
+#   uint8    sound[size * size]             0 none, 1 river, 2 player, 3 recent position,
+#                                           4 vegetation; bit 7 set: enemy, bits 0-6 intensity
+#   bytes    metadata                       UTF-8 JSON with the remaining response fields
+#                                           (the sounds are in the sound channel)
+#
+# Channels of cells that are not visible are zero, except sounds and
+# previous positions, which are shown wherever they fall in the viewport.
+
+RASTER_MIMETYPE = 'application/vnd.behind-enemy-lines.raster'
+RASTER_MAGIC = b'BELR'
+RASTER_VERSION = 1
+RASTER_HEADER = struct.Struct('<4sBBHfffI')
+RASTER_VIEWPORT_SIZE = 201  # Cells per side, as drawn by the game page
+RASTER_SOUND_CODES = {'blue': 1, 'red': 2, 'yellow': 3, 'green': 4}
+RASTER_ENEMY_SOUND = 0x80
+
+def _raster_sound_code(color):
+    code = RASTER_SOUND_CODES.get(color)
+    if code is None:
+        # Enemy sounds are 'rgba(255, 0, 0, <intensity>)'
+        intensity = float(color[color.rindex(',') + 1:-1])
+        code = RASTER_ENEMY_SOUND | int(round(min(max(intensity, 0.0), 1.0) * 127))
+    return code
+
+def encode_raster_view(visible_cells, metadata, size=RASTER_VIEWPORT_SIZE):
+    """Packs the viewport around the player and the JSON-serializable metadata into the raster format."""
+    half = size // 2
+    reach = min(half, visible_cells.radius)
+    radius = visible_cells.radius
+    # Position of each viewport cell in the attribute arrays, -1 where nothing is visible
+    positions = np.full((size, size), -1, dtype=np.int32)
+    positions[half - reach:half + reach + 1, half - reach:half + reach + 1] = \
+        visible_cells.index[radius - reach:radius + reach + 1, radius - reach:radius + reach + 1].T
+    visible = positions >= 0
+    cells = positions[visible]
+
+    elevation_offset, elevation_step, vegetation_step, quantized_elevation, quantized_vegetation = \
+        _quantize_view(visible_cells.elevation[cells], visible_cells.vegetation_height[cells])
+    elevation = np.zeros((size, size), dtype='<u2')
+    elevation[visible] = quantized_elevation
+    vegetation = np.zeros((size, size), dtype=np.uint8)
+    vegetation[visible] = quantized_vegetation
+
+    flags = np.zeros((size, size), dtype=np.uint8)
+    flags[visible] = (1
+                      | (visible_cells.water[cells].astype(np.uint8) << 1)
+                      | (visible_cells.enemy[cells].astype(np.uint8) << 2)
+                      | (visible_cells.enemy_fov[cells].astype(np.uint8) << 3)
+                      | (visible_cells.enemy_hearing[cells].astype(np.uint8) << 4)
+                      | (visible_cells.river_level[cells].astype(np.uint8) << 5))
+    previous = np.array([(pos['x'], pos['y']) for pos in metadata['previous_positions']], dtype=np.int64).reshape(-1, 2)
+    previous = previous[(np.abs(previous) <= half).all(axis=1)]
+    flags[previous[:, 1] + half, previous[:, 0] + half] |= 0x80
+
+    # Later sounds are drawn over earlier ones, as on the game page
+    sound = np.zeros((size, size), dtype=np.uint8)
+    sounds = [(entry['x'], entry['y'], _raster_sound_code(entry['color'])) for entry in metadata['sounds']
+              if abs(entry['x']) <= half and abs(entry['y']) <= half]
+    if sounds:
+        sound_xs, sound_ys, codes = np.array(sounds, dtype=np.int64).T
+        sound[sound_ys + half, sound_xs + half] = codes
+
+    metadata_bytes = json.dumps({key: value for key, value in metadata.items() if key != 'sounds'},
+                                separators=(',', ':')).encode('utf-8')
+    header = RASTER_HEADER.pack(RASTER_MAGIC, RASTER_VERSION, 0, size,
+                                elevation_offset, elevation_step, vegetation_step, len(metadata_bytes))
+    return b''.join([header, elevation.tobytes(), vegetation.tobytes(), flags.tobytes(), sound.tobytes(),
+                     metadata_bytes])
+
+def compress_response(response):
+    """Compresses the response body with brotli or gzip if the client accepts it."""
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COLUMNAR_COMPRESSION_MIN_BYTES:
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# Instrumentation
+#
+# Request stages are timed with timed() into a span table kept per thread
+# (per greenlet under gevent), which is sent back as a Server-Timing header
+# and aggregated into the /metrics histograms. Outside a request timed()
+# does nothing, so code shared with the worker pool and the enemy tick can
+# be timed unconditionally. Views computed in the worker pool bring their
+# spans back with the result.
+
+_request_timing = threading.local()
+
+metrics_registry = metrics.Registry()
+request_latency = metrics_registry.histogram(
+    'bel_request_duration_seconds', 'Time to handle a request, by endpoint.', labels=('endpoint',))
+stage_latency = metrics_registry.histogram(
+    'bel_stage_duration_seconds', 'Time spent in each request stage.', labels=('stage',))
+view_cells = metrics_registry.histogram(
+    'bel_view_cells', 'Visible cells per view response.', buckets=VIEW_CELLS_BUCKETS)
+redis_round_trips = metrics_registry.counter(
+    'bel_redis_round_trips_total', 'Commands and pipelines sent to Redis.')
+request_redis_round_trips = metrics_registry.histogram(
+    'bel_request_redis_round_trips', 'Redis round trips per request, by endpoint.',
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16), labels=('endpoint',))
+
+def start_timing():
+    """Starts collecting the current request's spans."""
+    _request_timing.spans = {}
+    _request_timing.round_trips = 0
+    _request_timing.started = time.perf_counter()
+
+def finish_timing():
+    """
+    Stops collecting spans. Returns (spans, Redis round trips, elapsed
+    seconds), or None if no spans were being collected.
+    """
+    spans = getattr(_request_timing, 'spans', None)
+    if spans is None:
+        return None
+    _request_timing.spans = None
+    return spans, _request_timing.round_trips, time.perf_counter() - _request_timing.started
+
+@contextlib.contextmanager
+def timed(stage):
+    """Adds the wall time of the block to the stage's span of the current request."""
+    spans = getattr(_request_timing, 'spans', None)
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[stage] = spans.get(stage, 0.0) + time.perf_counter() - started
+
+def add_spans(spans):
+    """Adds spans timed elsewhere, e.g. in a view worker, to the current request's."""
+    current = getattr(_request_timing, 'spans', None)
+    if current is None:
+        return
+    for stage, seconds in spans.items():
+        current[stage] = current.get(stage, 0.0) + seconds
+
+def count_redis_round_trip():
+    redis_round_trips.inc()
+    if getattr(_request_timing, 'spans', None) is not None:
+        _request_timing.round_trips += 1
+
+class CountingRedis(redis.Redis):
+    """Redis client that counts its round trips to the server."""
+
+    def execute_command(self, *args, **options):
+        count_redis_round_trip()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class CountingPipeline(Pipeline):
+    """Pipeline that counts each non-empty execute as one round trip."""
+
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            count_redis_round_trip()
+        return super().execute(raise_on_error)
+
+# Views and view deltas
+
+class LobbyViewCache:
+    """
+    Bounded LRU of the views of all players of a lobby, each valid for one
+    lobby state version and enemy tick. The first view requested after a
+    change computes the views of every player together; the other players
+    are then answered from the cache until the lobby changes again.
+    """
+
+    def __init__(self, max_lobbies):
+        self.max_lobbies = max_lobbies
+        self._entries = OrderedDict()  # lobby code: (version, enemy tick, views)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, lobby_code, version):
+        """
+        Returns the (enemy tick, views) cached for the lobby version, or
+        None. Views of another enemy tick are partly reusable; see
+        build_lobby_views.
+        """
+        with self._lock:
+            entry = self._entries.get(lobby_code)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(lobby_code)
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, lobby_code, version, enemy_tick, views):
+        with self._lock:
+            self._entries[lobby_code] = (version, enemy_tick, views)
+            self._entries.move_to_end(lobby_code)
+            while len(self._entries) > self.max_lobbies:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'lobbies': len(self._entries),
+                'max_lobbies': self.max_lobbies,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+lobby_view_cache = LobbyViewCache(LOBBY_VIEW_CACHE_SIZE)
+
+def view_enemy_signature(enemies, cells, center_x, center_y):
+    """
+    The states of the enemies a view depends on: those standing on one of
+    its visible cells (which flag the view with their position, field of
+    vision and hearing range) and those within earshot (enemy sounds).
+    cells is the view's VisibleCells or ViewFootprint. Views of one lobby
+    version with equal signatures are identical, wherever the other enemies
+    are.
+    """
+    if not enemies:
+        return ()
+    dxs = np.array([enemy['x'] for enemy in enemies], dtype=np.int64) - center_x
+    dys = np.array([enemy['y'] for enemy in enemies], dtype=np.int64) - center_y
+    reaching = (dxs**2 + dys**2 <= ENEMY_SOUND_RANGE_MAX**2) | cells.contains(dxs, dys)
+    return tuple((enemies[index]['x'], enemies[index]['y'], enemies[index]['direction'])
+                 for index in np.flatnonzero(reaching).tolist())
+
+class ViewFootprint:
+    """
+    The cells visible from a viewpoint, one bit per cell of the view's
+    grid: enough to tell which enemies a view sees without keeping its
+    cell arrays.
+    """
+    __slots__ = ('radius', 'bits')
+
+    def __init__(self, visible_cells):
+        self.radius = visible_cells.radius
+        self.bits = np.packbits(visible_cells.index >= 0, axis=None)
+
+    def contains(self, dxs, dys):
+        """Whether each cell (dx, dy) is visible."""
+        dxs = np.asarray(dxs)
+        dys = np.asarray(dys)
+        inside = (np.abs(dxs) <= self.radius) & (np.abs(dys) <= self.radius)
+        flat = (dxs[inside] + self.radius) * (2 * self.radius + 1) + (dys[inside] + self.radius)
+        visible = np.zeros(dxs.shape, dtype=bool)
+        visible[inside] = (self.bits[flat >> 3] >> (7 - (flat & 7))) & 1
+        return visible
+
+class ViewFootprintCache:
+    """
+    Bounded LRU of ViewFootprints keyed by viewpoint and viewshed settings,
+    filled from the views this process serves so that view ETags can be
+    checked without computing the view.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            footprint = self._entries.get(key)
+            if footprint is not None:
+                self._entries.move_to_end(key)
+            return footprint
+
+    def put(self, key, visible_cells):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = ViewFootprint(visible_cells)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+view_footprint_cache = ViewFootprintCache(VIEW_FOOTPRINT_CACHE_SIZE)
+
+def view_footprint_key(game_state, player_index):
+    position = game_state['positions'][player_index]
+    return (game_state.get('terrain_type', TERRAIN_MOUNTAINS), position['x'], position['y'],
+            game_state.get('viewshed_angle_step', VIEWSHED_ANGLE_STEP),
+            game_state.get('viewshed_max_range', VIEWSHED_MAX_RANGE))
+
+def build_lobby_views(game_state, lobby_code, previous=None):
+    """
+    Computes every player's view of the lobby in one pass: viewsheds missing
+    from the cache are cast together, the enemy overlay is shared, and
+    players standing on the same cell share their visible cells.
+
+    previous optionally holds the lobby's views of the same state version
+    for other enemy positions, as returned by this function. Views whose
+    enemy signature is unchanged are then reused as they are, and the
+    others only redo their enemy flags and enemy sounds.
+
+    Returns a list of (VisibleCells, metadata, ambient sounds, enemy
+    signature) in player order.
+    """
+    terrain_type = game_state.get('terrain_type', TERRAIN_MOUNTAINS)
+    centers = [(position['x'], position['y']) for position in game_state['positions']]
+    overlay = EnemyOverlay(game_state.get('enemies', []))
+    tagged_cells = {}
+
+    def tag(center_x, center_y, cells):
+        visible_cells = tagged_cells.get((center_x, center_y))
+        if visible_cells is None:
+            with timed('enemies'):
+                visible_cells = cells.copy()
+                tag_enemies(visible_cells, overlay, center_x, center_y)
+            tagged_cells[(center_x, center_y)] = visible_cells
+        return visible_cells
+
+    if previous is not None:
+        views = []
+        for (center_x, center_y), view in zip(centers, previous):
+            visible_cells, metadata, ambient_sounds, signature = view
+            new_signature = view_enemy_signature(overlay.enemies, visible_cells, center_x, center_y)
+            if new_signature != signature:
+                visible_cells = tag(center_x, center_y, visible_cells)
+                with timed('sounds'):
+                    sounds = ambient_sounds + compute_enemy_sounds(center_x, center_y, overlay.enemies)
+                view = (visible_cells, {**metadata, 'sounds': sounds}, ambient_sounds, new_signature)
+            views.append(view)
+        return views
+
+    with timed('viewshed'):
+        viewsheds = get_viewsheds(
+            centers, terrain_type,
+            angle_step=game_state.get('viewshed_angle_step', VIEWSHED_ANGLE_STEP),
+            max_range=game_state.get('viewshed_max_range', VIEWSHED_MAX_RANGE)
+        )
+    histories = game_state.get('previous_positions', [])
+
+    views = []
+    for player_index, ((center_x, center_y), viewshed) in enumerate(zip(centers, viewsheds)):
+        visible_cells = tag(center_x, center_y, viewshed['cells'])
+
+        # Prepare previous positions relative to the current position
+        previous_positions = histories[player_index] if player_index < len(histories) else []
+        relative_previous_positions = [{'x': pos['x'] - center_x, 'y': pos['y'] - center_y}
+                                       for pos in previous_positions]
+
+        # Compute sounds, including enemies
+        with timed('sounds'):
+            ambient_sounds = compute_ambient_sounds(center_x, center_y, terrain_type, previous_positions,
+                                                    sound_rng(lobby_code, game_state, player_index))
+            sounds = ambient_sounds + compute_enemy_sounds(center_x, center_y, overlay.enemies)
+
+        metadata = {
+            'previous_positions': relative_previous_positions,
+            'lobby_code': lobby_code,
+            'sounds': sounds  # Include sounds in the response
+        }
+        views.append((visible_cells, metadata, ambient_sounds,
+                      view_enemy_signature(overlay.enemies, visible_cells, center_x, center_y)))
+    return views
+
+def build_view(game_state, lobby_code, player_index=0):
+    """
+    Computes a player's view of the lobby.
+    Returns the VisibleCells and a dict of the remaining response fields,
+    shared with the lobby view cache.
+    """
+    version = game_state.get('version', 0)
+    enemy_tick = game_state.get('enemy_tick', 0)
+    cached = lobby_view_cache.get(lobby_code, version)
+    if cached is not None and cached[0] == enemy_tick:
+        views = cached[1]
+    else:
+        views = build_lobby_views(game_state, lobby_code, cached[1] if cached is not None else None)
+        lobby_view_cache.put(lobby_code, version, enemy_tick, views)
+    visible_cells, metadata, _, _ = views[player_index]
+    return visible_cells, metadata
+
+def _absolute_cell_keys(visible_cells, center_x, center_y):
+    # Packs absolute cell coordinates into one integer per cell
+    return (visible_cells.x + center_x + 2**30) * 2**31 + (visible_cells.y + center_y + 2**30)
+
+def diff_views(previous, current):
+    """
+    Computes the change between the view a client holds and a new view.
+
+    `previous` is a (VisibleCells, metadata, (center_x, center_y), held)
+    tuple where held is the (elevations, vegetation heights) pair of arrays
+    the client currently holds for each cell; `current` is a (VisibleCells,
+    metadata, (center_x, center_y)) tuple.
+
+    Cell coordinates in the delta are relative to the current center. Clients
+    first move their existing cells by -shift, then drop `removed`, and then
+    insert `added` (new cells, and cells with new flags, sound levels, or an
+    elevation or vegetation height that drifted by more than
+    VIEW_DELTA_ELEVATION_TOLERANCE or VIEW_DELTA_VEGETATION_TOLERANCE). A
+    cell keeps its attributes across a move but takes its elevation and
+    vegetation height from whichever ray sample lands on it, so both drift a
+    little. Other fields are included only when they differ.
+
+    Returns the delta and the held pair after the client applies it.
+    """
+    previous_cells, previous_metadata, (previous_x, previous_y), (previous_elevations, previous_vegetation) = previous
+    current_cells, current_metadata, (current_x, current_y) = current
+
+    previous_keys = _absolute_cell_keys(previous_cells, previous_x, previous_y)
+    current_keys = _absolute_cell_keys(current_cells, current_x, current_y)
+    _, previous_common, current_common = np.intersect1d(
+        previous_keys, current_keys, assume_unique=True, return_indices=True)
+
+    removed = np.ones(len(previous_cells), dtype=bool)
+    removed[previous_common] = False
+    resend = np.ones(len(current_cells), dtype=bool)
+    resend[current_common] = (
+        (previous_cells.water[previous_common] != current_cells.water[current_common])
+        | (previous_cells.river_level[previous_common] != current_cells.river_level[current_common])
+        | (previous_cells.enemy[previous_common] != current_cells.enemy[current_common])
+        | (previous_cells.enemy_fov[previous_common] != current_cells.enemy_fov[current_common])
+        | (previous_cells.enemy_hearing[previous_common] != current_cells.enemy_hearing[current_common])
+        | (np.abs(previous_elevations[previous_common] - current_cells.elevation[current_common])
+           > VIEW_DELTA_ELEVATION_TOLERANCE)
+        | (np.abs(previous_vegetation[previous_common] - current_cells.vegetation_height[current_common])
+           > VIEW_DELTA_VEGETATION_TOLERANCE)
+    )
+
+    # Cells that are not resent keep the values the client already has
+    client_elevations = current_cells.elevation.copy()
+    client_vegetation = current_cells.vegetation_height.copy()
+    kept = ~resend[current_common]
+    client_elevations[current_common[kept]] = previous_elevations[previous_common[kept]]
+    client_vegetation[current_common[kept]] = previous_vegetation[previous_common[kept]]
+
+    delta = {
+        'shift': {'x': current_x - previous_x, 'y': current_y - previous_y},
+        'removed': np.stack([
+            previous_cells.x[removed] + previous_x - current_x,
+            previous_cells.y[removed] + previous_y - current_y,
+        ], axis=1).tolist(),
+        'added': current_cells.to_dicts(np.flatnonzero(resend)),
+    }
+    for key, value in current_metadata.items():
+        if previous_metadata.get(key) != value:
+            delta[key] = value
+    return delta, (client_elevations, client_vegetation)
+
+def view_etag(lobby_code, game_state, player_index, view_format, footprint):
+    """
+    Entity tag for a player's view: changes whenever the lobby state version,
+    the player or their position, the response format or the enemies the
+    view reaches (see view_enemy_signature) change. footprint is the
+    ViewFootprint of the player's position.
+    """
+    position = game_state['positions'][player_index]
+    signature = view_enemy_signature(game_state.get('enemies', []), footprint, position['x'], position['y'])
+    return (f"{lobby_code}-{game_state.get('version', 0)}-{player_index}-"
+            f"{position['x']}-{position['y']}-{view_format}-{zlib.crc32(repr(signature).encode()):08x}")
+
+# View worker pool
+#
+# Views are computed in worker processes, so the CPU-bound viewshed and sound
+# computations neither block request handling nor share one core. Each worker
+# is its own single-process pool and a lobby always maps to the same worker,
+# which keeps that worker's viewshed and terrain tile caches warm across the
+# lobby's moves.
+
+class ViewPoolUnavailable(Exception):
+    """Raised when a view cannot be computed within the queue and deadline limits."""
+
+class ViewWorkerPool:
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executors = [None] * workers  # Started on first use, in the serving process
+        self._pending = [0] * workers
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _executor(self, worker):
+        # Caller holds self._lock. Spawned rather than forked, as the serving
+        # process may be running threads or a gevent hub.
+        if self._executors[worker] is None:
+            self._executors[worker] = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._executors[worker]
+
+    def _task_done(self, worker, future):
+        with self._lock:
+            self._pending[worker] -= 1
+
+    def worker_for(self, key):
+        return zlib.crc32(key.encode()) % self.workers
+
+    def submit(self, key, fn, *args):
+        """
+        Queues fn(*args) on the worker that key maps to. Raises
+        ViewPoolUnavailable instead of queueing past max_pending.
+        """
+        worker = self.worker_for(key)
+        with self._lock:
+            if self._pending[worker] >= self.max_pending:
+                self.rejected += 1
+                raise ViewPoolUnavailable('Server busy, please retry')
+            try:
+                future = self._executor(worker).submit(fn, *args)
+            except BrokenProcessPool:
+                # The worker process died (e.g. it was killed): replace it
+                self._executors[worker] = None
+                future = self._executor(worker).submit(fn, *args)
+            self._pending[worker] += 1
+        future.add_done_callback(functools.partial(self._task_done, worker))
+        return future
+
+    def run(self, key, fn, *args, timeout):
+        """Runs fn(*args) on key's worker, waiting at most timeout seconds for the result."""
+        future = self.submit(key, fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()  # Drops the task if it has not started yet
+            with self._lock:
+                self.timeouts += 1
+            raise ViewPoolUnavailable('View computation timed out')
+        except BrokenProcessPool:
+            raise ViewPoolUnavailable('View worker failed')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': sum(self._pending),
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+            }
+
+view_pool = ViewWorkerPool(VIEW_POOL_WORKERS, VIEW_POOL_MAX_PENDING) if VIEW_POOL_WORKERS > 0 else None
+view_worker_cache_stats = {}  # Worker index: cache_stats() as of the worker's latest view
+
+def cache_stats():
+    """Statistics of this process's terrain, viewshed and lobby view caches."""
+    return {
+        'terrain_tiles': terrain_tile_cache.stats(),
+        'viewsheds': viewshed_cache.stats(),
+        'lobby_views': lobby_view_cache.stats(),
+    }
+
+def build_view_timed(game_state, lobby_code, player_index):
+    """
+    build_view as run in a view worker. Returns the view, the spans timed
+    while building it and the worker's cache statistics.
+    """
+    start_timing()
+    try:
+        view = build_view(game_state, lobby_code, player_index)
+    finally:
+        spans, _, _ = finish_timing()
+    return view, spans, cache_stats()
+
+def compute_view(game_state, lobby_code, player_index):
+    """
+    build_view, run in the view worker pool when it is enabled.
+    Raises ViewPoolUnavailable when the pool is saturated or misses the deadline.
+    """
+    with timed('view'):
+        if view_pool is None:
+            return build_view(game_state, lobby_code, player_index)
+        view, spans, worker_cache_stats = view_pool.run(
+            lobby_code, build_view_timed, game_state, lobby_code, player_index,
+            timeout=VIEW_REQUEST_TIMEOUT_SECONDS
+        )
+    add_spans(spans)
+    view_worker_cache_stats[view_pool.worker_for(lobby_code)] = worker_cache_stats
+    return view
+
+def view_unavailable_response(error):
+    response = jsonify({'status': 'error', 'message': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(VIEW_RETRY_AFTER_SECONDS)
+    return response
+
+def format_sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+def lobby_events_channel(lobby_code):
+    return f'lobby_events:{lobby_code}'
+
+def publish_lobby_event(lobby_code, event):
+    """Notifies open view streams of the lobby that its state changed."""
+    state_backend.publish(lobby_events_channel(lobby_code), event)
 
 # Session management functions (unchanged)
 def get_session_id():
@@ -377,21 +2017,1017 @@ def get_session_id():
     return session_id
 
 def get_session_data(session_id):
-    session_data_json = redis_client.get(f'session:{session_id}')
-    if session_data_json:
-        return json.loads(session_data_json)
-    else:
-        return {}
+    return state_backend.get_session(session_id)
 
 def save_session_data(session_id, session_data, expire_seconds=3600):
-    redis_client.set(f'session:{session_id}', json.dumps(session_data), ex=expire_seconds)
+    state_backend.save_session(session_id, session_data, expire_seconds)
 
 def generate_lobby_code():
-    """Generates a unique 6-character lobby code."""
-    while True:
-        lobby_code = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
-        if not redis_client.exists(lobby_code):
-            return lobby_code
+    """Generates a random 6-character lobby code."""
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
+
+def start_position():
+    """Every player starts at the center, or the first land cell south of it."""
+    # Ensure starting position is on land (not on the river)
+    start_x = 0  # Starting at the center
+    start_y = river_geometry.first_land(start_x, 0, 10)  # Moving south in steps of 10 until on land
+    return {'x': start_x, 'y': start_y}
+
+# Lobby state
+#
+# Each lobby is stored as a mapping from top-level game state field to its
+# JSON encoding, so mutations can read and write single fields. Mutations are
+# atomic; they bump the 'version' field, refresh the lobby TTL and publish to
+# the lobby's event channel. Enemy updates bump 'enemy_tick' instead, so that
+# views the enemies do not reach keep their version (see view_etag). Two
+# backends implement the same interface: RedisStateBackend (shared by any
+# number of processes) and MemoryStateBackend (one process only, no network
+# hop).
+
+LOBBY_TTL_SECONDS = 3600
+MAX_PLAYERS_PER_LOBBY = 4
+PREVIOUS_POSITIONS_LIMIT = 100  # Movement history kept per player
+MOVE_MAX_ATTEMPTS = 5  # Optimistic retries when concurrent moves conflict
+MOVE_MAX_SCALE = 100  # Most cells one /move may cover: the largest scale the game page offers
+
+ACTIVE_LOBBIES_KEY = 'active_lobbies'  # Set of lobby codes, pruned as lobbies expire
+ENEMY_TICK_LEASE_KEY = 'enemy_tick_lease'
+
+_CREATE_LOBBY_LUA = """
+-- KEYS[1] lobby; KEYS[2] active lobbies set; ARGV[1] ttl; ARGV[2..] field/value pairs
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], KEYS[1])
+return 1
+"""
+
+# The lobby key is read from the session inside the script, so this script
+# assumes a single Redis node (not Redis Cluster)
+_LOAD_SESSION_AND_LOBBY_LUA = """
+-- KEYS[1] session
+local session = redis.call('GET', KEYS[1])
+if not session then
+    return {}
+end
+local ok, data = pcall(cjson.decode, session)
+if not ok or type(data) ~= 'table' or type(data['lobby_code']) ~= 'string' then
+    return {session}
+end
+return {session, redis.call('HGETALL', data['lobby_code'])}
+"""
+
+_JOIN_LOBBY_LUA = """
+-- KEYS[1] lobby; ARGV[1] player name; ARGV[2] ttl; ARGV[3] event channel; ARGV[4] JSON start position
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'error', 'Invalid lobby code'}
+end
+if cjson.decode(redis.call('HGET', KEYS[1], 'game_started') or 'false') then
+    return {'error', 'Game has already started'}
+end
+local names = cjson.decode(redis.call('HGET', KEYS[1], 'player_names'))
+local ready = cjson.decode(redis.call('HGET', KEYS[1], 'ready_statuses'))
+local max_players = tonumber(redis.call('HGET', KEYS[1], 'max_players'))
+if #names >= max_players then
+    return {'error', 'Lobby is full'}
+end
+table.insert(names, ARGV[1])
+table.insert(ready, false)
+local index = tostring(#names - 1)
+redis.call('HSET', KEYS[1], 'player_names', cjson.encode(names), 'ready_statuses', cjson.encode(ready),
+           'position:' .. index, ARGV[4], 'previous_positions:' .. index, '[]')
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[3], 'join')
+return {'ok', cjson.encode(names), cjson.encode(ready), tostring(max_players), tostring(#names - 1)}
+"""
+
+_SET_READY_LUA = """
+-- KEYS[1] lobby; ARGV[1] player index; ARGV[2] '1' or '0'; ARGV[3] ttl; ARGV[4] event channel
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'error', 'Game state not found'}
+end
+local ready = cjson.decode(redis.call('HGET', KEYS[1], 'ready_statuses'))
+local index = tonumber(ARGV[1]) + 1
+if index < 1 or index > #ready then
+    return {'error', 'Player not in lobby'}
+end
+ready[index] = ARGV[2] == '1'
+redis.call('HSET', KEYS[1], 'ready_statuses', cjson.encode(ready))
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('PUBLISH', ARGV[4], 'ready')
+return {'ok', cjson.encode(ready)}
+"""
+
+_APPLY_MOVE_LUA = """
+-- KEYS[1] lobby; ARGV[1] player index; ARGV[2], ARGV[3] expected position;
+-- ARGV[4] JSON list of positions walked; ARGV[5] history limit; ARGV[6] ttl; ARGV[7] event channel
+local position = redis.call('HGET', KEYS[1], 'position:' .. ARGV[1])
+if not position then
+    return -1
+end
+position = cjson.decode(position)
+if position['x'] ~= tonumber(ARGV[2]) or position['y'] ~= tonumber(ARGV[3]) then
+    return 0
+end
+local steps = cjson.decode(ARGV[4])
+local history = cjson.decode(redis.call('HGET', KEYS[1], 'previous_positions:' .. ARGV[1]) or '[]')
+for _, step in ipairs(steps) do
+    table.insert(history, step)
+end
+local limit = tonumber(ARGV[5])
+if #history > limit then
+    local trimmed = {}
+    for i = #history - limit + 1, #history do
+        table.insert(trimmed, history[i])
+    end
+    history = trimmed
+end
+redis.call('HSET', KEYS[1], 'position:' .. ARGV[1], cjson.encode(steps[#steps]),
+           'previous_positions:' .. ARGV[1], cjson.encode(history))
+local new_version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('PUBLISH', ARGV[7], 'move')
+return new_version
+"""
+
+# Written by the enemy tick engine only. Lobby TTLs are not refreshed, so
+# enemies never keep an abandoned lobby alive, and the lobby version is left
+# alone: 'enemy_tick' versions the enemies.
+_UPDATE_ENEMIES_LUA = """
+-- KEYS[1] lobby; ARGV[1] expected enemy tick; ARGV[2] JSON enemies; ARGV[3] event channel
+local tick = redis.call('HGET', KEYS[1], 'enemy_tick')
+if redis.call('EXISTS', KEYS[1]) == 0 or (tonumber(tick) or 0) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'enemies', ARGV[2], 'enemy_tick', ARGV[1] + 1)
+redis.call('PUBLISH', ARGV[3], 'enemies')
+return 1
+"""
+
+# Per-player state is kept in one hash field per player ('position:0', ...),
+# so a move rewrites only the moving player's fields. Game states hold it as
+# lists indexed by player.
+_PLAYER_FIELDS = {'positions': 'position', 'previous_positions': 'previous_positions'}
+_PLAYER_FIELD_STATES = {prefix: state_field for state_field, prefix in _PLAYER_FIELDS.items()}
+
+def _lobby_hash_fields(fields):
+    # Expands per-player game state fields into their hash fields
+    hash_fields = []
+    for field in fields:
+        if field in _PLAYER_FIELDS:
+            hash_fields.extend(f'{_PLAYER_FIELDS[field]}:{index}' for index in range(MAX_PLAYERS_PER_LOBBY))
+        else:
+            hash_fields.append(field)
+    return hash_fields
+
+def _decode_lobby(fields):
+    # Accepts a dict or the flat [field, value, ...] list returned by HGETALL in Lua
+    if isinstance(fields, list):
+        fields = dict(zip(fields[::2], fields[1::2]))
+    game_state = {}
+    players = {}
+    for field, value in fields.items():
+        if isinstance(field, bytes):
+            field = field.decode()
+        prefix, _, player_index = field.partition(':')
+        if player_index and prefix in _PLAYER_FIELD_STATES:
+            players.setdefault(_PLAYER_FIELD_STATES[prefix], {})[int(player_index)] = json.loads(value)
+        else:
+            game_state[field] = json.loads(value)
+    for field, values in players.items():
+        game_state[field] = [values[index] for index in sorted(values)]
+    return game_state
+
+def _encode_lobby(game_state):
+    lobby = {}
+    for field, value in game_state.items():
+        if field in _PLAYER_FIELDS:
+            for player_index, player_value in enumerate(value):
+                lobby[f'{_PLAYER_FIELDS[field]}:{player_index}'] = json.dumps(player_value)
+        else:
+            lobby[field] = json.dumps(value)
+    return lobby
+
+class RedisStateBackend:
+    """
+    Keeps sessions as JSON strings and lobbies as Redis hashes. Lobby
+    mutations run as Lua scripts: atomic, and one round trip each.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._create_lobby_script = client.register_script(_CREATE_LOBBY_LUA)
+        self._load_session_and_lobby_script = client.register_script(_LOAD_SESSION_AND_LOBBY_LUA)
+        self._join_lobby_script = client.register_script(_JOIN_LOBBY_LUA)
+        self._set_ready_script = client.register_script(_SET_READY_LUA)
+        self._apply_move_script = client.register_script(_APPLY_MOVE_LUA)
+        self._update_enemies_script = client.register_script(_UPDATE_ENEMIES_LUA)
+
+    def get_session(self, session_id):
+        session_data_json = self.client.get(f'session:{session_id}')
+        if session_data_json:
+            return json.loads(session_data_json)
+        else:
+            return {}
+
+    def save_session(self, session_id, session_data, expire_seconds):
+        self.client.set(f'session:{session_id}', json.dumps(session_data), ex=expire_seconds)
+
+    def create_lobby(self, lobby_code, game_state):
+        """Stores a new lobby. Returns False if the lobby code is already taken."""
+        field_values = []
+        for field, value in _encode_lobby(game_state).items():
+            field_values.extend([field, value])
+        return bool(self._create_lobby_script(
+            keys=[lobby_code, ACTIVE_LOBBIES_KEY], args=[LOBBY_TTL_SECONDS, *field_values]
+        ))
+
+    def lobby_exists(self, lobby_code):
+        return bool(self.client.exists(lobby_code))
+
+    def load_lobby(self, lobby_code, fields=None):
+        """Returns the lobby game state (or only the given fields), or None if it does not exist."""
+        if fields is None:
+            values = self.client.hgetall(lobby_code)
+            return _decode_lobby(values) if values else None
+        hash_fields = _lobby_hash_fields(fields)
+        values = self.client.hmget(lobby_code, hash_fields)
+        if all(value is None for value in values):
+            return None
+        return _decode_lobby({field: value for field, value in zip(hash_fields, values) if value is not None})
+
+    def load_session_and_lobby(self, session_id):
+        """
+        Fetches the session data and its lobby's game state in one round trip.
+        The game state is None if the session has no lobby or the lobby expired.
+        """
+        result = self._load_session_and_lobby_script(keys=[f'session:{session_id}'])
+        session_data = json.loads(result[0]) if result else {}
+        game_state = _decode_lobby(result[1]) if len(result) > 1 and result[1] else None
+        return session_data, game_state
+
+    def join_lobby(self, lobby_code, player_name, position):
+        """
+        Atomically adds a player to a lobby, starting at position.
+        Returns (error message or None, lobby fields for the response).
+        """
+        result = self._join_lobby_script(
+            keys=[lobby_code],
+            args=[player_name, LOBBY_TTL_SECONDS, lobby_events_channel(lobby_code), json.dumps(position)]
+        )
+        if result[0] == b'error':
+            return result[1].decode(), None
+        return None, {
+            'player_names': json.loads(result[1]),
+            'ready_statuses': json.loads(result[2]),
+            'max_players': int(result[3]),
+            'player_index': int(result[4]),
+        }
+
+    def set_player_ready(self, lobby_code, player_index, ready):
+        """
+        Atomically sets one player's ready status.
+        Returns (error message or None, updated ready statuses).
+        """
+        result = self._set_ready_script(
+            keys=[lobby_code],
+            args=[player_index, '1' if ready else '0', LOBBY_TTL_SECONDS, lobby_events_channel(lobby_code)]
+        )
+        if result[0] == b'error':
+            return result[1].decode(), None
+        return None, json.loads(result[1])
+
+    def apply_move(self, lobby_code, player_index, expected_position, new_positions):
+        """
+        Moves a player along new_positions if they are still at
+        expected_position. Returns the new lobby version, 0 if the player
+        moved meanwhile, or -1 if the lobby or player no longer exists.
+        """
+        return self._apply_move_script(
+            keys=[lobby_code],
+            args=[player_index, expected_position['x'], expected_position['y'], json.dumps(new_positions),
+                  PREVIOUS_POSITIONS_LIMIT, LOBBY_TTL_SECONDS, lobby_events_channel(lobby_code)]
+        )
+
+    def active_lobbies(self):
+        return [lobby_code.decode() for lobby_code in self.client.smembers(ACTIVE_LOBBIES_KEY)]
+
+    def load_lobbies(self, lobby_codes, fields):
+        """
+        Loads the given fields of many lobbies in one round trip. Returns a
+        list with None for lobbies that no longer exist.
+        """
+        hash_fields = _lobby_hash_fields(fields)
+        pipeline = self.client.pipeline(transaction=False)
+        for lobby_code in lobby_codes:
+            pipeline.hmget(lobby_code, hash_fields)
+        lobbies = []
+        for values in pipeline.execute():
+            if all(value is None for value in values):
+                lobbies.append(None)
+            else:
+                lobbies.append(_decode_lobby(
+                    {field: value for field, value in zip(hash_fields, values) if value is not None}))
+        return lobbies
+
+    def save_enemies(self, updates, expired_lobbies=()):
+        """
+        Writes enemy states in one round trip. updates maps lobby codes to
+        (enemy tick the states were computed from, enemies); a lobby whose
+        enemies changed since that tick is skipped. Expired lobbies are
+        dropped from the active set.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for lobby_code, (enemy_tick, enemies) in updates.items():
+            self._update_enemies_script(
+                keys=[lobby_code],
+                args=[enemy_tick, json.dumps(enemies), lobby_events_channel(lobby_code)],
+                client=pipeline
+            )
+        if expired_lobbies:
+            pipeline.srem(ACTIVE_LOBBIES_KEY, *expired_lobbies)
+        pipeline.execute()
+
+    def acquire_lease(self, name, seconds):
+        """True if this process holds the named lease for the next seconds (one holder at a time)."""
+        return bool(self.client.set(name, uuid.uuid4().hex, nx=True, px=max(int(seconds * 1000), 1)))
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel):
+        """Returns a subscription with get_message(timeout) and close()."""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return pubsub
+
+class MemorySubscription:
+    """In-process counterpart of a Redis PubSub subscribed to one channel."""
+
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.messages = queue.Queue()
+
+    def get_message(self, timeout=0):
+        try:
+            if timeout:
+                data = self.messages.get(timeout=timeout)
+            else:
+                data = self.messages.get_nowait()
+        except queue.Empty:
+            return None
+        return {'type': 'message', 'channel': self.channel, 'data': data}
+
+    def close(self):
+        self.backend._unsubscribe(self)
+
+class MemoryStateBackend:
+    """
+    Keeps sessions and lobbies in this process's memory with the same
+    semantics as RedisStateBackend: per-key TTLs, atomic lobby mutations and
+    publish/subscribe. State is neither shared between processes nor
+    persisted, so run a single worker process with this backend.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 60  # How often expired keys are purged on writes
+
+    def __init__(self):
+        self._entries = {}  # key: (expires_at, value)
+        self._lobby_codes = set()
+        self._subscriptions = {}  # channel: set of MemorySubscription
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self.SWEEP_INTERVAL_SECONDS
+
+    # Callers hold self._lock
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry[1]
+
+    def _set(self, key, value, expire_seconds):
+        now = time.monotonic()
+        self._entries[key] = (now + expire_seconds, value)
+        if now >= self._next_sweep:
+            self._entries = {k: entry for k, entry in self._entries.items() if entry[0] > now}
+            self._next_sweep = now + self.SWEEP_INTERVAL_SECONDS
+
+    def _update_lobby(self, lobby_code, lobby, event):
+        lobby['version'] = str(int(lobby['version']) + 1)
+        self._set(lobby_code, lobby, LOBBY_TTL_SECONDS)
+        self._publish(lobby_events_channel(lobby_code), event)
+        return int(lobby['version'])
+
+    def _publish(self, channel, message):
+        for subscription in self._subscriptions.get(channel, ()):
+            subscription.messages.put(message)
+
+    def get_session(self, session_id):
+        with self._lock:
+            session_data_json = self._get(f'session:{session_id}')
+        return json.loads(session_data_json) if session_data_json else {}
+
+    def save_session(self, session_id, session_data, expire_seconds):
+        session_data_json = json.dumps(session_data)
+        with self._lock:
+            self._set(f'session:{session_id}', session_data_json, expire_seconds)
+
+    def create_lobby(self, lobby_code, game_state):
+        lobby = _encode_lobby(game_state)
+        with self._lock:
+            if self._get(lobby_code) is not None:
+                return False
+            self._set(lobby_code, lobby, LOBBY_TTL_SECONDS)
+            self._lobby_codes.add(lobby_code)
+        return True
+
+    def lobby_exists(self, lobby_code):
+        with self._lock:
+            return self._get(lobby_code) is not None
+
+    def load_lobby(self, lobby_code, fields=None):
+        with self._lock:
+            lobby = self._get(lobby_code)
+            if lobby is not None and fields is not None:
+                lobby = {field: lobby[field] for field in _lobby_hash_fields(fields) if field in lobby}
+            elif lobby is not None:
+                lobby = dict(lobby)
+        return _decode_lobby(lobby) if lobby else None
+
+    def load_session_and_lobby(self, session_id):
+        session_data = self.get_session(session_id)
+        game_state = None
+        if isinstance(session_data.get('lobby_code'), str):
+            game_state = self.load_lobby(session_data['lobby_code'])
+        return session_data, game_state
+
+    def join_lobby(self, lobby_code, player_name, position):
+        with self._lock:
+            lobby = self._get(lobby_code)
+            if lobby is None:
+                return 'Invalid lobby code', None
+            if json.loads(lobby.get('game_started', 'false')):
+                return 'Game has already started', None
+            player_names = json.loads(lobby['player_names'])
+            ready_statuses = json.loads(lobby['ready_statuses'])
+            max_players = json.loads(lobby['max_players'])
+            if len(player_names) >= max_players:
+                return 'Lobby is full', None
+            player_names.append(player_name)
+            ready_statuses.append(False)
+            lobby['player_names'] = json.dumps(player_names)
+            lobby['ready_statuses'] = json.dumps(ready_statuses)
+            lobby[f'position:{len(player_names) - 1}'] = json.dumps(position)
+            lobby[f'previous_positions:{len(player_names) - 1}'] = '[]'
+            self._update_lobby(lobby_code, lobby, 'join')
+        return None, {
+            'player_names': player_names,
+            'ready_statuses': ready_statuses,
+            'max_players': max_players,
+            'player_index': len(player_names) - 1,
+        }
+
+    def set_player_ready(self, lobby_code, player_index, ready):
+        with self._lock:
+            lobby = self._get(lobby_code)
+            if lobby is None:
+                return 'Game state not found', None
+            ready_statuses = json.loads(lobby['ready_statuses'])
+            if not 0 <= player_index < len(ready_statuses):
+                return 'Player not in lobby', None
+            ready_statuses[player_index] = bool(ready)
+            lobby['ready_statuses'] = json.dumps(ready_statuses)
+            self._update_lobby(lobby_code, lobby, 'ready')
+        return None, ready_statuses
+
+    def apply_move(self, lobby_code, player_index, expected_position, new_positions):
+        with self._lock:
+            lobby = self._get(lobby_code)
+            if lobby is None or f'position:{player_index}' not in lobby:
+                return -1
+            position = json.loads(lobby[f'position:{player_index}'])
+            if (position['x'], position['y']) != (expected_position['x'], expected_position['y']):
+                return 0
+            previous_positions = json.loads(lobby.get(f'previous_positions:{player_index}', '[]')) + new_positions
+            lobby[f'position:{player_index}'] = json.dumps(new_positions[-1])
+            lobby[f'previous_positions:{player_index}'] = json.dumps(previous_positions[-PREVIOUS_POSITIONS_LIMIT:])
+            return self._update_lobby(lobby_code, lobby, 'move')
+
+    def active_lobbies(self):
+        with self._lock:
+            return list(self._lobby_codes)
+
+    def load_lobbies(self, lobby_codes, fields):
+        return [self.load_lobby(lobby_code, fields) for lobby_code in lobby_codes]
+
+    def save_enemies(self, updates, expired_lobbies=()):
+        with self._lock:
+            for lobby_code, (enemy_tick, enemies) in updates.items():
+                lobby = self._get(lobby_code)
+                if lobby is None or json.loads(lobby.get('enemy_tick', '0')) != enemy_tick:
+                    continue
+                # Written in place: the lobby's TTL is not refreshed
+                lobby['enemies'] = json.dumps(enemies)
+                lobby['enemy_tick'] = json.dumps(enemy_tick + 1)
+                self._publish(lobby_events_channel(lobby_code), 'enemies')
+            self._lobby_codes.difference_update(expired_lobbies)
+
+    def acquire_lease(self, name, seconds):
+        now = time.monotonic()
+        with self._lock:
+            if self._get(name) is not None:
+                return False
+            self._entries[name] = (now + seconds, True)
+        return True
+
+    def publish(self, channel, message):
+        with self._lock:
+            self._publish(channel, message)
+
+    def subscribe(self, channel):
+        subscription = MemorySubscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[subscription.channel]
+
+def create_state_backend():
+    """Builds the backend selected by STATE_BACKEND."""
+    if STATE_BACKEND == 'memory':
+        return MemoryStateBackend()
+    if STATE_BACKEND != 'redis':
+        raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND!r}")
+
+    redis_url = REDIS_URL
+    if REDIS_TLS and redis_url.startswith('redis://'):
+        redis_url = redis_url.replace('redis://', 'rediss://', 1)
+    connection_kwargs = {}
+    if redis_url.startswith('rediss://'):
+        connection_kwargs = {'connection_class': SSLConnection, 'ssl_cert_reqs': REDIS_SSL_CERT_REQS}
+    pool = redis.ConnectionPool.from_url(
+        redis_url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        **connection_kwargs
+    )
+    return RedisStateBackend(CountingRedis(connection_pool=pool))
+
+state_backend = create_state_backend()
+
+# Path planning
+#
+# Routes are planned with A* over a traversal-cost grid derived from the
+# terrain tiles: stepping into a cell costs one plus penalties for the local
+# slope and the vegetation height, and river cells cannot be entered. Cost
+# tiles and planned routes are cached, since the terrain never changes.
+
+@functools.lru_cache(maxsize=PATH_COST_CACHE_TILES)
+def traversal_cost_tile(terrain_type, tile_x, tile_y):
+    """
+    Returns the read-only cost of stepping into each cell of a terrain tile,
+    indexed like the tile, with infinity for river cells.
+    """
+    terrain = terrain_tile_cache.get_tile(terrain_type, tile_x, tile_y)
+    rise = np.tan(slope_field_tile(terrain_type, tile_x, tile_y)['slope'], dtype=np.float64)  # Feet per cell
+    cost = 1 + PATH_SLOPE_COST * rise + PATH_VEGETATION_COST * terrain['vegetation_height'] / MAX_VEG_HEIGHT
+    cost[terrain['water']] = np.inf
+    cost.flags.writeable = False
+    return cost
+
+def traversal_cost_window(x0, y0, width, height, terrain_type):
+    """Returns the (width, height) traversal costs of the rectangle starting at cell (x0, y0)."""
+    size = terrain_tile_cache.tile_size
+    result = np.empty((width, height))
+    for tile_x in range(x0 // size, (x0 + width - 1) // size + 1):
+        for tile_y in range(y0 // size, (y0 + height - 1) // size + 1):
+            tile = traversal_cost_tile(terrain_type, tile_x, tile_y)
+            wx0 = max(x0, tile_x * size)
+            wy0 = max(y0, tile_y * size)
+            wx1 = min(x0 + width, (tile_x + 1) * size)
+            wy1 = min(y0 + height, (tile_y + 1) * size)
+            result[wx0 - x0:wx1 - x0, wy0 - y0:wy1 - y0] = \
+                tile[wx0 - tile_x * size:wx1 - tile_x * size, wy0 - tile_y * size:wy1 - tile_y * size]
+    return result
+
+@functools.lru_cache(maxsize=PATH_PLAN_CACHE_SIZE)
+def plan_route(terrain_type, start_x, start_y, goal_x, goal_y):
+    """
+    Plans the cheapest 4-connected route from the start to the goal cell
+    within PATH_PLAN_MARGIN cells of their bounding box. Returns a tuple of
+    the (x, y) cells walked, excluding the start, or None if there is none.
+    """
+    x0 = min(start_x, goal_x) - PATH_PLAN_MARGIN
+    y0 = min(start_y, goal_y) - PATH_PLAN_MARGIN
+    width = abs(goal_x - start_x) + 2 * PATH_PLAN_MARGIN + 1
+    height = abs(goal_y - start_y) + 2 * PATH_PLAN_MARGIN + 1
+    costs = traversal_cost_window(x0, y0, width, height, terrain_type).ravel().tolist()
+
+    # Cells are numbered (x - x0) * height + (y - y0); every step costs at
+    # least one, so the Manhattan distance never overestimates
+    start = (start_x - x0) * height + (start_y - y0)
+    goal = (goal_x - x0) * height + (goal_y - y0)
+    goal_cx, goal_cy = divmod(goal, height)
+    best = {start: 0.0}
+    came_from = {}
+    frontier = [(0.0, 0.0, start)]
+    while frontier:
+        _, cost, cell = heapq.heappop(frontier)
+        if cell == goal:
+            break
+        if cost > best[cell]:
+            continue
+        cx, cy = divmod(cell, height)
+        for nx, ny in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+            if not (0 <= nx < width and 0 <= ny < height):
+                continue
+            neighbor = nx * height + ny
+            new_cost = cost + costs[neighbor]
+            if new_cost < best.get(neighbor, math.inf):
+                best[neighbor] = new_cost
+                came_from[neighbor] = cell
+                heapq.heappush(frontier, (new_cost + abs(goal_cx - nx) + abs(goal_cy - ny), new_cost, neighbor))
+    else:
+        return None
+
+    route = []
+    cell = goal
+    while cell != start:
+        cx, cy = divmod(cell, height)
+        route.append((x0 + cx, y0 + cy))
+        cell = came_from[cell]
+    route.reverse()
+    return tuple(route)
+
+# Enemy simulation
+#
+# A background thread advances the enemies of every active lobby once per
+# ENEMY_TICK_SECONDS. A lease in the state backend lets only one process
+# tick per interval, and the enemies of all lobbies are stepped together as
+# arrays, with one batched read and one batched write per tick.
+
+def spawn_enemies(count, rng=None):
+    """Places enemies at random land cells near the start, each guarding its spawn point."""
+    if rng is None:
+        rng = np.random.default_rng()
+    enemy_xs, enemy_ys = river_geometry.sample_land(rng, count, -50, 50, -50, 50)
+    # Direction of each enemy's field of vision (in degrees)
+    directions = rng.uniform(0, 360, count)
+    enemies = []
+    for enemy_x, enemy_y, direction in zip(enemy_xs.tolist(), enemy_ys.tolist(), directions.tolist()):
+        enemies.append({
+            'x': enemy_x,
+            'y': enemy_y,
+            'direction': direction,
+            'home_x': enemy_x,
+            'home_y': enemy_y,
+            'alert': 0,  # Ticks of pursuit left
+        })
+    return enemies
+
+def step_enemies(enemies, player_x, player_y, terrain_type, rng):
+    """
+    Advances enemies by one tick. enemies is a dict of equally long arrays
+    (x, y, direction, home_x, home_y, alert); player_x and player_y give the
+    position of the player each enemy is hunting. Returns the new arrays.
+
+    An enemy detects the player when it hears them (within
+    ENEMY_HEARING_RANGE) or sees them (inside its field of vision, with line
+    of sight). It then turns towards the player and pursues them for
+    ENEMY_ALERT_TICKS. Otherwise it patrols: it wanders with a small random
+    heading change, turning back towards its post once more than
+    ENEMY_PATROL_RADIUS away. Enemies move one cell per tick and never
+    enter the river.
+    """
+    x = enemies['x']
+    y = enemies['y']
+    direction = enemies['direction']
+
+    to_player_x = player_x - x
+    to_player_y = player_y - y
+    player_distance = np.hypot(to_player_x, to_player_y)
+    player_bearing = np.degrees(np.arctan2(to_player_y, to_player_x))
+    off_axis = np.abs((player_bearing - direction + 180) % 360 - 180)
+
+    heard = player_distance <= ENEMY_HEARING_RANGE
+    in_fov = (player_distance <= ENEMY_FOV_RANGE) & (off_axis <= ENEMY_FOV_ANGLE / 2) & ~heard
+    detected = heard
+    if in_fov.any():
+        detected = heard.copy()
+        detected[in_fov] = intervisibility(x[in_fov], y[in_fov], player_x[in_fov], player_y[in_fov], terrain_type)
+    alert = np.where(detected, ENEMY_ALERT_TICKS, np.maximum(enemies['alert'] - 1, 0))
+
+    # Patrolling enemies wander, and head back once they stray too far from their post
+    to_home_x = enemies['home_x'] - x
+    to_home_y = enemies['home_y'] - y
+    home_bearing = np.degrees(np.arctan2(to_home_y, to_home_x))
+    wander = direction + rng.uniform(-ENEMY_TURN_JITTER, ENEMY_TURN_JITTER, x.size)
+    patrol_direction = np.where(np.hypot(to_home_x, to_home_y) > ENEMY_PATROL_RADIUS, home_bearing, wander)
+    # Alerted enemies face the player while they can detect them and keep their heading otherwise
+    direction = np.where(detected, player_bearing, np.where(alert > 0, direction, patrol_direction)) % 360
+
+    # Step one cell along the heading, unless that enters the river or reaches the player
+    direction_rad = np.radians(direction)
+    new_x = x + np.rint(np.cos(direction_rad)).astype(np.int64)
+    new_y = y + np.rint(np.sin(direction_rad)).astype(np.int64)
+    blocked = is_river_array(new_x, new_y) | ((new_x == player_x) & (new_y == player_y))
+    # Patrols turn around at the river bank
+    direction = np.where(blocked & (alert == 0), (direction + 180) % 360, direction)
+
+    return {
+        'x': np.where(blocked, x, new_x),
+        'y': np.where(blocked, y, new_y),
+        'direction': direction,
+        'home_x': enemies['home_x'],
+        'home_y': enemies['home_y'],
+        'alert': alert,
+    }
+
+class EnemyTickEngine:
+    """
+    Runs step_enemies over all active lobbies every interval seconds on a
+    background thread. Started by the first request a process serves, so
+    view pool workers never run it.
+    """
+
+    FIELDS = ('x', 'y', 'direction', 'home_x', 'home_y', 'alert')
+
+    def __init__(self, backend, interval, seed=None):
+        self.backend = backend
+        self.interval = interval
+        self._rng = np.random.default_rng(seed)
+        self._thread = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+        self.ticks = 0
+        self.overruns = 0  # Ticks that took longer than the interval
+        self.last_tick_seconds = 0.0
+        self.last_tick_lobbies = 0
+        self.last_tick_enemies = 0
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='enemy-tick', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stopped.is_set():
+            if self.backend.acquire_lease(ENEMY_TICK_LEASE_KEY, self.interval):
+                try:
+                    self.tick()
+                except Exception:
+                    app.logger.exception('Enemy tick failed')
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                self.overruns += 1
+                next_tick = time.monotonic()
+                delay = 0
+            self._stopped.wait(delay)
+
+    def tick(self):
+        """Advances the enemies of every active lobby by one step."""
+        started = time.perf_counter()
+        lobby_codes = self.backend.active_lobbies()
+        lobbies = self.backend.load_lobbies(lobby_codes, ['enemies', 'positions', 'enemy_tick', 'terrain_type'])
+        expired = [lobby_code for lobby_code, lobby in zip(lobby_codes, lobbies) if lobby is None]
+
+        # Lobbies sharing a terrain type are stepped as one batch
+        batches = {}
+        for lobby_code, lobby in zip(lobby_codes, lobbies):
+            if lobby and lobby.get('enemies') and lobby.get('positions'):
+                batches.setdefault(lobby.get('terrain_type', TERRAIN_MOUNTAINS), []).append((lobby_code, lobby))
+
+        updates = {}
+        num_enemies = 0
+        for terrain_type, batch in batches.items():
+            columns = {field: [] for field in self.FIELDS}
+            player_x = []
+            player_y = []
+            for _, lobby in batch:
+                for enemy in lobby['enemies']:
+                    columns['x'].append(enemy['x'])
+                    columns['y'].append(enemy['y'])
+                    columns['direction'].append(enemy['direction'])
+                    columns['home_x'].append(enemy.get('home_x', enemy['x']))
+                    columns['home_y'].append(enemy.get('home_y', enemy['y']))
+                    columns['alert'].append(enemy.get('alert', 0))
+                # Each enemy hunts the nearest player
+                enemy_x = np.array(columns['x'][-len(lobby['enemies']):])
+                enemy_y = np.array(columns['y'][-len(lobby['enemies']):])
+                players_x = np.array([position['x'] for position in lobby['positions']])
+                players_y = np.array([position['y'] for position in lobby['positions']])
+                nearest = np.argmin(np.hypot(enemy_x[:, None] - players_x, enemy_y[:, None] - players_y), axis=1)
+                player_x.append(players_x[nearest])
+                player_y.append(players_y[nearest])
+            arrays = {field: np.array(values, dtype=np.float64 if field == 'direction' else np.int64)
+                      for field, values in columns.items()}
+            stepped = step_enemies(arrays, np.concatenate(player_x), np.concatenate(player_y), terrain_type, self._rng)
+
+            rows = zip(*(stepped[field].tolist() for field in self.FIELDS))
+            for lobby_code, lobby in batch:
+                enemies = [dict(zip(self.FIELDS, next(rows))) for _ in lobby['enemies']]
+                num_enemies += len(enemies)
+                # Lobbies whose enemies all stood still are neither written nor notified
+                if enemies != lobby['enemies']:
+                    updates[lobby_code] = (lobby.get('enemy_tick', 0), enemies)
+
+        self.backend.save_enemies(updates, expired)
+        self.ticks += 1
+        self.last_tick_seconds = time.perf_counter() - started
+        self.last_tick_lobbies = sum(len(batch) for batch in batches.values())
+        self.last_tick_enemies = num_enemies
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'last_tick_seconds': self.last_tick_seconds,
+            'last_tick_lobbies': self.last_tick_lobbies,
+            'last_tick_enemies': self.last_tick_enemies,
+        }
+
+enemy_engine = EnemyTickEngine(state_backend, ENEMY_TICK_SECONDS)
+
+@app.before_request
+def start_enemy_engine():
+    enemy_engine.start()
+
+# Request instrumentation
+
+def _collapsed_stack(frame):
+    """The frame's stack, outermost call first, in the collapsed format flame graph tools read."""
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(calls))
+
+class SlowRequestProfiler:
+    """
+    Samples the Python stacks of in-flight requests on a CPU-time interval
+    timer (SIGPROF) and logs the most frequent stacks of requests slower
+    than the threshold. Only CPU time spent in this process is sampled:
+    views computed in the worker pool show up as waiting, so profile them
+    with VIEW_POOL_WORKERS=0.
+    """
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self._requests = {}  # Thread or greenlet ident: (start time, Counter of collapsed stacks)
+
+    def install(self):
+        """Starts the sampling timer. Call from the main thread."""
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def _sample(self, signum, frame):
+        if not self._requests:
+            return
+        # Handlers run in the main thread, on whichever greenlet was interrupted
+        current = threading.get_ident()
+        frames = sys._current_frames()
+        for ident, (_, stacks) in list(self._requests.items()):
+            sampled = frame if ident == current else frames.get(ident)
+            if sampled is not None:
+                stacks[_collapsed_stack(sampled)] += 1
+
+    def start(self):
+        self._requests[threading.get_ident()] = (time.perf_counter(), Counter())
+
+    def finish(self, description):
+        entry = self._requests.pop(threading.get_ident(), None)
+        if entry is None:
+            return
+        started, stacks = entry
+        elapsed = time.perf_counter() - started
+        if elapsed < self.threshold:
+            return
+        lines = [f'{stack} {count}' for stack, count in stacks.most_common(PROFILE_TOP_STACKS)]
+        app.logger.warning('Slow request %s took %.0f ms; %d stack samples:\n%s', description, elapsed * 1e3,
+                           sum(stacks.values()), '\n'.join(lines) or '(none: the request was waiting)')
+
+slow_request_profiler = None
+if (SLOW_REQUEST_PROFILE_SECONDS > 0 and hasattr(signal, 'setitimer')
+        and threading.current_thread() is threading.main_thread()
+        and multiprocessing.parent_process() is None):  # Not in view workers
+    slow_request_profiler = SlowRequestProfiler(SLOW_REQUEST_PROFILE_SECONDS, PROFILE_SAMPLE_INTERVAL_SECONDS)
+    slow_request_profiler.install()
+
+@app.before_request
+def start_request_instrumentation():
+    start_timing()
+    if slow_request_profiler is not None:
+        slow_request_profiler.start()
+
+@app.after_request
+def record_request_timing(response):
+    timing = finish_timing()
+    if timing is None:
+        return response
+    spans, round_trips, elapsed = timing
+    endpoint = request.endpoint or 'unmatched'
+    request_latency.observe(elapsed, endpoint)
+    request_redis_round_trips.observe(round_trips, endpoint)
+    for stage, seconds in spans.items():
+        stage_latency.observe(seconds, stage)
+    if SERVER_TIMING:
+        entries = [f'{stage};dur={seconds * 1e3:.2f}' for stage, seconds in spans.items()]
+        if round_trips:
+            entries.append(f'redis;desc="{round_trips} round trip{"s" if round_trips > 1 else ""}"')
+        entries.append(f'total;dur={elapsed * 1e3:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+@app.teardown_request
+def finish_request_instrumentation(error):
+    finish_timing()  # In case an error skipped record_request_timing
+    if slow_request_profiler is not None:
+        slow_request_profiler.finish(f'{request.method} {request.path}')
+
+@metrics_registry.collector
+def collect_cache_metrics():
+    snapshots = [cache_stats()] + list(view_worker_cache_stats.values())
+    totals = {}
+    for snapshot in snapshots:
+        for cache, stats in snapshot.items():
+            hits, misses = totals.get(cache, (0, 0))
+            totals[cache] = (hits + stats['hits'], misses + stats['misses'])
+    for cache, function in (('slope_field_tiles', slope_field_tile), ('path_cost_tiles', traversal_cost_tile),
+                            ('path_plans', plan_route)):
+        info = function.cache_info()
+        totals[cache] = (info.hits, info.misses)
+
+    return [
+        ('bel_cache_hits_total', 'counter', 'Cache hits, summed over the view workers.',
+         [({'cache': cache}, hits) for cache, (hits, _) in totals.items()]),
+        ('bel_cache_misses_total', 'counter', 'Cache misses, summed over the view workers.',
+         [({'cache': cache}, misses) for cache, (_, misses) in totals.items()]),
+        ('bel_cache_hit_ratio', 'gauge', 'Fraction of cache lookups that hit.',
+         [({'cache': cache}, hits / (hits + misses) if hits + misses else 0.0)
+          for cache, (hits, misses) in totals.items()]),
+    ]
+
+@metrics_registry.collector
+def collect_worker_metrics():
+    families = []
+    if view_pool is not None:
+        stats = view_pool.stats()
+        families += [
+            ('bel_view_pool_pending', 'gauge', 'Views queued or running in the worker pool.', [({}, stats['pending'])]),
+            ('bel_view_pool_rejected_total', 'counter', 'Views shed because the pool was full.',
+             [({}, stats['rejected'])]),
+            ('bel_view_pool_timeouts_total', 'counter', 'Views that missed their deadline.', [({}, stats['timeouts'])]),
+        ]
+    stats = enemy_engine.stats()
+    families += [
+        ('bel_enemy_ticks_total', 'counter', 'Enemy ticks run by this process.', [({}, stats['ticks'])]),
+        ('bel_enemy_tick_overruns_total', 'counter', 'Enemy ticks that took longer than the interval.',
+         [({}, stats['overruns'])]),
+        ('bel_enemy_last_tick_seconds', 'gauge', 'Duration of the latest enemy tick.',
+         [({}, stats['last_tick_seconds'])]),
+    ]
+    return families
+
+def metrics_request_allowed():
+    """
+    Whether the current request may scrape /metrics: it carries the
+    METRICS_TOKEN bearer token, or comes from this host when no token is set.
+    """
+    if METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        return hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+    return request.remote_addr in METRICS_LOOPBACK_ADDRESSES
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of this process's metrics."""
+    if not metrics_request_allowed():
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # Routes
 @app.route('/')
@@ -405,49 +3041,55 @@ def index():
 def start_game():
     session_id = get_session_id()
     data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
     player_name = data.get('player_name', 'Player1')
     terrain_type = TERRAIN_MOUNTAINS  # Fixed to mountains
-    lobby_code = generate_lobby_code()
-    session_data = {'lobby_code': lobby_code, 'player_name': player_name}
 
-    # Ensure starting position is on land (not on the river)
-    start_x, start_y = 0, 0  # Starting at the center
-    while is_river(start_x, start_y):
-        start_y += 10  # Move south until landing on land
-        # Optional: Add bounds checking here to prevent infinite loop
+    # Optional per-lobby viewshed settings to trade accuracy against latency
+    try:
+        viewshed_angle_step = float(data.get('viewshed_angle_step', VIEWSHED_ANGLE_STEP))
+        viewshed_max_range = data.get('viewshed_max_range', VIEWSHED_MAX_RANGE)
+        if viewshed_max_range is not None:
+            viewshed_max_range = int(viewshed_max_range)
+    except (ValueError, TypeError, OverflowError):
+        return jsonify({'status': 'error', 'message': 'Invalid viewshed settings'}), 400
+    # Bounded, as every view of the lobby casts 360 / angle step rays of up to max range cells
+    if (not VIEWSHED_MIN_ANGLE_STEP <= viewshed_angle_step <= VIEWSHED_MAX_ANGLE_STEP
+            or (viewshed_max_range is not None and not 1 <= viewshed_max_range <= VIEWSHED_RANGE_LIMIT)):
+        return jsonify({'status': 'error', 'message': 'Invalid viewshed settings'}), 400
+
+    try:
+        num_enemies = int(data.get('num_enemies', ENEMIES_PER_LOBBY))
+    except (ValueError, TypeError):
+        num_enemies = -1
+    if not 0 <= num_enemies <= MAX_ENEMIES_PER_LOBBY:
+        return jsonify({'status': 'error', 'message': 'Invalid number of enemies'}), 400
 
     # Initialize enemies
-    enemies = []
-    num_enemies = 2
-
-    for _ in range(num_enemies):
-        while True:
-            # Generate random positions for enemies
-            enemy_x = random.randint(-50, 50)
-            enemy_y = random.randint(-50, 50)
-            if not is_river(enemy_x, enemy_y):
-                break
-        # Assign random direction for enemy's field of vision (in degrees)
-        enemy_direction = random.uniform(0, 360)
-        enemies.append({
-            'x': enemy_x,
-            'y': enemy_y,
-            'direction': enemy_direction
-        })
+    enemies = spawn_enemies(num_enemies)
 
     game_state = {
-        'position': {'x': start_x, 'y': start_y},
-        'previous_positions': [],
-        'max_players': 4,
+        'version': 1,  # Incremented on every state change
+        'positions': [start_position()],  # Per player
+        'previous_positions': [[]],  # Per player
+        'max_players': MAX_PLAYERS_PER_LOBBY,
         'player_names': [player_name],
         'ready_statuses': [False],
         'game_started': False,
         'terrain_type': terrain_type,
-        'enemies': enemies  # Add enemies to game state
+        'viewshed_angle_step': viewshed_angle_step,
+        'viewshed_max_range': viewshed_max_range,
+        'enemies': enemies,  # Add enemies to game state
+        'enemy_tick': 0  # Incremented by the enemy tick engine on every update; versions the enemies
     }
 
-    redis_client.set(lobby_code, json.dumps(game_state), ex=3600)
+    # Retry on the rare lobby code collision
+    lobby_code = generate_lobby_code()
+    while not state_backend.create_lobby(lobby_code, game_state):
+        lobby_code = generate_lobby_code()
 
+    session_data = {'lobby_code': lobby_code, 'player_name': player_name, 'player_index': 0}
     save_session_data(session_id, session_data)
 
     response = jsonify({
@@ -469,35 +3111,41 @@ def join_game():
     if not lobby_code:
         return jsonify({'status': 'error', 'message': 'No lobby code provided'}), 400
 
-    game_state_json = redis_client.get(lobby_code)
-    if not game_state_json:
-        return jsonify({'status': 'error', 'message': 'Invalid lobby code'}), 400
-
-    game_state = json.loads(game_state_json)
-
-    if game_state.get('game_started'):
-        return jsonify({'status': 'error', 'message': 'Game has already started'}), 400
+    error, lobby = state_backend.join_lobby(lobby_code, player_name, start_position())
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
 
-    if len(game_state['player_names']) >= game_state['max_players']:
-        return jsonify({'status': 'error', 'message': 'Lobby is full'}), 400
-
-    game_state['player_names'].append(player_name)
-    game_state['ready_statuses'].append(False)
-    redis_client.set(lobby_code, json.dumps(game_state), ex=3600)
-
-    session_data = {'lobby_code': lobby_code, 'player_name': player_name}
+    session_data = {'lobby_code': lobby_code, 'player_name': player_name, 'player_index': lobby['player_index']}
     save_session_data(session_id, session_data)
 
     response = jsonify({
         'message': f'Joined lobby {lobby_code}',
         'lobby_code': lobby_code,
-        'player_names': game_state['player_names'],
-        'ready_statuses': game_state['ready_statuses'],
-        'max_players': game_state['max_players']
+        'player_names': lobby['player_names'],
+        'ready_statuses': lobby['ready_statuses'],
+        'max_players': lobby['max_players']
     })
     response.set_cookie('session_id', session_id)
     return response
 
+@app.route('/ready', methods=['POST'])
+def ready():
+    session_id = get_session_id()
+    session_data = get_session_data(session_id)
+    if 'lobby_code' not in session_data or 'player_index' not in session_data:
+        return jsonify({'status': 'error', 'message': 'Not in a game'}), 400
+
+    data = request.get_json(silent=True) or {}
+    error, ready_statuses = state_backend.set_player_ready(
+        session_data['lobby_code'], session_data['player_index'], bool(data.get('ready', True))
+    )
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+
+    response = jsonify({'status': 'success', 'ready_statuses': ready_statuses})
+    response.set_cookie('session_id', session_id)
+    return response
+
 @app.route('/game')
 def game():
     session_id = get_session_id()
@@ -511,88 +3159,126 @@ def game():
 @app.route('/visible_cells')
 def visible_cells():
     session_id = get_session_id()
-    session_data = get_session_data(session_id)
+    with timed('state'):
+        session_data, game_state = state_backend.load_session_and_lobby(session_id)
     if 'lobby_code' not in session_data:
         return jsonify({'status': 'error', 'message': 'Not in a game'}), 400
 
     lobby_code = session_data['lobby_code']
-
-    game_state_json = redis_client.get(lobby_code)
-    if not game_state_json:
+    if game_state is None:
         return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
+    player_index = session_data.get('player_index', 0)
+    if player_index >= len(game_state['positions']):
+        return jsonify({'status': 'error', 'message': 'Player not in lobby'}), 400
+
+    view_format = requested_view_format()
+
+    # Idle players poll an unchanged state: answer from the version, and the
+    # enemies within reach of the cells this viewpoint is known to see
+    footprint_key = view_footprint_key(game_state, player_index)
+    footprint = view_footprint_cache.get(footprint_key)
+    etag = view_etag(lobby_code, game_state, player_index, view_format, footprint) if footprint else None
+    if etag is not None and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        try:
+            visible_cells, metadata = compute_view(game_state, lobby_code, player_index)
+        except ViewPoolUnavailable as error:
+            return view_unavailable_response(error)
+        if footprint is None:
+            view_footprint_cache.put(footprint_key, visible_cells)
+            etag = view_etag(lobby_code, game_state, player_index, view_format, visible_cells)
+        view_cells.observe(len(visible_cells))
+        with timed('serialize'):
+            if view_format == 'columnar':
+                response = make_response(encode_columnar_view(visible_cells, metadata))
+                response.mimetype = COLUMNAR_MIMETYPE
+                response = compress_response(response)
+            elif view_format == 'raster':
+                response = make_response(encode_raster_view(visible_cells, metadata))
+                response.mimetype = RASTER_MIMETYPE
+                response = compress_response(response)
+            else:
+                response = jsonify({'visible_cells': visible_cells.to_dicts(), **metadata})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    response.set_cookie('session_id', session_id)
+    return response
 
-    game_state = json.loads(game_state_json)
-    terrain_type = game_state.get('terrain_type', TERRAIN_MOUNTAINS)
-
-    position = game_state['position']
-    center_x = position['x']
-    center_y = position['y']
-
-    # Use LOS visibility for "mountains" terrain
-    visible_cells = line_of_sight_visibility(center_x, center_y, terrain_type)
-
-    # Prepare previous positions relative to the current position
-    relative_previous_positions = []
-    for pos in game_state.get('previous_positions', []):
-        rel_x = pos['x'] - center_x
-        rel_y = pos['y'] - center_y
-        relative_previous_positions.append({'x': rel_x, 'y': rel_y})
-
-    # Create a set of visible positions for quick lookup
-    visible_positions = set((cell['x'], cell['y']) for cell in visible_cells)
-
-    # Get enemies from game state
-    enemies = game_state.get('enemies', [])
-
-    for enemy in enemies:
-        enemy_x = enemy['x']
-        enemy_y = enemy['y']
-        enemy_direction = enemy['direction']
-
-        # Compute relative position of enemy
-        enemy_rel_x = enemy_x - center_x
-        enemy_rel_y = enemy_y - center_y
-
-        enemy_visible = (enemy_rel_x, enemy_rel_y) in visible_positions
-
-        if enemy_visible:
-            # Mark the enemy's position
-            for cell in visible_cells:
-                if cell['x'] == enemy_rel_x and cell['y'] == enemy_rel_y:
-                    cell['enemy'] = True
-
-            # Compute FOV and hearing ranges
-            fov_cells = compute_enemy_fov(enemy_x, enemy_y, enemy_direction)
-            hearing_cells = compute_enemy_hearing(enemy_x, enemy_y)
-
-            # Mark cells in visible_cells
-            for cell in visible_cells:
-                cell_x_global = cell['x'] + center_x
-                cell_y_global = cell['y'] + center_y
-
-                dx_enemy = cell_x_global - enemy_x
-                dy_enemy = cell_y_global - enemy_y
-
-                if (dx_enemy, dy_enemy) in fov_cells:
-                    cell['enemy_fov'] = True
-                elif (dx_enemy, dy_enemy) in hearing_cells:
-                    cell['enemy_hearing'] = True
-        else:
-            # Enemy not visible, do not include FOV and hearing ranges
-            continue
-
-    # Get enemies from game state
-    enemies = game_state.get('enemies', [])
+@app.route('/view_stream')
+def view_stream():
+    """
+    Server-Sent Events stream of the player's view. Sends the full view once
+    ('view' event), then a 'delta' event whenever the lobby publishes a change.
+    Run under an async worker class (see Procfile) so that open streams do
+    not each hold a worker.
+    """
+    session_id = get_session_id()
+    session_data = get_session_data(session_id)
+    if 'lobby_code' not in session_data:
+        return jsonify({'status': 'error', 'message': 'Not in a game'}), 400
 
-    # Compute sounds, including enemies
-    sounds = compute_sounds(center_x, center_y, terrain_type, game_state.get('previous_positions', []), enemies)
+    lobby_code = session_data['lobby_code']
+    player_index = session_data.get('player_index', 0)
+    if not state_backend.lobby_exists(lobby_code):
+        return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
 
-    response = jsonify({
-        'visible_cells': visible_cells,
-        'previous_positions': relative_previous_positions,
-        'lobby_code': lobby_code,
-        'sounds': sounds  # Include sounds in the response
-    })
+    def generate():
+        pubsub = state_backend.subscribe(lobby_events_channel(lobby_code))
+        try:
+            previous = None
+            previous_key = None  # Lobby version and enemy signature of the view sent last
+            while True:
+                game_state = state_backend.load_lobby(lobby_code)
+                if game_state is None:
+                    yield format_sse('game_error', {'status': 'error', 'message': 'Game state not found'})
+                    return
+                if player_index >= len(game_state['positions']):
+                    yield format_sse('game_error', {'status': 'error', 'message': 'Player not in lobby'})
+                    return
+
+                key = None
+                if previous is not None:
+                    position = game_state['positions'][player_index]
+                    key = (game_state.get('version', 0), view_enemy_signature(
+                        game_state.get('enemies', []), previous[0], position['x'], position['y']))
+                if key is None or key != previous_key:
+                    try:
+                        visible_cells, metadata = compute_view(game_state, lobby_code, player_index)
+                    except ViewPoolUnavailable:
+                        # Overloaded: try again shortly with the then-current state
+                        yield ': busy\n\n'
+                        time.sleep(VIEW_RETRY_AFTER_SECONDS)
+                        continue
+                    position = game_state['positions'][player_index]
+                    center = (position['x'], position['y'])
+                    if previous is None:
+                        yield format_sse('view', {'visible_cells': visible_cells.to_dicts(), **metadata})
+                        held = (visible_cells.elevation, visible_cells.vegetation_height)
+                    else:
+                        delta, held = diff_views(previous, (visible_cells, metadata, center))
+                        yield format_sse('delta', delta)
+                    previous = (visible_cells, metadata, center, held)
+                    # Keyed against the visible cells of the view just sent
+                    previous_key = (game_state.get('version', 0), view_enemy_signature(
+                        game_state.get('enemies', []), visible_cells, *center))
+
+                # Wait for the next change, sending keep-alive comments meanwhile
+                message = None
+                while message is None:
+                    message = pubsub.get_message(timeout=VIEW_STREAM_KEEPALIVE_SECONDS)
+                    if message is None:
+                        yield ': keep-alive\n\n'
+                # Coalesce changes published while the view was being computed
+                while pubsub.get_message(timeout=0) is not None:
+                    pass
+        finally:
+            pubsub.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable proxy buffering
     response.set_cookie('session_id', session_id)
     return response
 
@@ -606,25 +3292,16 @@ def move():
 
     lobby_code = session_data['lobby_code']
 
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
     direction = data.get('direction')
     if not direction:
         return jsonify({'status': 'error', 'message': 'No direction provided'}), 400
 
     scale = data.get('scale', 1)
-    try:
-        scale = int(scale)
-    except (ValueError, TypeError):
-        scale = 1
-
-    game_state_json = redis_client.get(lobby_code)
-    if not game_state_json:
-        return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
-
-    game_state = json.loads(game_state_json)
-
-    position = game_state['position']
-    previous_positions = game_state.setdefault('previous_positions', [])
+    if isinstance(scale, bool) or not isinstance(scale, int) or not 1 <= scale <= MOVE_MAX_SCALE:
+        return jsonify({'status': 'error', 'message': 'Invalid scale'}), 400
 
     # Determine the movement direction
     dx, dy = 0, 0
@@ -639,31 +3316,153 @@ def move():
     else:
         return jsonify({'status': 'error', 'message': 'Invalid direction'}), 400
 
-    # Generate the new position(s) based on scale
-    new_positions = []
-    for step in range(1, scale + 1):
-        new_x = position['x'] + dx * step
-        new_y = position['y'] + dy * step
-        if is_river(new_x, new_y):
+    # Optimistic concurrency: the move is applied only if the player is still
+    # where the move was validated from, otherwise re-read and re-validate
+    player_index = session_data.get('player_index', 0)
+    for _ in range(MOVE_MAX_ATTEMPTS):
+        game_state = state_backend.load_lobby(lobby_code, ['positions'])
+        if game_state is None or player_index >= len(game_state.get('positions', [])):
+            return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
+        position = game_state['positions'][player_index]
+
+        if max(abs(position['x'] + dx * scale), abs(position['y'] + dy * scale)) > WORLD_COORDINATE_LIMIT:
+            return jsonify({'status': 'error', 'message': 'Destination out of bounds'}), 400
+        if river_geometry.crosses(position['x'], position['y'], dx, dy, scale):
             return jsonify({'status': 'error', 'message': 'Cannot move into the river!'}), 400
-        new_positions.append({'x': new_x, 'y': new_y})
+        # Generate the new position(s) based on scale; only the most recent
+        # steps are kept in the lobby's history
+        new_positions = [
+            {'x': position['x'] + dx * step, 'y': position['y'] + dy * step}
+            for step in range(max(scale - PREVIOUS_POSITIONS_LIMIT + 1, 1), scale + 1)
+        ]
+
+        version = state_backend.apply_move(lobby_code, player_index, position, new_positions)
+        if version == -1:
+            return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
+        if version:
+            break
+    else:
+        return jsonify({'status': 'error', 'message': 'Concurrent moves, please retry'}), 409
 
-    # Append the new positions to previous_positions
-    previous_positions.extend(new_positions)
+    response = jsonify({'status': 'success'})
+    response.set_cookie('session_id', session_id)
+    return response
 
-    # Update the current position to the final position
-    position['x'] += dx * scale
-    position['y'] += dy * scale
+@app.route('/intervisibility', methods=['POST'])
+def intervisibility_query():
+    """
+    Answers "can A see B" for a list of [viewer_x, viewer_y, target_x,
+    target_y] cell pairs with the viewshed's visibility model.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
+    terrain_type = data.get('terrain_type', TERRAIN_MOUNTAINS)
+    if terrain_type != TERRAIN_MOUNTAINS:  # The only terrain type
+        return jsonify({'status': 'error', 'message': 'Invalid terrain type'}), 400
 
-    # Limit the length of previous_positions to avoid too much data
-    if len(previous_positions) > 100:
-        previous_positions = previous_positions[-100:]
-        game_state['previous_positions'] = previous_positions
+    # Bounded like the lobby viewshed settings, as each sightline samples up to max range cells
+    try:
+        max_range = data.get('max_range', VIEWSHED_MAX_RANGE)
+        if max_range is not None:
+            max_range = int(max_range)
+    except (ValueError, TypeError, OverflowError):
+        return jsonify({'status': 'error', 'message': 'Invalid max range'}), 400
+    if max_range is not None and not 1 <= max_range <= VIEWSHED_RANGE_LIMIT:
+        return jsonify({'status': 'error', 'message': 'Invalid max range'}), 400
+
+    pairs = data.get('pairs')
+    if not isinstance(pairs, list):
+        return jsonify({'status': 'error', 'message': 'Invalid pairs'}), 400
+    if len(pairs) > INTERVISIBILITY_MAX_PAIRS:
+        return jsonify({'status': 'error', 'message': 'Too many pairs'}), 400
+    # Whole cell coordinates only: no bools, floats or strings
+    if not all(isinstance(pair, list) and len(pair) == 4
+               and all(isinstance(value, int) and not isinstance(value, bool)
+                       and abs(value) <= WORLD_COORDINATE_LIMIT for value in pair)
+               for pair in pairs):
+        return jsonify({'status': 'error', 'message': 'Invalid pairs'}), 400
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 4)
+
+    visible = intervisibility(pairs[:, 0], pairs[:, 1], pairs[:, 2], pairs[:, 3], terrain_type, max_range)
+    return jsonify({'status': 'success', 'visible': visible.tolist()})
+
+@app.route('/move_path', methods=['POST'])
+def move_path():
+    """
+    Walks the player through a list of waypoints, or to a single target, in
+    one state update. Waypoints are cell offsets from the player's position,
+    as in the view; the route between them is planned around the river and
+    steep or overgrown terrain.
+    """
+    session_id = get_session_id()
+    session_data = get_session_data(session_id)
+    if 'lobby_code' not in session_data:
+        return jsonify({'status': 'error', 'message': 'Not in a game'}), 400
+
+    lobby_code = session_data['lobby_code']
 
-    # Update game state in Redis
-    redis_client.set(lobby_code, json.dumps(game_state), ex=3600)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
+    waypoints = data.get('waypoints')
+    if waypoints is None and data.get('target') is not None:
+        waypoints = [data['target']]
+    if not isinstance(waypoints, list) or not all(isinstance(waypoint, dict) for waypoint in waypoints):
+        return jsonify({'status': 'error', 'message': 'Invalid waypoints'}), 400
+    try:
+        offsets = [(int(waypoint['x']), int(waypoint['y'])) for waypoint in waypoints]
+    except (KeyError, ValueError, TypeError, OverflowError):
+        return jsonify({'status': 'error', 'message': 'Invalid waypoints'}), 400
+    if not 0 < len(offsets) <= PATH_MAX_WAYPOINTS:
+        return jsonify({'status': 'error', 'message': 'Invalid number of waypoints'}), 400
+    # Farther than every leg together can reach
+    if any(abs(dx) + abs(dy) > PATH_MAX_WAYPOINTS * PATH_MAX_LEG_DISTANCE for dx, dy in offsets):
+        return jsonify({'status': 'error', 'message': 'Waypoint too far away'}), 400
+
+    waypoints = None
+    # Optimistic concurrency as in /move; the waypoints stay where they were
+    # first seen and the route is re-planned from the new position
+    player_index = session_data.get('player_index', 0)
+    for _ in range(MOVE_MAX_ATTEMPTS):
+        game_state = state_backend.load_lobby(lobby_code, ['positions', 'terrain_type'])
+        if game_state is None or player_index >= len(game_state.get('positions', [])):
+            return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
+        position = game_state['positions'][player_index]
+        terrain_type = game_state.get('terrain_type', TERRAIN_MOUNTAINS)
+        if waypoints is None:
+            waypoints = [(position['x'] + dx, position['y'] + dy) for dx, dy in offsets]
+            waypoint_xs, waypoint_ys = zip(*waypoints)
+            if max(map(abs, waypoint_xs + waypoint_ys)) > WORLD_COORDINATE_LIMIT:
+                return jsonify({'status': 'error', 'message': 'Destination out of bounds'}), 400
+            if river_geometry.is_water(waypoint_xs, waypoint_ys).any():
+                return jsonify({'status': 'error', 'message': 'Cannot move into the river!'}), 400
+
+        route = []
+        leg_start = (position['x'], position['y'])
+        for waypoint in waypoints:
+            if abs(waypoint[0] - leg_start[0]) + abs(waypoint[1] - leg_start[1]) > PATH_MAX_LEG_DISTANCE:
+                return jsonify({'status': 'error', 'message': 'Waypoint too far away'}), 400
+            leg = plan_route(terrain_type, *leg_start, *waypoint)
+            if leg is None:
+                return jsonify({'status': 'error', 'message': 'No route to waypoint'}), 400
+            route.extend(leg)
+            leg_start = waypoint
+        if not route:
+            # Every waypoint is the current position
+            break
+
+        # Only the most recent steps are kept in the lobby's history
+        new_positions = [{'x': x, 'y': y} for x, y in route[-PREVIOUS_POSITIONS_LIMIT:]]
+        version = state_backend.apply_move(lobby_code, player_index, position, new_positions)
+        if version == -1:
+            return jsonify({'status': 'error', 'message': 'Game state not found'}), 400
+        if version:
+            break
+    else:
+        return jsonify({'status': 'error', 'message': 'Concurrent moves, please retry'}), 409
 
-    response = jsonify({'status': 'success'})
+    response = jsonify({'status': 'success', 'steps': len(route)})
     response.set_cookie('session_id', session_id)
     return response
 
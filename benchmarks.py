@@ -0,0 +1,237 @@
+"""
+Microbenchmarks for the terrain, viewshed, sound and enemy hot paths.
+
+    python benchmarks.py                     # run and compare against the baseline
+    python benchmarks.py --save              # run and record a new baseline
+    python benchmarks.py -k viewshed         # only benchmarks whose name contains 'viewshed'
+    python benchmarks.py --save -k gradient  # re-record only the matching benchmarks
+
+Runs offline: the app is imported with the in-memory state backend and
+without the view worker pool. Each benchmark reports the best time per call
+over several repeats and the samples (terrain points or cells) it processes
+per second. Against the baseline, a benchmark more than --threshold slower
+is a regression and makes the run exit with status 1. Timings depend on the
+machine, so record the baseline on the machine that runs the comparison.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import platform
+import sys
+import time
+
+# glibc mallopt parameters
+M_TRIM_THRESHOLD = -1
+M_MMAP_THRESHOLD = -3
+
+def pin_allocator():
+    """
+    Keeps glibc from handing freed memory back to the OS. Otherwise large
+    temporary arrays are page-faulted in anew on some calls and not others,
+    and array-heavy benchmarks vary by more than half depending on what ran
+    before them.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.mallopt(M_TRIM_THRESHOLD, 1 << 30)
+        libc.mallopt(M_MMAP_THRESHOLD, 32 << 20)  # The largest value glibc accepts
+    except (OSError, AttributeError, TypeError):
+        pass  # Not glibc
+
+# Before numpy and the app allocate anything
+pin_allocator()
+
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('VIEW_POOL_WORKERS', '0')
+os.environ.setdefault('ENEMY_TICK_SECONDS', '0')
+
+import numpy as np
+
+import app
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DEFAULT_THRESHOLD = 0.25  # Fraction slower than the baseline that counts as a regression
+MIN_REPEAT_SECONDS = 0.2  # Each repeat runs the benchmark for at least this long
+REPEATS = 7
+
+VIEWPOINTS = {
+    'valley': (240, 45),  # Lowest land cell near the start
+    'river_bank': (0, 5),  # First land cell south of the river at the start column
+    'peak_100_100': (100, 100),
+    'peak_200_-200': (200, -200),
+}
+
+# Points compute_ambient_sounds samples: its river lattice (every 10 cells
+# within 50) and its vegetation lattice (every 5 cells within 100)
+SOUND_LATTICE_POINTS = len(range(-50, 51, 10)) ** 2 + len(range(-100, 101, 5)) ** 2
+
+def _grid(center, size, step=1):
+    offsets = np.arange(-(size // 2), size - size // 2) * step
+    xs, ys = np.meshgrid(center[0] + offsets, center[1] + offsets, indexing='ij')
+    return xs, ys
+
+def _enemies(center, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{'x': int(center[0] + dx), 'y': int(center[1] + dy), 'direction': float(direction)}
+            for dx, dy, direction in zip(rng.integers(-40, 41, count), rng.integers(-40, 41, count),
+                                         rng.uniform(0, 360, count))]
+
+def benchmarks():
+    """
+    Returns {name: (setup, run)}. setup() is called before every call and
+    is not timed; run() returns the number of samples it processed.
+    """
+    terrain_type = app.TERRAIN_MOUNTAINS
+    cases = {}
+    no_setup = lambda: None
+
+    xs, ys = _grid(VIEWPOINTS['valley'], 32)
+    scalar_points = list(zip(xs.ravel().tolist(), ys.ravel().tolist()))
+
+    def terrain_height():
+        for x, y in scalar_points:
+            app.terrain_height(x, y, terrain_type)
+        return len(scalar_points)
+    cases['terrain_height'] = (no_setup, terrain_height)
+
+    elevations = [app.terrain_height(x, y, terrain_type) for x, y in scalar_points]
+
+    def vegetation_height():
+        for (x, y), elevation in zip(scalar_points, elevations):
+            app.vegetation_height(x, y, elevation)
+        return len(scalar_points)
+    cases['vegetation_height'] = (no_setup, vegetation_height)
+
+    def terrain_gradient():
+        for x, y in scalar_points:
+            app.terrain_gradient(x, y, terrain_type)
+        return len(scalar_points)
+    cases['terrain_gradient'] = (no_setup, terrain_gradient)
+
+    def get_visibility_range():
+        # Looked up in the slope field, which the warm-up call fills
+        for x, y in scalar_points:
+            app.get_visibility_range(x, y, terrain_type)
+        return len(scalar_points)
+    cases['get_visibility_range'] = (no_setup, get_visibility_range)
+
+    grid_xs, grid_ys = _grid(VIEWPOINTS['valley'], 256)
+    grid_elevations = app.terrain_height_array(grid_xs, grid_ys, terrain_type)
+    cases['terrain_height_array'] = (
+        no_setup, lambda: app.terrain_height_array(grid_xs, grid_ys, terrain_type).size)
+    cases['vegetation_height_array'] = (
+        no_setup, lambda: app.vegetation_height_array(grid_xs, grid_ys, grid_elevations).size)
+    cases['terrain_gradient_array'] = (
+        no_setup, lambda: app.terrain_gradient_array(grid_xs, grid_ys, terrain_type)[0].size)
+
+    for name, (x, y) in VIEWPOINTS.items():
+        # Cold: every call casts the full viewshed; samples are the ray samples it keeps
+        cases[f'get_viewshed[{name}]'] = (
+            app.viewshed_cache.clear,
+            lambda x=x, y=y: len(app.get_viewshed(x, y, terrain_type)['distance'])
+        )
+
+        enemies = _enemies((x, y), 50)
+        rng = np.random.default_rng(0)
+
+        def compute_sounds(x=x, y=y, enemies=enemies, rng=rng):
+            app.compute_sounds(x, y, terrain_type, [], enemies, rng)
+            return SOUND_LATTICE_POINTS + len(enemies)
+        cases[f'compute_sounds[{name}]'] = (no_setup, compute_sounds)
+
+        visible_cells = app.get_viewshed(x, y, terrain_type)['cells']
+        overlay = app.EnemyOverlay(_enemies((x, y), 100))
+
+        def tag_enemies(x=x, y=y, visible_cells=visible_cells, overlay=overlay):
+            app.tag_enemies(visible_cells.copy(), overlay, x, y)
+            return len(overlay.enemies)
+        cases[f'tag_enemies[{name}]'] = (no_setup, tag_enemies)
+
+    directions = np.linspace(0, 360, 64, endpoint=False).tolist()
+
+    def clear_stencil_caches():
+        app._fov_cone.cache_clear()
+        app._hearing_disc.cache_clear()
+        app._enemy_stencils.cache_clear()
+
+    def compute_enemy_fov():
+        # Distinct headings, so every call computes its cone
+        return sum(len(app.compute_enemy_fov(0, 0, direction)) for direction in directions)
+    cases['compute_enemy_fov'] = (clear_stencil_caches, compute_enemy_fov)
+
+    return cases
+
+def measure(setup, run):
+    """Returns (best seconds per call, samples per call)."""
+    setup()
+    samples = run()  # Warm up
+    best = float('inf')
+    for _ in range(REPEATS):
+        calls = 0
+        elapsed = 0.0
+        while elapsed < MIN_REPEAT_SECONDS:
+            setup()
+            started = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - started
+            calls += 1
+        best = min(best, elapsed / calls)
+    return best, samples
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the hot-path microbenchmarks.')
+    parser.add_argument('-k', '--filter', default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file to compare against or save to')
+    parser.add_argument('--save', action='store_true', help='Record the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Fraction slower than the baseline that fails the run')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':40} {'per call':>12} {'samples/s':>12} {'baseline':>12} {'change':>8}")
+    for name, (setup, run) in benchmarks().items():
+        if args.filter not in name:
+            continue
+        seconds, samples = measure(setup, run)
+        results[name] = {'seconds_per_call': seconds, 'samples_per_call': samples,
+                         'samples_per_second': samples / seconds}
+
+        reference = baseline.get(name)
+        if reference and not args.save:
+            change = seconds / reference['seconds_per_call'] - 1
+            compared = f"{reference['seconds_per_call'] * 1e3:10.3f}ms {change:+8.1%}"
+            if change > args.threshold:
+                regressions.append(name)
+                compared += '  REGRESSION'
+        else:
+            compared = f"{'-':>12} {'-':>8}"
+        print(f'{name:40} {seconds * 1e3:10.3f}ms {samples / seconds:12.4g} {compared}')
+
+    if args.save:
+        # Benchmarks filtered out by -k keep their recorded results
+        if args.filter:
+            results = {**baseline, **results}
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'machine': platform.machine(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'benchmarks': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Saved baseline to {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regression(s) beyond {args.threshold:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,380 @@
+"""
+Load test of the full HTTP flow with simulated players.
+
+    python loadtest.py --players 200 --duration 60
+    python loadtest.py --players 40 --view-workers 2 --json results.json
+    python loadtest.py --url http://127.0.0.1:8000 --players 100
+
+Without --url, starts the app under gunicorn as the Procfile does (one
+gevent worker) with the in-memory state backend, so no Redis is needed. To
+test several gunicorn workers, run them against a local Redis and pass
+--url.
+
+Players are started evenly over --ramp seconds. The first player of each
+lobby creates it with /start_game, and the others /join_game it; every player
+then marks itself /ready. Each player then behaves like the game page:
+- polls /visible_cells every --poll-interval seconds, sending the ETag of
+  its last view and accepting the raster format
+- now and then sends a burst of /move requests in one direction, polling
+  its view after each move that succeeds
+
+Only the --duration seconds after the ramp are measured. The report shows
+latency percentiles, throughput and error rates per endpoint. It also shows
+the stage timings the server sent in Server-Timing headers, which a server
+given with --url only sends when it runs with SERVER_TIMING=1. When the driver
+started the server, it shows the CPU the server used per lobby as well.
+5xx responses and failed connections count as errors. 4xx responses, such
+as moves into the river, are reported separately.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+import gevent
+from gevent.event import AsyncResult
+import numpy as np
+
+COLUMNAR_MIMETYPE = 'application/vnd.behind-enemy-lines.columnar'
+RASTER_MIMETYPE = 'application/vnd.behind-enemy-lines.raster'
+REQUEST_TIMEOUT_SECONDS = 30
+SERVER_START_TIMEOUT_SECONDS = 60
+MOVE_DIRECTIONS = ('up', 'down', 'left', 'right')
+SETUP_ENDPOINTS = ('/start_game', '/join_game', '/ready')
+
+class Recorder:
+    """Collects the latency, status and server stage timings of each request."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)  # endpoint: seconds
+        self.statuses = defaultdict(Counter)  # endpoint: status (0 when the request failed)
+        self.stages = defaultdict(lambda: defaultdict(list))  # endpoint: stage: milliseconds
+        self.measuring = False
+
+    def record(self, endpoint, status, seconds, server_timing=None):
+        if not self.measuring and endpoint not in SETUP_ENDPOINTS:
+            return
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+        for stage, milliseconds in parse_server_timing(server_timing):
+            self.stages[endpoint][stage].append(milliseconds)
+
+def parse_server_timing(header):
+    """Yields (stage, milliseconds) for each entry of a Server-Timing header that has a duration."""
+    if not header:
+        return
+    for entry in header.split(','):
+        name, *params = entry.strip().split(';')
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                yield name, float(value)
+
+class Player:
+    """One simulated player: a keep-alive connection, a session cookie and the last view's ETag."""
+
+    def __init__(self, host, port, recorder, rng):
+        self.connection = http.client.HTTPConnection(host, port, timeout=REQUEST_TIMEOUT_SECONDS)
+        self.recorder = recorder
+        self.rng = rng
+        self.session_id = None
+        self.etag = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request and records it. Returns (status, response body), status 0 on failure."""
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.session_id:
+            headers['Cookie'] = f'session_id={self.session_id}'
+
+        started = time.perf_counter()
+        try:
+            self.connection.request(method, path, payload, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()  # Reconnects on the next request
+            self.recorder.record(path, 0, time.perf_counter() - started)
+            return 0, None
+        self.recorder.record(path, response.status, time.perf_counter() - started,
+                             response.getheader('Server-Timing'))
+
+        for set_cookie in response.headers.get_all('Set-Cookie') or []:
+            cookie = SimpleCookie(set_cookie)
+            if 'session_id' in cookie:
+                self.session_id = cookie['session_id'].value
+        if response.status == 200 and path == '/visible_cells':
+            self.etag = response.getheader('ETag')
+        return response.status, data
+
+    def poll_view(self):
+        headers = {'Accept': f'{RASTER_MIMETYPE}, {COLUMNAR_MIMETYPE};q=0.9, application/json;q=0.5', 'Accept-Encoding': 'gzip, br'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        self.request('GET', '/visible_cells', headers=headers)
+
+    def move_burst(self, moves, interval):
+        direction = self.rng.choice(MOVE_DIRECTIONS)
+        for _ in range(moves):
+            status, _ = self.request('POST', '/move', {'direction': direction, 'scale': 1})
+            if status == 200:
+                self.poll_view()  # As the game page does after a move
+            gevent.sleep(interval)
+
+def simulate_player(player, index, lobby, args, start_time, end_time):
+    """Joins or creates the player's lobby, then plays until end_time."""
+    gevent.sleep(max(start_time - time.time(), 0))
+    seat = index % args.lobby_size
+    if seat == 0:
+        status, data = player.request('POST', '/start_game',
+                                      {'player_name': f'Player{index}', 'num_enemies': args.enemies})
+        lobby.set(json.loads(data)['lobby_code'] if status == 200 else None)
+    else:
+        lobby_code = lobby.get()
+        if lobby_code is None:
+            return
+        player.request('POST', '/join_game', {'lobby_code': lobby_code, 'player_name': f'Player{index}'})
+    player.request('POST', '/ready', {'ready': True})
+
+    rng = player.rng
+    next_poll = time.time() + rng.uniform(0, args.poll_interval)
+    next_burst = time.time() + rng.expovariate(args.bursts_per_minute / 60) if args.bursts_per_minute else math.inf
+    while True:
+        now = time.time()
+        if now >= end_time:
+            return
+        if now >= next_burst:
+            player.move_burst(rng.randint(1, args.burst_moves), args.move_interval)
+            next_burst = time.time() + rng.expovariate(args.bursts_per_minute / 60)
+        elif now >= next_poll:
+            player.poll_view()
+            # Like setInterval: a slow poll delays the next one instead of queueing several
+            next_poll = max(next_poll + args.poll_interval, time.time())
+        gevent.sleep(max(min(next_poll, next_burst, end_time) - time.time(), 0))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(port, view_workers, log):
+    """Starts the app under gunicorn with the in-memory backend and waits until it answers."""
+    env = dict(os.environ)
+    env.setdefault('STATE_BACKEND', 'memory')
+    env.setdefault('SERVER_TIMING', '1')
+    if view_workers is not None:
+        env['VIEW_POOL_WORKERS'] = str(view_workers)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-k', 'gevent', '--worker-connections', '1000',
+         '-b', f'127.0.0.1:{port}', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.time() + SERVER_START_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if server.poll() is not None:
+            break
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except OSError:
+            gevent.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f'The server did not start; see {log.name}')
+
+def process_tree_cpu_seconds(root_pid):
+    """User plus system CPU seconds used so far by a process and its live descendants (Linux only)."""
+    children = defaultdict(list)
+    cpu = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # Exited meanwhile
+        pid = int(entry)
+        children[int(fields[1])].append(pid)
+        cpu[pid] = int(fields[11]) + int(fields[12])
+    ticks = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        ticks += cpu.get(pid, 0)
+        pending.extend(children[pid])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+def driver_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def summarize(recorder, seconds, setup_seconds):
+    """
+    Per-endpoint results: request counts, rates and latency percentiles in
+    milliseconds. Rates are over the ramp for the setup endpoints and over
+    the measured seconds for the others.
+    """
+    endpoints = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        statuses = recorder.statuses[endpoint]
+        requests = sum(statuses.values())
+        errors = sum(count for status, count in statuses.items() if status == 0 or status >= 500)
+        milliseconds = np.array(latencies) * 1e3
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        endpoints[endpoint] = {
+            'requests': requests,
+            'requests_per_second': requests / (setup_seconds if endpoint in SETUP_ENDPOINTS else seconds),
+            'not_modified': statuses[304],
+            'client_errors': sum(count for status, count in statuses.items() if 400 <= status < 500),
+            'errors': errors,
+            'error_rate': errors / requests,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+            'max_ms': float(milliseconds.max()),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        }
+    stages = {
+        endpoint: {stage: {'count': len(values), 'mean_ms': float(np.mean(values)),
+                           'p95_ms': float(np.percentile(values, 95))}
+                   for stage, values in sorted(stage_values.items())}
+        for endpoint, stage_values in sorted(recorder.stages.items())
+    }
+    return endpoints, stages
+
+def print_report(endpoints, stages, totals):
+    print(f"\n{'endpoint':16} {'requests':>9} {'req/s':>8} {'304':>6} {'4xx':>6} {'errors':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for endpoint, result in endpoints.items():
+        print(f"{endpoint:16} {result['requests']:9} {result['requests_per_second']:8.1f} "
+              f"{result['not_modified']:6} {result['client_errors']:6} {result['error_rate']:7.1%} "
+              f"{result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['p99_ms']:8.1f} {result['max_ms']:8.1f}")
+
+    for endpoint, result in endpoints.items():
+        if result['errors'] or result['client_errors']:
+            statuses = ', '.join(f"{'failed' if status == '0' else status}: {count}"
+                                 for status, count in result['statuses'].items())
+            print(f'{endpoint} statuses: {statuses}')
+
+    if stages:
+        print(f"\n{'server stage (Server-Timing)':40} {'count':>7} {'mean ms':>8} {'p95 ms':>8}")
+        for endpoint, endpoint_stages in stages.items():
+            for stage, result in endpoint_stages.items():
+                print(f"{endpoint + ' ' + stage:40} {result['count']:7} {result['mean_ms']:8.2f} {result['p95_ms']:8.2f}")
+
+    print(f"\n{totals['players']} players in {totals['lobbies']} lobbies for {totals['seconds']:.0f} s: "
+          f"{totals['requests_per_second']:.1f} req/s, {totals['error_rate']:.2%} errors")
+    if 'server_cores' in totals:
+        print(f"Server CPU: {totals['server_cores']:.2f} cores, "
+              f"{totals['server_cores_per_lobby']:.3f} cores per lobby")
+    print(f"Driver CPU: {totals['driver_cores']:.2f} cores")
+    if totals['driver_cores'] > 0.8:
+        print('Warning: the driver was near one full core, so latencies include its own queueing; '
+              'run fewer players per driver or several drivers')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the app with simulated players.')
+    parser.add_argument('--url', help='Server to test; by default one is started with the in-memory backend')
+    parser.add_argument('--view-workers', type=int,
+                        help='VIEW_POOL_WORKERS of the started server (default: the app default)')
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--lobby-size', type=int, default=4, help='Players per lobby')
+    parser.add_argument('--enemies', type=int, default=2, help='Enemies per lobby')
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds over which players join')
+    parser.add_argument('--duration', type=float, default=60, help='Measured seconds after the ramp')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between view polls')
+    parser.add_argument('--bursts-per-minute', type=float, default=6, help='Average move bursts per player')
+    parser.add_argument('--burst-moves', type=int, default=5, help='Most moves in one burst')
+    parser.add_argument('--move-interval', type=float, default=0.15, help='Seconds between moves of a burst')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    server = None
+    log = None
+    if args.url:
+        target = urlsplit(args.url)
+        host, port = target.hostname, target.port or 80
+    else:
+        host, port = '127.0.0.1', free_port()
+        log = tempfile.NamedTemporaryFile('w', prefix='loadtest-server-', suffix='.log', delete=False)
+        server = start_server(port, args.view_workers, log)
+
+    try:
+        recorder = Recorder()
+        lobbies = -(-args.players // args.lobby_size)
+        lobby_codes = [AsyncResult() for _ in range(lobbies)]
+        ramp_start = time.time() + 0.5
+        measure_start = ramp_start + args.ramp
+        end_time = measure_start + args.duration
+        players = [
+            gevent.spawn(simulate_player, Player(host, port, recorder, random.Random(args.seed * 1000003 + index)),
+                         index, lobby_codes[index // args.lobby_size], args,
+                         ramp_start + args.ramp * index / args.players, end_time)
+            for index in range(args.players)
+        ]
+        print(f'{args.players} players in {lobbies} lobbies against {host}:{port}; '
+              f'ramping up for {args.ramp:.0f} s, then measuring for {args.duration:.0f} s')
+
+        gevent.sleep(max(measure_start - time.time(), 0))
+        recorder.measuring = True
+        driver_cpu = driver_cpu_seconds()
+        server_cpu = process_tree_cpu_seconds(server.pid) if server and os.path.isdir('/proc') else None
+        gevent.sleep(max(end_time - time.time(), 0))
+        recorder.measuring = False
+        driver_cpu = driver_cpu_seconds() - driver_cpu
+        if server_cpu is not None:
+            server_cpu = process_tree_cpu_seconds(server.pid) - server_cpu
+        gevent.joinall(players, timeout=REQUEST_TIMEOUT_SECONDS)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            log.close()
+
+    endpoints, stages = summarize(recorder, args.duration, max(args.ramp, 1))
+    measured = {endpoint: result for endpoint, result in endpoints.items() if endpoint not in SETUP_ENDPOINTS}
+    requests = sum(result['requests'] for result in measured.values())
+    errors = sum(result['errors'] for result in measured.values())
+    totals = {
+        'players': args.players,
+        'lobbies': lobbies,
+        'seconds': args.duration,
+        'requests_per_second': requests / args.duration,
+        'error_rate': errors / requests if requests else 0.0,
+        'driver_cores': driver_cpu / args.duration,
+    }
+    if server_cpu is not None:
+        totals['server_cores'] = server_cpu / args.duration
+        totals['server_cores_per_lobby'] = totals['server_cores'] / lobbies
+    print_report(endpoints, stages, totals)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'totals': totals, 'endpoints': endpoints, 'stages': stages},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 1 if totals['error_rate'] > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
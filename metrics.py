@@ -0,0 +1,128 @@
+"""
+Minimal in-process metrics in the Prometheus text exposition format.
+
+Counters and histograms are updated on the request path, so updates only
+take a lock and bump a few numbers. Values that other objects already keep
+(cache and pool statistics) are read when the metrics are rendered, through
+collector functions. Metrics are per process: with several gunicorn workers,
+each worker serves its own.
+"""
+import bisect
+import math
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    """Monotonic count, optionally split by label values."""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        return [(self.name, tuple(zip(self.labels, label_values)), value) for label_values, value in values]
+
+class Histogram:
+    """Distribution of observed values over fixed upper bounds, optionally split by label values."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self._series = {}  # label values: [count per bucket plus overflow, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = sorted((label_values, (list(counts), total))
+                            for label_values, (counts, total) in self._series.items())
+        samples = []
+        for label_values, (counts, total) in series:
+            labels = tuple(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + (('le', _format_value(float(bound))),), cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+class Registry:
+    """
+    Holds the process's metrics. Collectors are functions called at render
+    time that return (name, kind, documentation, [(labels, value), ...])
+    families, where labels is a dict.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS, labels=()):
+        metric = Histogram(name, documentation, buckets, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Registers fn as a collector. Usable as a decorator."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        families = [(metric.name, metric.kind, metric.documentation, metric.samples()) for metric in self._metrics]
+        for collect in self._collectors:
+            for name, kind, documentation, values in collect():
+                families.append((name, kind, documentation,
+                                 [(name, tuple(sorted(labels.items())), value) for labels, value in values]))
+
+        lines = []
+        for name, kind, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,109 @@
+"""
+Closed-form geometry of the river.
+
+The river is a band of cells around a sinusoidal centerline: the cell (x, y)
+is water when |y - trunc(amplitude * sin(frequency * x))| < width // 2. Each
+column of the map therefore holds one run of water cells, so whether a move
+crosses the river, how far a point is from it and where the land is can be
+answered from the centerline instead of testing cells one by one.
+"""
+import math
+import numpy as np
+
+class RiverGeometry:
+    """
+    Answers river queries for a centerline y = amplitude * sin(frequency * x)
+    and a band of width cells. is_water matches app.is_river cell for cell.
+    """
+
+    def __init__(self, width, amplitude, frequency):
+        self.width = width
+        self.amplitude = amplitude
+        self.frequency = frequency
+        # Water cells lie within half_width cells of the centerline's cell
+        self.half_width = width // 2 - 1
+        # No water cell lies further than this from y = 0
+        self.reach = int(amplitude) + self.half_width
+        # Where the centerline moves at most one cell per column, it takes
+        # every cell value between its extremes in any window of a full
+        # period, so a row meets the river within a period or never does
+        self.period_cells = (math.ceil(2 * math.pi / frequency) + 1
+                             if amplitude * frequency <= 1 else None)
+
+    def centerline(self, xs):
+        """Cell row of the centerline in each column of xs."""
+        return np.trunc(self.amplitude * np.sin(self.frequency * np.asarray(xs)))
+
+    def water_rows(self, x):
+        """First and last water row of column x."""
+        central_y = int(self.amplitude * math.sin(self.frequency * x))
+        return central_y - self.half_width, central_y + self.half_width
+
+    def is_water(self, xs, ys):
+        """Whether each cell of xs, ys is water."""
+        return np.abs(np.asarray(ys) - self.centerline(xs)) <= self.half_width
+
+    def signed_distance(self, xs, ys):
+        """
+        Distance in cells from each cell to the river bank, negative inside
+        the river; the sign matches is_water. The vertical offset from the
+        centerline's cell to the bank, half a cell beyond the last water row,
+        is scaled by the centerline's slope: exact where the river runs
+        straight and a close approximation along the meanders.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        offset = np.abs(ys - self.centerline(xs)) - (self.half_width + 0.5)
+        slope = self.amplitude * self.frequency * np.cos(self.frequency * xs)
+        return offset / np.sqrt(1 + slope * slope)
+
+    def crosses(self, x, y, dx, dy, steps):
+        """
+        Whether walking steps cells from (x, y) along (dx, dy), each -1, 0 or
+        1, enters the river. The start cell is not checked.
+        """
+        if steps < 1:
+            return False
+        if dx == 0:
+            first, last = sorted((y + dy, y + dy * steps))
+            water_first, water_last = self.water_rows(x)
+            return first <= water_last and water_first <= last
+        if dy == 0:
+            if abs(y) > self.reach:
+                return False
+            if self.period_cells is not None:
+                steps = min(steps, self.period_cells)
+            walked = np.arange(1, steps + 1)
+        else:
+            # Only the steps whose row is within reach of the river can hit it
+            first, last = sorted(((-self.reach - y) * dy, (self.reach - y) * dy))
+            walked = np.arange(max(first, 1), min(last, steps) + 1)
+        return bool(self.is_water(x + dx * walked, y + dy * walked).any())
+
+    def first_land(self, x, y, step):
+        """First cell of y, y + step, y + 2 * step, ... in column x that is land."""
+        water_first, water_last = self.water_rows(x)
+        if not water_first <= y <= water_last:
+            return y
+        if step > 0:
+            return y + step * ((water_last - y) // step + 1)
+        return y + step * ((y - water_first) // -step + 1)
+
+    def sample_land(self, rng, count, x_min, x_max, y_min, y_max):
+        """
+        Draws count land cells uniformly from the rectangle [x_min, x_max] x
+        [y_min, y_max] using the NumPy generator rng. Returns arrays xs, ys.
+        """
+        columns = np.arange(x_min, x_max + 1)
+        water_first = np.maximum(self.centerline(columns).astype(np.int64) - self.half_width, y_min)
+        water_last = np.minimum(self.centerline(columns).astype(np.int64) + self.half_width, y_max)
+        water_cells = np.maximum(water_last - water_first + 1, 0)
+        land_cells = (y_max - y_min + 1) - water_cells
+        if land_cells.sum() == 0:
+            raise ValueError('The rectangle has no land cells')
+
+        picked = rng.choice(columns.size, size=count, p=land_cells / land_cells.sum())
+        # Index into the column's land rows, then skip over its water run
+        ys = y_min + (rng.random(count) * land_cells[picked]).astype(np.int64)
+        ys = np.where((water_cells[picked] > 0) & (ys >= water_first[picked]), ys + water_cells[picked], ys)
+        return columns[picked], ys
@@ -0,0 +1,217 @@
+"""
+Bakes the procedural terrain into a file that the app memory-maps at startup.
+
+    python terrain_creator.py terrain.bin --x0 -512 --y0 -512 --width 1024 --height 1024
+
+then run the app with TERRAIN_BAKED_PATH=terrain.bin. Every worker maps the
+same read-only file, so they share one page-cache copy of the world's cells
+instead of each computing terrain tiles on demand.
+
+File layout: an 8-byte magic, a little-endian uint32 header length and a JSON
+header, followed by page-aligned raw arrays described in the header:
+
+- 'terrain': (width, height) array of the app's TERRAIN_TILE_DTYPE
+  (elevation, vegetation_height, water), indexed [x - x0, y - y0].
+- 'max_elevation_<level>': max-elevation pyramid. Level 0 holds, for each
+  block of mip_block x mip_block cells, the highest terrain-plus-vegetation
+  surface in the block; each further level halves the resolution, down to
+  a single block covering the whole world.
+
+The arrays are stored uncompressed so they can be mapped directly.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+
+BAKED_TERRAIN_MAGIC = b'BELTERR1'
+BAKED_TERRAIN_VERSION = 1
+BAKED_TERRAIN_ALIGNMENT = 4096  # Arrays start on page boundaries
+_HEADER_LENGTH = struct.Struct('<I')
+
+DEFAULT_MIP_BLOCK = 8  # Cells per side of a level 0 max-elevation block
+BAKE_CHUNK_SIZE = 256  # Cells per side evaluated per batch while baking
+
+def _align(offset):
+    return -(-offset // BAKED_TERRAIN_ALIGNMENT) * BAKED_TERRAIN_ALIGNMENT
+
+def _mip_shapes(width, height, mip_block):
+    shape = (-(-width // mip_block), -(-height // mip_block))
+    shapes = [shape]
+    while shape != (1, 1):
+        shape = (-(-shape[0] // 2), -(-shape[1] // 2))
+        shapes.append(shape)
+    return shapes
+
+def _downsample_max(level):
+    """Halves a max-elevation level by taking the maximum of each 2x2 block."""
+    width, height = level.shape
+    padded = np.full((width + width % 2, height + height % 2), -np.inf)
+    padded[:width, :height] = level
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+
+class BakedTerrain:
+    """
+    Read-only, memory-mapped view of a baked terrain file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic = f.read(len(BAKED_TERRAIN_MAGIC))
+            if magic != BAKED_TERRAIN_MAGIC:
+                raise ValueError(f'{path} is not a baked terrain file')
+            header_length, = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))
+            header = json.loads(f.read(header_length))
+        if header['version'] != BAKED_TERRAIN_VERSION:
+            raise ValueError(f"{path} has unsupported version {header['version']}")
+
+        self.terrain_type = header['terrain_type']
+        self.x0 = header['x0']
+        self.y0 = header['y0']
+        self.width = header['width']
+        self.height = header['height']
+        self.mip_block = header['mip_block']
+        arrays = {
+            name: np.memmap(
+                path, mode='r', offset=spec['offset'], shape=tuple(spec['shape']),
+                dtype=np.lib.format.descr_to_dtype(spec['dtype'])
+            )
+            for name, spec in header['arrays'].items()
+        }
+        # Plain ndarray views of the mapping index faster than np.memmap
+        self.terrain = arrays['terrain'].view(np.ndarray)
+        self.max_elevation = [
+            arrays[f'max_elevation_{level}'].view(np.ndarray) for level in range(header['mip_levels'])
+        ]
+
+    def tile(self, tile_x, tile_y, tile_size):
+        """
+        Returns a view of the tile in the app's tile layout, or None if the
+        baked extent does not cover the whole tile.
+        """
+        x = tile_x * tile_size - self.x0
+        y = tile_y * tile_size - self.y0
+        if x < 0 or y < 0 or x + tile_size > self.width or y + tile_size > self.height:
+            return None
+        return self.terrain[x:x + tile_size, y:y + tile_size]
+
+def bake_terrain(path, terrain_type, x0, y0, width, height, mip_block=DEFAULT_MIP_BLOCK, progress=None):
+    """
+    Samples the terrain over the given extent and writes a baked terrain file.
+    The file is written next to path and renamed into place when complete.
+    """
+    import app  # The terrain functions live in the app module
+
+    if width < 2 or height < 2:
+        raise ValueError('The baked extent must be at least 2 x 2 cells')
+
+    mip_shapes = _mip_shapes(width, height, mip_block)
+    shapes = {'terrain': ((width, height), app.TERRAIN_TILE_DTYPE)}
+    for level, shape in enumerate(mip_shapes):
+        shapes[f'max_elevation_{level}'] = (shape, np.dtype('<f8'))
+
+    # Array offsets are relative to the data start until the header size is known
+    arrays = {}
+    offset = 0
+    for name, (shape, dtype) in shapes.items():
+        arrays[name] = {'dtype': np.lib.format.dtype_to_descr(dtype), 'shape': list(shape), 'offset': offset}
+        offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+    header = {
+        'version': BAKED_TERRAIN_VERSION,
+        'terrain_type': terrain_type,
+        'x0': x0,
+        'y0': y0,
+        'width': width,
+        'height': height,
+        'mip_block': mip_block,
+        'mip_levels': len(mip_shapes),
+        'arrays': arrays,
+    }
+    # Leave room for the digits the absolute offsets add to the header
+    data_start = _align(len(BAKED_TERRAIN_MAGIC) + _HEADER_LENGTH.size + len(json.dumps(header)) + 32 * len(arrays))
+    for spec in arrays.values():
+        spec['offset'] += data_start
+    header_bytes = json.dumps(header).encode()
+    total_size = data_start + offset
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(BAKED_TERRAIN_MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header_bytes)))
+            f.write(header_bytes)
+            f.truncate(total_size)
+
+        def mapped(name):
+            spec = arrays[name]
+            return np.memmap(tmp_path, mode='r+', offset=spec['offset'], shape=tuple(spec['shape']),
+                             dtype=np.lib.format.descr_to_dtype(spec['dtype']))
+
+        terrain = mapped('terrain')
+        # Chunks are multiples of mip_block so each block is reduced in one pass
+        chunk = max(BAKE_CHUNK_SIZE // mip_block, 1) * mip_block
+        level0 = np.full(mip_shapes[0], -np.inf)
+        chunks_total = -(-width // chunk) * -(-height // chunk)
+        chunks_done = 0
+        for cx in range(0, width, chunk):
+            for cy in range(0, height, chunk):
+                xs, ys = np.meshgrid(np.arange(x0 + cx, x0 + min(cx + chunk, width)),
+                                     np.arange(y0 + cy, y0 + min(cy + chunk, height)), indexing='ij')
+                block = terrain[cx:cx + xs.shape[0], cy:cy + xs.shape[1]]
+                block['elevation'] = app.terrain_height_array(xs, ys, terrain_type)
+                block['vegetation_height'] = app.vegetation_height_array(xs, ys, block['elevation'])
+                block['water'] = app.is_river_array(xs, ys)
+
+                surface = block['elevation'] + block['vegetation_height']
+                bw = -(-surface.shape[0] // mip_block)
+                bh = -(-surface.shape[1] // mip_block)
+                padded = np.full((bw * mip_block, bh * mip_block), -np.inf)
+                padded[:surface.shape[0], :surface.shape[1]] = surface
+                level0[cx // mip_block:cx // mip_block + bw, cy // mip_block:cy // mip_block + bh] = \
+                    padded.reshape(bw, mip_block, bh, mip_block).max(axis=(1, 3))
+
+                chunks_done += 1
+                if progress:
+                    progress(chunks_done, chunks_total)
+        terrain.flush()
+
+        level = level0
+        for index in range(len(mip_shapes)):
+            if index:
+                level = _downsample_max(level)
+            mip = mapped(f'max_elevation_{index}')
+            mip[:] = level
+            mip.flush()
+        del terrain, mip
+        os.chmod(tmp_path, 0o644)  # mkstemp creates files readable by the owner only
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bake the procedural terrain into a memory-mappable file.')
+    parser.add_argument('output', help='Path of the baked terrain file to write')
+    parser.add_argument('--terrain-type', default='mountains')
+    parser.add_argument('--x0', type=int, default=-512, help='West edge of the baked extent, in cells')
+    parser.add_argument('--y0', type=int, default=-512, help='North edge of the baked extent, in cells')
+    parser.add_argument('--width', type=int, default=1024, help='Cells baked along x')
+    parser.add_argument('--height', type=int, default=1024, help='Cells baked along y')
+    parser.add_argument('--mip-block', type=int, default=DEFAULT_MIP_BLOCK,
+                        help='Cells per side of a level 0 max-elevation block')
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f'\rBaking {done}/{total} chunks', end='', file=sys.stderr, flush=True)
+
+    bake_terrain(args.output, args.terrain_type, args.x0, args.y0, args.width, args.height,
+                 args.mip_block, progress)
+    print(f'\nWrote {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
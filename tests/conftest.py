@@ -0,0 +1,10 @@
+import os
+import sys
+
+# app reads its configuration at import time: keep the tests off Redis, the
+# view worker pool and the enemy tick thread
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('VIEW_POOL_WORKERS', '0')
+os.environ.setdefault('ENEMY_TICK_SECONDS', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,107 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+import app
+
+
+def decode_columnar(body):
+    """Reads the columnar format the way the game page does."""
+    magic, version, _, _, count, elevation_offset, elevation_step, vegetation_step, metadata_length = \
+        app.COLUMNAR_HEADER.unpack_from(body)
+    assert (magic, version) == (app.COLUMNAR_MAGIC, app.COLUMNAR_VERSION)
+    offset = app.COLUMNAR_HEADER.size
+    columns = {}
+    for name, dtype in (('x', '<i2'), ('y', '<i2'), ('elevation', '<u2'), ('vegetation', 'u1'), ('flags', 'u1')):
+        columns[name] = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+        offset += columns[name].nbytes
+    assert len(body) == offset + metadata_length
+    flags = columns['flags']
+    return {
+        'x': columns['x'],
+        'y': columns['y'],
+        'elevation': elevation_offset + columns['elevation'] * elevation_step,
+        'vegetation_height': columns['vegetation'] * vegetation_step,
+        'water': (flags & 1).astype(bool),
+        'enemy': (flags & 2).astype(bool),
+        'enemy_fov': (flags & 4).astype(bool),
+        'enemy_hearing': (flags & 8).astype(bool),
+        'river_level': (flags >> 4) & 3,
+        'elevation_step': elevation_step,
+        'vegetation_step': vegetation_step,
+        'metadata': json.loads(body[offset:]),
+    }
+
+
+@pytest.fixture(scope='module')
+def view():
+    # An enemy within sight and earshot of the viewer, and another out of view
+    game_state = {
+        'version': 1,
+        'positions': [{'x': 0, 'y': 15}],
+        'previous_positions': [[{'x': 0, 'y': 13}, {'x': 0, 'y': 14}]],
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': [{'x': 5, 'y': 20, 'direction': 90}, {'x': -30, 'y': 40, 'direction': 0}],
+        'enemy_tick': 0,
+    }
+    visible_cells, metadata = app.build_view(game_state, 'wire', 0)
+    assert visible_cells.enemy.any() and visible_cells.water.any()
+    return visible_cells, metadata
+
+
+def test_columnar_round_trip(view):
+    visible_cells, metadata = view
+    decoded = decode_columnar(app.encode_columnar_view(visible_cells, metadata))
+
+    assert decoded['metadata'] == metadata
+    np.testing.assert_array_equal(decoded['x'], visible_cells.x)
+    np.testing.assert_array_equal(decoded['y'], visible_cells.y)
+    for name in ('water', 'enemy', 'enemy_fov', 'enemy_hearing', 'river_level'):
+        np.testing.assert_array_equal(decoded[name], getattr(visible_cells, name), err_msg=name)
+    # Quantized to within half a step
+    assert np.abs(decoded['elevation'] - visible_cells.elevation).max() <= decoded['elevation_step'] / 2 + 1e-3
+    # Sparse vegetation is rounded up to a whole step
+    assert np.abs(decoded['vegetation_height'] - visible_cells.vegetation_height).max() <= \
+        decoded['vegetation_step'] + 1e-6
+
+
+def test_columnar_empty_view():
+    empty = np.zeros(0)
+    visible_cells = app.VisibleCells(0, np.full((1, 1), -1, dtype=np.int32), empty.astype(np.int64),
+                                     empty.astype(np.int64), empty, empty, empty.astype(bool), empty.astype(np.int64))
+    decoded = decode_columnar(app.encode_columnar_view(visible_cells, {'sounds': []}))
+    assert decoded['x'].size == 0
+    assert decoded['metadata'] == {'sounds': []}
+
+
+def test_quantize_keeps_sparse_vegetation():
+    _, _, vegetation_step, _, quantized = app._quantize_view(np.array([100.0, 200.0]), np.array([0.0, 1e-3]))
+    assert 1e-3 < vegetation_step / 2
+    assert quantized.tolist() == [0, 1]
+
+
+def test_columnar_negotiation():
+    client = app.app.test_client()
+    client.post('/start_game', json={})
+    cells = client.get('/visible_cells').get_json()['visible_cells']
+
+    accept = f'{app.COLUMNAR_MIMETYPE}, application/json;q=0.5'
+    for response in (client.get('/visible_cells', headers={'Accept': accept}),
+                     client.get('/visible_cells?format=columnar')):
+        assert response.mimetype == app.COLUMNAR_MIMETYPE
+        decoded = decode_columnar(response.get_data())
+        assert sorted(zip(decoded['x'].tolist(), decoded['y'].tolist())) == \
+            sorted((cell['x'], cell['y']) for cell in cells)
+    assert client.get('/visible_cells', headers={'Accept': 'application/json'}).mimetype == 'application/json'
+
+
+def test_columnar_compression():
+    client = app.app.test_client()
+    client.post('/start_game', json={})
+    plain = client.get('/visible_cells?format=columnar')
+    compressed = client.get('/visible_cells?format=columnar', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
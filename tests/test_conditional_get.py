@@ -0,0 +1,61 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def lobby():
+    client = app.app.test_client()
+    lobby_code = client.post('/start_game', json={'num_enemies': 0}).get_json()['lobby_code']
+    return client, lobby_code
+
+
+def set_enemies(lobby_code, enemies):
+    enemy_tick = app.state_backend.load_lobby(lobby_code, ['enemy_tick'])['enemy_tick']
+    app.state_backend.save_enemies({lobby_code: (enemy_tick, enemies)})
+
+
+def position(lobby_code):
+    return app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+
+
+def test_unchanged_view_is_not_modified(lobby):
+    client, _ = lobby
+    response = client.get('/visible_cells')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    response = client.get('/visible_cells', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+
+    # Each format is its own representation
+    response = client.get('/visible_cells?format=columnar', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_move_changes_etag(lobby):
+    client, _ = lobby
+    etag = client.get('/visible_cells').headers['ETag']
+    assert client.post('/move', json={'direction': 'down'}).status_code == 200
+    response = client.get('/visible_cells', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_enemy_tick_changes_etag_only_within_reach(lobby):
+    client, lobby_code = lobby
+    etag = client.get('/visible_cells').headers['ETag']
+    player = position(lobby_code)
+
+    # An enemy far out of sight and earshot leaves the view as it was
+    set_enemies(lobby_code, [{'x': player['x'] + 500, 'y': player['y'] + 500, 'direction': 0}])
+    assert client.get('/visible_cells', headers={'If-None-Match': etag}).status_code == 304
+
+    set_enemies(lobby_code, [{'x': player['x'] + 1, 'y': player['y'], 'direction': 0}])
+    response = client.get('/visible_cells', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import app
+
+
+def reference_tags(visible_cells, enemies, center_x, center_y):
+    """
+    The original tagging: for each visible enemy, every visible cell is
+    checked against its field of vision, and failing that its hearing range.
+    Returns {(x, y): set of flags} for the flagged cells.
+    """
+    visible_positions = set(zip(visible_cells.x.tolist(), visible_cells.y.tolist()))
+    tags = {}
+    for enemy in enemies:
+        enemy_x, enemy_y = enemy['x'], enemy['y']
+        if (enemy_x - center_x, enemy_y - center_y) not in visible_positions:
+            continue
+        tags.setdefault((enemy_x - center_x, enemy_y - center_y), set()).add('enemy')
+        fov_cells = app.compute_enemy_fov(enemy_x, enemy_y, enemy['direction'])
+        hearing_cells = app.compute_enemy_hearing(enemy_x, enemy_y)
+        for x, y in visible_positions:
+            offset = (x + center_x - enemy_x, y + center_y - enemy_y)
+            if offset in fov_cells:
+                tags.setdefault((x, y), set()).add('enemy_fov')
+            elif offset in hearing_cells:
+                tags.setdefault((x, y), set()).add('enemy_hearing')
+    return tags
+
+
+def stencil_tags(visible_cells, enemies, center_x, center_y):
+    visible_cells = visible_cells.copy()
+    app.tag_enemies(visible_cells, app.EnemyOverlay(enemies), center_x, center_y)
+    tags = {}
+    for name in ('enemy', 'enemy_fov', 'enemy_hearing'):
+        for position in np.flatnonzero(getattr(visible_cells, name)).tolist():
+            tags.setdefault((int(visible_cells.x[position]), int(visible_cells.y[position])), set()).add(name)
+    return tags
+
+
+@pytest.mark.parametrize('center', [(0, 15), (240, 45), (100, 100)])
+def test_stencil_tagging_matches_reference(center):
+    visible_cells = app.get_viewshed(*center, app.TERRAIN_MOUNTAINS)['cells']
+    rng = np.random.default_rng(sum(center))
+    # Enemies on visible cells, including two on one cell, plus some out of view
+    picks = rng.choice(len(visible_cells), 12).tolist()
+    picks.append(picks[0])
+    enemies = [{'x': int(visible_cells.x[pick]) + center[0], 'y': int(visible_cells.y[pick]) + center[1],
+                'direction': float(rng.uniform(0, 360))} for pick in picks]
+    enemies += [{'x': center[0] + 400, 'y': center[1] - 400, 'direction': 0.0}]
+
+    expected = reference_tags(visible_cells, enemies, *center)
+    assert any('enemy_hearing' in flags for flags in expected.values())
+    assert stencil_tags(visible_cells, enemies, *center) == expected
+
+
+def test_stencils_match_fov_and_hearing():
+    for direction in (0, 37.5, 90, 181, 359.9):
+        fov_cells, hearing_cells = app.enemy_stencils(direction)
+        fov = app.compute_enemy_fov(0, 0, direction)
+        assert set(map(tuple, fov_cells.tolist())) == fov
+        assert set(map(tuple, hearing_cells.tolist())) == app.compute_enemy_hearing(0, 0) - fov
+
+
+def test_no_visible_enemies_leaves_cells_untagged():
+    visible_cells = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)['cells']
+    assert stencil_tags(visible_cells, [], 0, 15) == {}
+    assert stencil_tags(visible_cells, [{'x': 500, 'y': 500, 'direction': 0.0}], 0, 15) == {}
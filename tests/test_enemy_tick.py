@@ -0,0 +1,102 @@
+import pytest
+
+import app
+
+
+def new_game_state(enemies, position=None):
+    return {
+        'version': 1,
+        'positions': [position or {'x': 0, 'y': 15}],
+        'previous_positions': [[]],
+        'max_players': 2,
+        'player_names': ['alice'],
+        'ready_statuses': [False],
+        'game_started': True,
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': enemies,
+        'enemy_tick': 0,
+    }
+
+
+@pytest.fixture
+def backend():
+    return app.MemoryStateBackend()
+
+
+# Enemy tick
+
+def test_tick_moves_enemies_without_bumping_version(backend):
+    enemies = [{'x': 10 * index, 'y': 40, 'direction': 90.0} for index in range(20)]
+    backend.create_lobby('abc', new_game_state(enemies))
+    backend.create_lobby('def', new_game_state(enemies[:3], {'x': 200, 'y': -200}))
+    engine = app.EnemyTickEngine(backend, interval=1, seed=0)
+
+    engine.tick()
+    for lobby_code, count in (('abc', 20), ('def', 3)):
+        game_state = backend.load_lobby(lobby_code)
+        assert game_state['enemy_tick'] == 1
+        assert game_state['version'] == 1
+        assert len(game_state['enemies']) == count
+        assert game_state['enemies'] != enemies[:count]
+        assert all(enemy.keys() >= {'x', 'y', 'direction'} for enemy in game_state['enemies'])
+    assert engine.stats()['ticks'] == 1
+    assert engine.stats()['last_tick_lobbies'] == 2
+    assert engine.stats()['last_tick_enemies'] == 23
+
+
+def test_tick_skips_lobbies_whose_enemies_stand_still(backend, monkeypatch):
+    enemy = {'x': 5, 'y': 20, 'direction': 0.0, 'home_x': 5, 'home_y': 20, 'alert': 0}
+    backend.create_lobby('abc', new_game_state([enemy]))
+    backend.create_lobby('none', new_game_state([]))
+    monkeypatch.setattr(app, 'step_enemies', lambda enemies, *args: enemies)
+    subscription = backend.subscribe(app.lobby_events_channel('abc'))
+
+    app.EnemyTickEngine(backend, interval=1).tick()
+    assert backend.load_lobby('abc', ['enemy_tick'])['enemy_tick'] == 0
+    assert backend.load_lobby('none', ['enemy_tick'])['enemy_tick'] == 0
+    assert subscription.get_message(timeout=0) is None
+    subscription.close()
+
+
+def test_tick_prunes_expired_lobbies(backend):
+    backend.create_lobby('abc', new_game_state([{'x': 5, 'y': 20, 'direction': 0.0}]))
+    backend._entries.pop('abc')
+    app.EnemyTickEngine(backend, interval=1).tick()
+    assert backend.active_lobbies() == []
+
+
+# Compare-and-set moves
+
+@pytest.fixture
+def client():
+    client = app.app.test_client()
+    lobby_code = client.post('/start_game', json={'num_enemies': 0}).get_json()['lobby_code']
+    return client, lobby_code
+
+
+def test_move_retries_after_concurrent_move(client, monkeypatch):
+    client, lobby_code = client
+    start = app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+    apply_move = app.state_backend.apply_move
+    attempts = []
+
+    def racing_apply_move(lobby_code, player_index, expected_position, new_positions):
+        if not attempts:
+            # Another request moves the player between the read and the write
+            apply_move(lobby_code, player_index, start, [{'x': start['x'] + 1, 'y': start['y']}])
+        attempts.append(expected_position)
+        return apply_move(lobby_code, player_index, expected_position, new_positions)
+    monkeypatch.setattr(app.state_backend, 'apply_move', racing_apply_move)
+
+    assert client.post('/move', json={'direction': 'down'}).status_code == 200
+    assert attempts == [start, {'x': start['x'] + 1, 'y': start['y']}]
+    position = app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+    assert position == {'x': start['x'] + 1, 'y': start['y'] + 1}
+
+
+def test_move_gives_up_after_repeated_conflicts(client, monkeypatch):
+    client, lobby_code = client
+    calls = []
+    monkeypatch.setattr(app.state_backend, 'apply_move', lambda *args: calls.append(args) or 0)
+    assert client.post('/move', json={'direction': 'down'}).status_code == 409
+    assert len(calls) == app.MOVE_MAX_ATTEMPTS
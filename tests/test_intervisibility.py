@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+import pytest
+
+import app
+
+
+def reference_visible(viewer_x, viewer_y, target_x, target_y, max_range=None):
+    """One sightline at a time: a sample per whole cell of distance, then the target."""
+    terrain_type = app.TERRAIN_MOUNTAINS
+    viewer_terrain_elevation = app.terrain_height(viewer_x, viewer_y, terrain_type)
+    viewer_elevation = (viewer_terrain_elevation + app.vegetation_height(viewer_x, viewer_y, viewer_terrain_elevation)
+                        + app.VIEWER_HEIGHT_FT)
+    max_distance = int(app.horizon_distance(viewer_elevation) / app.SQUARE_SIZE_MILES)
+    if max_range is not None:
+        max_distance = min(max_distance, max_range)
+    max_distance = max(max_distance, 1)
+
+    length = math.hypot(target_x - viewer_x, target_y - viewer_y)
+    if length > max_distance:
+        return False
+    distances = list(range(math.ceil(length - 1e-9))) + [length]
+    previous_max_angle = -math.inf
+    for d in distances:
+        x = viewer_x + (d * (target_x - viewer_x) / length if length else 0)
+        y = viewer_y + (d * (target_y - viewer_y) / length if length else 0)
+        elevation = app.terrain_height(x, y, terrain_type)
+        veg_height = app.vegetation_height(x, y, elevation)
+        elevation_angle = math.degrees(math.atan2(elevation + veg_height - viewer_elevation,
+                                                  max(d * app.SQUARE_SIZE_MILES * 5280, 1)))
+        if elevation_angle <= previous_max_angle:
+            return False
+        previous_max_angle = elevation_angle
+    return True
+
+
+@pytest.mark.parametrize('max_range', [None, 30])
+def test_intervisibility_matches_reference(max_range):
+    rng = np.random.default_rng(0)
+    viewers = rng.integers(-150, 150, (200, 2))
+    pairs = np.concatenate([viewers, viewers + rng.integers(-60, 61, (200, 2))], axis=1)
+    pairs[:5, 2:] = pairs[:5, :2]  # Viewers looking at their own cell
+    visible = app.intervisibility(*pairs.T, app.TERRAIN_MOUNTAINS, max_range)
+    expected = [reference_visible(*pair, max_range) for pair in pairs.tolist()]
+    np.testing.assert_array_equal(visible, expected)
+    assert 0 < visible.sum() < len(visible)
+
+
+def test_intervisibility_agrees_with_viewshed():
+    # Along the 0 degree ray, sightlines and ray samples fall on the same points
+    viewshed = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)
+    cells = viewshed['cells']
+    distances = np.arange(1, viewshed['max_distance'] + 1)
+    visible = app.intervisibility(np.zeros_like(distances), np.full_like(distances, 15),
+                                  distances, np.full_like(distances, 15), app.TERRAIN_MOUNTAINS)
+    in_viewshed = cells.contains(distances, np.zeros_like(distances))
+    assert visible.any()
+    assert not (visible & ~in_viewshed).any()
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_intervisibility_endpoint(client):
+    pairs = [[0, 15, 3, 15], [0, 15, 0, 15]]
+    response = client.post('/intervisibility', json={'pairs': pairs, 'max_range': 50})
+    assert response.status_code == 200
+    expected = app.intervisibility(*np.array(pairs).T, app.TERRAIN_MOUNTAINS, 50).tolist()
+    assert response.get_json() == {'status': 'success', 'visible': expected}
+    assert client.post('/intervisibility', json={'pairs': []}).get_json()['visible'] == []
+
+
+@pytest.mark.parametrize('body', [
+    ['not', 'an', 'object'],
+    {'pairs': [[0, 15, 3, 15]], 'max_range': 10**30},
+    {'pairs': [[0, 15, 3, 15]], 'max_range': 0},
+    {'pairs': [[0, 15, 3, 15]], 'max_range': app.VIEWSHED_RANGE_LIMIT + 1},
+    {'pairs': [[0, 15, 3, 15]], 'max_range': 'far'},
+    {'pairs': [[0, 15, 3, 15]], 'terrain_type': 'desert'},
+    {'pairs': [[0, 15, 3, True]]},
+    {'pairs': [[0, 15, 3.5, 15]]},
+    {'pairs': [[0, 15, '3', 15]]},
+    {'pairs': [[0, 15, 3]]},
+    {'pairs': [[0, 15, app.WORLD_COORDINATE_LIMIT + 1, 15]]},
+    {'pairs': [[0, 15, 10**30, 15]]},
+    {'pairs': {'0': [0, 15, 3, 15]}},
+    {},
+    {'pairs': [[0, 15, 3, 15]] * (app.INTERVISIBILITY_MAX_PAIRS + 1)},
+])
+def test_intervisibility_rejects_invalid_requests(client, body):
+    response = client.post('/intervisibility', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
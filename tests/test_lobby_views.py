@@ -0,0 +1,100 @@
+import pytest
+
+import app
+
+POSITIONS = [{'x': 0, 'y': 15}, {'x': 400, 'y': 400}, {'x': 0, 'y': 15}, {'x': -30, 'y': 30}]
+ENEMIES = [{'x': 5, 'y': 20, 'direction': 90.0}, {'x': 398, 'y': 402, 'direction': 200.0},
+           {'x': -28, 'y': 33, 'direction': 10.0}]
+
+
+def game_state(enemies=ENEMIES, enemy_tick=0):
+    return {
+        'version': 3,
+        'positions': POSITIONS,
+        'previous_positions': [[{'x': position['x'], 'y': position['y'] - 1}] for position in POSITIONS],
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': enemies,
+        'enemy_tick': enemy_tick,
+    }
+
+
+def single_view(state, lobby_code, player_index):
+    """A player's view computed on its own."""
+    position = state['positions'][player_index]
+    center_x, center_y = position['x'], position['y']
+    visible_cells = app.get_viewshed(center_x, center_y, app.TERRAIN_MOUNTAINS)['cells'].copy()
+    app.tag_enemies(visible_cells, app.EnemyOverlay(state['enemies']), center_x, center_y)
+    previous_positions = state['previous_positions'][player_index]
+    sounds = (app.compute_ambient_sounds(center_x, center_y, app.TERRAIN_MOUNTAINS, previous_positions,
+                                         app.sound_rng(lobby_code, state, player_index))
+              + app.compute_enemy_sounds(center_x, center_y, state['enemies']))
+    return {
+        'visible_cells': visible_cells.to_dicts(),
+        'previous_positions': [{'x': pos['x'] - center_x, 'y': pos['y'] - center_y} for pos in previous_positions],
+        'lobby_code': lobby_code,
+        'sounds': sounds,
+    }
+
+
+def test_lobby_views_match_single_views():
+    state = game_state()
+    views = app.build_lobby_views(state, 'lobby')
+    assert len(views) == len(POSITIONS)
+    for player_index, (visible_cells, metadata, _, _) in enumerate(views):
+        assert {'visible_cells': visible_cells.to_dicts(), **metadata} == single_view(state, 'lobby', player_index)
+    # Each player sees from their own position
+    assert views[0][1]['previous_positions'] == [{'x': 0, 'y': -1}]
+    assert views[0][0].to_dicts() != views[1][0].to_dicts()
+
+
+def test_players_on_one_cell_share_visible_cells():
+    views = app.build_lobby_views(game_state(), 'lobby')
+    assert views[0][0] is views[2][0]
+    assert views[0][0] is not views[1][0]
+
+
+def test_enemy_tick_redoes_only_the_views_it_reaches():
+    previous = app.build_lobby_views(game_state(), 'lobby')
+    # The enemy near player 1 turns; the others stand still
+    enemies = [dict(ENEMIES[1], direction=20.0) if enemy is ENEMIES[1] else enemy for enemy in ENEMIES]
+    state = game_state(enemies, enemy_tick=1)
+    views = app.build_lobby_views(state, 'lobby', previous)
+    assert views[0] is previous[0]
+    assert views[3] is previous[3]
+    assert views[1] is not previous[1]
+    assert {'visible_cells': views[1][0].to_dicts(), **views[1][1]} == single_view(state, 'lobby', 1)
+
+
+def test_build_view_computes_the_lobby_once():
+    state = game_state()
+    before = app.lobby_view_cache.stats()
+    views = [app.build_view(state, 'once', player_index) for player_index in range(len(POSITIONS))]
+    after = app.lobby_view_cache.stats()
+    # The first player's view computes every view; the others are cache hits
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == len(POSITIONS) - 1
+    for player_index, (visible_cells, metadata) in enumerate(views):
+        assert {'visible_cells': visible_cells.to_dicts(), **metadata} == single_view(state, 'once', player_index)
+
+
+@pytest.fixture
+def lobby():
+    host = app.app.test_client()
+    lobby_code = host.post('/start_game', json={'num_enemies': 0}).get_json()['lobby_code']
+    guest = app.app.test_client()
+    assert guest.post('/join_game', json={'lobby_code': lobby_code, 'player_name': 'bob'}).status_code == 200
+    return host, guest, lobby_code
+
+
+def test_players_get_their_own_views(lobby):
+    host, guest, lobby_code = lobby
+    assert guest.post('/move', json={'direction': 'right', 'scale': 5}).status_code == 200
+    state = app.state_backend.load_lobby(lobby_code)
+    assert state['positions'][0] != state['positions'][1]
+
+    for player_index, client in enumerate((host, guest)):
+        view = client.get('/visible_cells').get_json()
+        expected = single_view(state, lobby_code, player_index)
+        assert view['visible_cells'] == expected['visible_cells']
+        assert view['previous_positions'] == expected['previous_positions']
+        assert view['sounds'] == expected['sounds']
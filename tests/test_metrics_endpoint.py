@@ -0,0 +1,38 @@
+import pytest
+
+import app
+
+REMOTE = {'REMOTE_ADDR': '203.0.113.5'}
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_metrics_served_to_loopback(client):
+    client.get('/')
+    for address in app.METRICS_LOOPBACK_ADDRESSES:
+        response = client.get('/metrics', environ_base={'REMOTE_ADDR': address})
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert '# TYPE bel_redis_round_trips_total counter' in response.get_data(as_text=True)
+
+
+def test_metrics_hidden_from_remote_clients(client):
+    response = client.get('/metrics', environ_base=REMOTE)
+    assert response.status_code == 404
+    assert response.get_json() == {'status': 'error', 'message': 'Not found'}
+    # Forwarding headers are not trusted
+    headers = {'X-Forwarded-For': '127.0.0.1'}
+    assert client.get('/metrics', environ_base=REMOTE, headers=headers).status_code == 404
+
+
+def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(app, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics', environ_base=REMOTE,
+                      headers={'Authorization': 'Bearer secret'}).status_code == 200
+    for headers in ({}, {'Authorization': 'Bearer wrong'}, {'Authorization': 'secret'}):
+        assert client.get('/metrics', environ_base=REMOTE, headers=headers).status_code == 404
+    # With a token set, loopback clients need it too
+    assert client.get('/metrics').status_code == 404
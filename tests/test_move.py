@@ -0,0 +1,58 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    client = app.app.test_client()
+    lobby_code = client.post('/start_game', json={'num_enemies': 0}).get_json()['lobby_code']
+    return client, lobby_code
+
+
+def position(lobby_code):
+    return app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+
+
+def teleport(lobby_code, x, y):
+    assert app.state_backend.apply_move(lobby_code, 0, position(lobby_code), [{'x': x, 'y': y}])
+
+
+def test_move(client):
+    client, lobby_code = client
+    start = position(lobby_code)
+    assert client.post('/move', json={'direction': 'down', 'scale': 3}).status_code == 200
+    assert position(lobby_code) == {'x': start['x'], 'y': start['y'] + 3}
+
+
+@pytest.mark.parametrize('scale', [10**19, app.MOVE_MAX_SCALE + 1, 0, -5, 2.0, '2', True, None])
+def test_move_rejects_invalid_scale(client, scale):
+    client, lobby_code = client
+    start = position(lobby_code)
+    response = client.post('/move', json={'direction': 'down', 'scale': scale})
+    assert response.status_code == 400
+    assert position(lobby_code) == start
+    # The view is still served
+    assert client.get('/visible_cells').status_code == 200
+
+
+def test_move_rejects_malformed_body(client):
+    client, _ = client
+    assert client.post('/move', data='[1', content_type='application/json').status_code == 400
+    assert client.post('/move', json=['down']).status_code == 400
+
+
+def test_move_rejects_destination_out_of_bounds(client):
+    client, lobby_code = client
+    limit = app.WORLD_COORDINATE_LIMIT
+    teleport(lobby_code, limit - 1, 500)
+    assert client.post('/move', json={'direction': 'right', 'scale': 1}).status_code == 200
+    response = client.post('/move', json={'direction': 'right', 'scale': 1})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Destination out of bounds'
+    assert position(lobby_code) == {'x': limit, 'y': 500}
+
+    response = client.post('/move_path', json={'target': {'x': 1, 'y': 0}})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Destination out of bounds'
+    assert position(lobby_code) == {'x': limit, 'y': 500}
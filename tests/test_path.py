@@ -0,0 +1,110 @@
+import heapq
+import math
+
+import numpy as np
+import pytest
+
+import app
+
+
+def dijkstra_cost(terrain_type, start_x, start_y, goal_x, goal_y):
+    """Cheapest route cost over the same window as plan_route, by plain Dijkstra."""
+    margin = app.PATH_PLAN_MARGIN
+    x0 = min(start_x, goal_x) - margin
+    y0 = min(start_y, goal_y) - margin
+    width = abs(goal_x - start_x) + 2 * margin + 1
+    height = abs(goal_y - start_y) + 2 * margin + 1
+    costs = app.traversal_cost_window(x0, y0, width, height, terrain_type)
+    best = np.full((width, height), math.inf)
+    best[start_x - x0, start_y - y0] = 0
+    frontier = [(0.0, start_x - x0, start_y - y0)]
+    while frontier:
+        cost, cx, cy = heapq.heappop(frontier)
+        if cost > best[cx, cy]:
+            continue
+        for nx, ny in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+            if 0 <= nx < width and 0 <= ny < height and cost + costs[nx, ny] < best[nx, ny]:
+                best[nx, ny] = cost + costs[nx, ny]
+                heapq.heappush(frontier, (best[nx, ny], nx, ny))
+    return best[goal_x - x0, goal_y - y0]
+
+
+def route_cost(terrain_type, start, route):
+    cost = 0.0
+    for (x0, y0), (x1, y1) in zip((start,) + route, route):
+        assert abs(x1 - x0) + abs(y1 - y0) == 1
+        cost += app.traversal_cost_window(x1, y1, 1, 1, terrain_type)[0, 0]
+    return cost
+
+
+@pytest.mark.parametrize('start, goal', [
+    ((0, 10), (0, 10)),
+    ((0, 10), (30, 40)),
+    ((100, 100), (60, 140)),  # Mountains
+    ((-50, 30), (-45, 30)),
+    ((-20, 20), (40, 30)),  # Around a meander
+])
+def test_plan_route_is_optimal(start, goal):
+    route = app.plan_route(app.TERRAIN_MOUNTAINS, *start, *goal)
+    assert route is not None
+    if start == goal:
+        assert route == ()
+        return
+    assert route[-1] == goal
+    assert not app.river_geometry.is_water(*zip(*route)).any()
+    expected = dijkstra_cost(app.TERRAIN_MOUNTAINS, *start, *goal)
+    assert route_cost(app.TERRAIN_MOUNTAINS, start, route) == pytest.approx(expected, rel=1e-9)
+
+
+def test_plan_route_does_not_cross_river():
+    assert app.plan_route(app.TERRAIN_MOUNTAINS, 0, 10, 0, -10) is None
+
+
+# /move_path
+
+@pytest.fixture
+def client():
+    client = app.app.test_client()
+    lobby_code = client.post('/start_game', json={'num_enemies': 0}).get_json()['lobby_code']
+    return client, lobby_code
+
+
+def test_move_path_walks_route(client):
+    client, lobby_code = client
+    start = app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+    response = client.post('/move_path', json={'waypoints': [{'x': 5, 'y': 5}, {'x': 5, 'y': 10}]})
+    assert response.status_code == 200
+    game_state = app.state_backend.load_lobby(lobby_code, ['positions', 'previous_positions'])
+    assert game_state['positions'][0] == {'x': start['x'] + 5, 'y': start['y'] + 10}
+    walked = [(step['x'], step['y']) for step in game_state['previous_positions'][0]]
+    first_leg = app.plan_route(app.TERRAIN_MOUNTAINS, start['x'], start['y'], start['x'] + 5, start['y'] + 5)
+    assert walked[:len(first_leg)] == list(first_leg)
+
+
+@pytest.mark.parametrize('body', [
+    '[1',  # Not JSON
+    '["up"]',
+    '{}',
+    '{"waypoints": {"x": 1, "y": 1}}',
+    '{"waypoints": [[1, 1]]}',
+    '{"waypoints": [{"x": 1}]}',
+    '{"waypoints": [{"x": "one", "y": 1}]}',
+    '{"waypoints": [{"x": 1e400, "y": 1}]}',
+    '{"waypoints": []}',
+    '{"target": {"x": 100000, "y": 0}}',
+    '{"target": {"x": 0, "y": -12}}',  # In the river
+    '{"target": {"x": 0, "y": -20}}',  # Across the river
+])
+def test_move_path_rejects_malformed_body(client, body):
+    client, lobby_code = client
+    start = app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0]
+    response = client.post('/move_path', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
+    assert app.state_backend.load_lobby(lobby_code, ['positions'])['positions'][0] == start
+
+
+def test_move_path_rejects_too_many_waypoints(client):
+    client, _ = client
+    waypoints = [{'x': 0, 'y': 1}] * (app.PATH_MAX_WAYPOINTS + 1)
+    assert client.post('/move_path', json={'waypoints': waypoints}).status_code == 400
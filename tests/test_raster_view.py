@@ -0,0 +1,116 @@
+import json
+
+import numpy as np
+import pytest
+
+import app
+
+
+def decode_raster(body):
+    """Reads the raster format into (size, size) channels indexed [y, x]."""
+    magic, version, _, size, elevation_offset, elevation_step, vegetation_step, metadata_length = \
+        app.RASTER_HEADER.unpack_from(body)
+    assert (magic, version) == (app.RASTER_MAGIC, app.RASTER_VERSION)
+    offset = app.RASTER_HEADER.size
+    channels = {}
+    for name, dtype in (('elevation', '<u2'), ('vegetation', 'u1'), ('flags', 'u1'), ('sound', 'u1')):
+        channels[name] = np.frombuffer(body, dtype=dtype, count=size * size, offset=offset).reshape(size, size)
+        offset += channels[name].nbytes
+    assert len(body) == offset + metadata_length
+    channels.update(
+        size=size,
+        elevation_feet=elevation_offset + channels['elevation'] * elevation_step,
+        vegetation_feet=channels['vegetation'] * vegetation_step,
+        elevation_step=elevation_step,
+        vegetation_step=vegetation_step,
+        metadata=json.loads(body[offset:]),
+    )
+    return channels
+
+
+@pytest.fixture(scope='module')
+def view():
+    # An enemy within sight and earshot of the viewer, and another out of view
+    game_state = {
+        'version': 1,
+        'positions': [{'x': 0, 'y': 15}],
+        'previous_positions': [[{'x': 0, 'y': 13}, {'x': 0, 'y': 14}]],
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': [{'x': 5, 'y': 20, 'direction': 90}, {'x': -30, 'y': 40, 'direction': 0}],
+        'enemy_tick': 0,
+    }
+    visible_cells, metadata = app.build_view(game_state, 'wire', 0)
+    assert visible_cells.enemy.any() and visible_cells.water.any()
+    return visible_cells, metadata
+
+
+def test_raster_round_trip(view):
+    visible_cells, metadata = view
+    decoded = decode_raster(app.encode_raster_view(visible_cells, metadata))
+    size = decoded['size']
+    half = size // 2
+    assert size == app.RASTER_VIEWPORT_SIZE
+    assert decoded['metadata'] == {key: value for key, value in metadata.items() if key != 'sounds'}
+
+    # Every visible cell inside the viewport, and only those, is marked visible
+    flags = decoded['flags']
+    inside = (np.abs(visible_cells.x) <= half) & (np.abs(visible_cells.y) <= half)
+    rows = visible_cells.y[inside] + half
+    columns = visible_cells.x[inside] + half
+    assert (flags & 1).sum() == inside.sum()
+    assert (flags[rows, columns] & 1).all()
+
+    cell_flags = flags[rows, columns]
+    for bit, name in ((1, 'water'), (2, 'enemy'), (3, 'enemy_fov'), (4, 'enemy_hearing')):
+        np.testing.assert_array_equal((cell_flags >> bit) & 1, getattr(visible_cells, name)[inside], err_msg=name)
+    np.testing.assert_array_equal((cell_flags >> 5) & 3, visible_cells.river_level[inside])
+
+    elevation = decoded['elevation_feet'][rows, columns]
+    assert np.abs(elevation - visible_cells.elevation[inside]).max() <= decoded['elevation_step'] / 2 + 1e-3
+    vegetation = decoded['vegetation_feet'][rows, columns]
+    assert np.abs(vegetation - visible_cells.vegetation_height[inside]).max() <= decoded['vegetation_step'] + 1e-6
+    # Channels of cells that are not visible are zero
+    assert not decoded['elevation'][(flags & 1) == 0].any()
+
+
+def test_raster_previous_positions_and_sounds(view):
+    visible_cells, metadata = view
+    decoded = decode_raster(app.encode_raster_view(visible_cells, metadata))
+    half = decoded['size'] // 2
+
+    previous = {(pos['x'], pos['y']) for pos in metadata['previous_positions']}
+    marked = {(int(x) - half, int(y) - half) for y, x in zip(*np.nonzero(decoded['flags'] & 0x80))}
+    assert marked == previous
+
+    # Later sounds are drawn over earlier ones
+    expected = {}
+    for entry in metadata['sounds']:
+        if abs(entry['x']) <= half and abs(entry['y']) <= half:
+            expected[(entry['x'], entry['y'])] = app._raster_sound_code(entry['color'])
+    sound = decoded['sound']
+    drawn = {(int(x) - half, int(y) - half): int(sound[y, x]) for y, x in zip(*np.nonzero(sound))}
+    assert drawn == expected
+    assert any(code & app.RASTER_ENEMY_SOUND for code in drawn.values())
+
+
+def test_raster_sound_codes():
+    assert app._raster_sound_code('blue') == 1
+    assert app._raster_sound_code('rgba(255, 0, 0, 1.0)') == app.RASTER_ENEMY_SOUND | 127
+    assert app._raster_sound_code('rgba(255, 0, 0, 0.5)') == app.RASTER_ENEMY_SOUND | 64
+    assert app._raster_sound_code('rgba(255, 0, 0, 0)') == app.RASTER_ENEMY_SOUND
+
+
+def test_raster_negotiation():
+    client = app.app.test_client()
+    client.post('/start_game', json={})
+    cells = client.get('/visible_cells').get_json()['visible_cells']
+    half = app.RASTER_VIEWPORT_SIZE // 2
+    in_viewport = {(cell['x'], cell['y']) for cell in cells if abs(cell['x']) <= half and abs(cell['y']) <= half}
+
+    accept = f'{app.RASTER_MIMETYPE}, application/json;q=0.5'
+    for response in (client.get('/visible_cells', headers={'Accept': accept}),
+                     client.get('/visible_cells?format=raster')):
+        assert response.mimetype == app.RASTER_MIMETYPE
+        decoded = decode_raster(response.get_data())
+        visible = {(int(x) - half, int(y) - half) for y, x in zip(*np.nonzero(decoded['flags'] & 1))}
+        assert visible == in_viewport
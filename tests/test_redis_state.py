@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import app
+
+
+def new_game_state():
+    return {
+        'version': 1,
+        'positions': [{'x': 0, 'y': 15}],
+        'previous_positions': [[]],
+        'max_players': 2,
+        'player_names': ['alice'],
+        'ready_statuses': [False],
+        'game_started': False,
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': [{'x': 3, 'y': 4, 'direction': 90}],
+        'enemy_tick': 0,
+    }
+
+
+# Lobby hash fields
+
+def test_encode_lobby_splits_player_fields():
+    game_state = new_game_state()
+    game_state['positions'].append({'x': 5, 'y': 20})
+    game_state['previous_positions'].append([{'x': 5, 'y': 19}])
+    fields = app._encode_lobby(game_state)
+    assert json.loads(fields['position:0']) == {'x': 0, 'y': 15}
+    assert json.loads(fields['position:1']) == {'x': 5, 'y': 20}
+    assert json.loads(fields['previous_positions:1']) == [{'x': 5, 'y': 19}]
+    assert 'positions' not in fields and 'previous_positions' not in fields
+    assert app._decode_lobby(fields) == game_state
+
+
+def test_decode_lobby_orders_players_by_index():
+    fields = {f'position:{index}': json.dumps({'x': index, 'y': 0}) for index in (10, 2, 0, 1)}
+    assert [position['x'] for position in app._decode_lobby(fields)['positions']] == [0, 1, 2, 10]
+
+
+def test_decode_lobby_accepts_redis_replies():
+    game_state = new_game_state()
+    fields = app._encode_lobby(game_state)
+    as_bytes = {field.encode(): value.encode() for field, value in fields.items()}
+    assert app._decode_lobby(as_bytes) == game_state
+    # The flat [field, value, ...] list returned by HGETALL inside a Lua script
+    flat = [item for pair in as_bytes.items() for item in pair]
+    assert app._decode_lobby(flat) == game_state
+
+
+def test_lobby_hash_fields():
+    hash_fields = app._lobby_hash_fields(['positions', 'version'])
+    assert hash_fields[:2] == ['position:0', 'position:1']
+    assert len(hash_fields) == app.MAX_PLAYERS_PER_LOBBY + 1
+    assert hash_fields[-1] == 'version'
+
+
+# Round trips
+
+def test_lobby_operations_take_one_round_trip():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    backend = app.RedisStateBackend(app.CountingRedis(connection_pool=fakeredis.FakeRedis().connection_pool))
+    backend.save_session('s1', {'lobby_code': 'abc'}, 60)
+
+    def round_trips(operation, *args):
+        operation(*args)  # Loads the Lua script on first use
+        before = app.redis_round_trips.samples()[0][2]
+        result = operation(*args)
+        assert app.redis_round_trips.samples()[0][2] - before == 1, operation.__name__
+        return result
+
+    round_trips(backend.create_lobby, 'abc', new_game_state())
+    assert round_trips(backend.load_session_and_lobby, 's1') == ({'lobby_code': 'abc'}, new_game_state())
+    round_trips(backend.set_player_ready, 'abc', 0, True)
+    round_trips(backend.apply_move, 'abc', 0, {'x': 0, 'y': 15}, [{'x': 0, 'y': 16}])
+    round_trips(backend.load_lobby, 'abc', ['positions', 'version'])
+    round_trips(backend.save_enemies, {'abc': (0, [])})
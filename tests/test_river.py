@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import app
+from river import RiverGeometry
+
+river = RiverGeometry(app.RIVER_WIDTH, app.RIVER_MEANDER_AMPLITUDE, app.RIVER_MEANDER_FREQUENCY)
+
+DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+def crosses_by_walking(x, y, dx, dy, steps):
+    return any(app.is_river(x + dx * step, y + dy * step) for step in range(1, steps + 1))
+
+
+def test_is_water_matches_is_river():
+    xs, ys = np.meshgrid(np.arange(-300, 300), np.arange(-30, 30), indexing='ij')
+    expected = np.vectorize(app.is_river)(xs, ys)
+    np.testing.assert_array_equal(river.is_water(xs, ys), expected)
+
+
+def test_signed_distance_matches_is_water():
+    xs, ys = np.meshgrid(np.arange(-300, 300), np.arange(-30, 30), indexing='ij')
+    distance = river.signed_distance(xs, ys)
+    np.testing.assert_array_equal(distance < 0, river.is_water(xs, ys))
+    # Cells next to the bank are half a cell from it, at most
+    assert np.abs(distance).min() > 0
+    assert np.abs(distance).min() <= 0.5
+    # Where the river runs straight the distance is the vertical offset
+    column = int(round(np.pi / (2 * river.frequency)))  # A meander crest
+    assert river.signed_distance(column, river.water_rows(column)[1] + 10) == pytest.approx(9.5, abs=0.01)
+
+
+@pytest.mark.parametrize('dx, dy', DIRECTIONS)
+def test_crosses_matches_walking(dx, dy):
+    rng = np.random.default_rng(0)
+    for _ in range(400):
+        x = int(rng.integers(-200, 200))
+        y = int(rng.integers(-40, 40))
+        steps = int(rng.integers(0, 80))
+        assert river.crosses(x, y, dx, dy, steps) == crosses_by_walking(x, y, dx, dy, steps), (x, y, steps)
+
+
+def test_crosses_ignores_start_cell():
+    x = 7
+    water_first, water_last = river.water_rows(x)
+    assert app.is_river(x, water_first)
+    assert not river.crosses(x, water_last, 0, 1, 5)
+    assert river.crosses(x, water_first, 0, 1, 1)
+
+
+def test_crosses_long_walk_along_river():
+    # Walking along a row the river meanders across is decided within a period
+    row = int(app.RIVER_MEANDER_AMPLITUDE)
+    assert river.crosses(-1000, row, 1, 0, 100000) == crosses_by_walking(-1000, row, 1, 0, 2000)
+    assert not river.crosses(-1000, river.reach + 1, 1, 0, 100000)
+
+
+@pytest.mark.parametrize('step', [1, 3, 10, -1, -4, -10])
+def test_first_land(step):
+    for x in range(-150, 150, 7):
+        for y in range(-25, 25):
+            land = river.first_land(x, y, step)
+            assert not app.is_river(x, land)
+            assert (land - y) % abs(step) == 0
+            # Every cell stepped over before it is water
+            assert all(app.is_river(x, cell) for cell in range(y, land, step))
+
+
+def test_first_land_on_land_is_unchanged():
+    x = 3
+    _, water_last = river.water_rows(x)
+    assert river.first_land(x, water_last + 1, 10) == water_last + 1
+
+
+def test_sample_land():
+    rng = np.random.default_rng(1)
+    xs, ys = river.sample_land(rng, 2000, -50, 50, -50, 50)
+    assert xs.min() >= -50 and xs.max() <= 50 and ys.min() >= -50 and ys.max() <= 50
+    assert not river.is_water(xs, ys).any()
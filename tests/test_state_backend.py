@@ -0,0 +1,238 @@
+import time
+
+import pytest
+
+import app
+
+
+def new_game_state(player_name='alice', position=None):
+    return {
+        'version': 1,
+        'positions': [position or {'x': 0, 'y': 15}],
+        'previous_positions': [[]],
+        'max_players': 2,
+        'player_names': [player_name],
+        'ready_statuses': [False],
+        'game_started': False,
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': [{'x': 3, 'y': 4, 'direction': 90}],
+        'enemy_tick': 0,
+    }
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    """Each backend test runs against both backends, which must behave alike."""
+    if request.param == 'memory':
+        return app.MemoryStateBackend()
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')  # Needed by fakeredis to run the Lua scripts
+    return app.RedisStateBackend(fakeredis.FakeRedis())
+
+
+def ttl(backend, key):
+    """Seconds until key expires."""
+    if isinstance(backend, app.RedisStateBackend):
+        return backend.client.ttl(key)
+    return backend._entries[key][0] - time.monotonic()
+
+
+def set_ttl(backend, key, seconds):
+    if isinstance(backend, app.RedisStateBackend):
+        backend.client.expire(key, seconds)
+    else:
+        backend._entries[key] = (time.monotonic() + seconds, backend._entries[key][1])
+
+
+# Sessions
+
+def test_session_round_trip(backend):
+    assert backend.get_session('s1') == {}
+    backend.save_session('s1', {'lobby_code': 'abc', 'player_index': 0}, 60)
+    assert backend.get_session('s1') == {'lobby_code': 'abc', 'player_index': 0}
+    assert 0 < ttl(backend, 'session:s1') <= 60
+
+
+def test_load_session_and_lobby(backend):
+    backend.create_lobby('abc', new_game_state())
+    backend.save_session('s1', {'lobby_code': 'abc'}, 60)
+    backend.save_session('s2', {'lobby_code': 'gone'}, 60)
+
+    session_data, game_state = backend.load_session_and_lobby('s1')
+    assert session_data == {'lobby_code': 'abc'}
+    assert game_state == new_game_state()
+    assert backend.load_session_and_lobby('s2') == ({'lobby_code': 'gone'}, None)
+    assert backend.load_session_and_lobby('missing') == ({}, None)
+
+
+# Lobbies
+
+def test_create_lobby(backend):
+    assert backend.create_lobby('abc', new_game_state())
+    assert not backend.create_lobby('abc', new_game_state('bob'))
+    assert backend.lobby_exists('abc')
+    assert not backend.lobby_exists('xyz')
+    assert backend.load_lobby('abc') == new_game_state()
+    assert backend.load_lobby('xyz') is None
+    assert backend.active_lobbies() == ['abc']
+    assert 0 < ttl(backend, 'abc') <= app.LOBBY_TTL_SECONDS
+
+
+def test_load_lobby_fields(backend):
+    backend.create_lobby('abc', new_game_state())
+    assert backend.load_lobby('abc', ['positions', 'version']) == {'positions': [{'x': 0, 'y': 15}], 'version': 1}
+    assert backend.load_lobbies(['abc', 'xyz'], ['enemy_tick']) == [{'enemy_tick': 0}, None]
+
+
+def test_join_lobby(backend):
+    backend.create_lobby('abc', new_game_state())
+    set_ttl(backend, 'abc', 100)
+
+    error, fields = backend.join_lobby('abc', 'bob', {'x': 5, 'y': 20})
+    assert error is None
+    assert fields == {'player_names': ['alice', 'bob'], 'ready_statuses': [False, False],
+                      'max_players': 2, 'player_index': 1}
+    game_state = backend.load_lobby('abc')
+    assert game_state['positions'] == [{'x': 0, 'y': 15}, {'x': 5, 'y': 20}]
+    assert game_state['previous_positions'] == [[], []]
+    assert game_state['version'] == 2
+    assert ttl(backend, 'abc') > 100  # Refreshed
+
+    assert backend.join_lobby('abc', 'carol', {'x': 0, 'y': 15}) == ('Lobby is full', None)
+    assert backend.join_lobby('xyz', 'carol', {'x': 0, 'y': 15}) == ('Invalid lobby code', None)
+
+
+def test_join_started_lobby(backend):
+    game_state = new_game_state()
+    game_state['game_started'] = True
+    backend.create_lobby('abc', game_state)
+    assert backend.join_lobby('abc', 'bob', {'x': 0, 'y': 15}) == ('Game has already started', None)
+
+
+def test_set_player_ready(backend):
+    backend.create_lobby('abc', new_game_state())
+    set_ttl(backend, 'abc', 100)
+
+    assert backend.set_player_ready('abc', 0, True) == (None, [True])
+    assert backend.load_lobby('abc', ['ready_statuses', 'version']) == {'ready_statuses': [True], 'version': 2}
+    assert ttl(backend, 'abc') > 100
+    assert backend.set_player_ready('abc', 1, True) == ('Player not in lobby', None)
+    assert backend.set_player_ready('xyz', 0, True) == ('Game state not found', None)
+
+
+def test_apply_move(backend):
+    backend.create_lobby('abc', new_game_state())
+    set_ttl(backend, 'abc', 100)
+
+    steps = [{'x': 0, 'y': 16}, {'x': 0, 'y': 17}]
+    assert backend.apply_move('abc', 0, {'x': 0, 'y': 15}, steps) == 2
+    game_state = backend.load_lobby('abc')
+    assert game_state['positions'] == [{'x': 0, 'y': 17}]
+    assert game_state['previous_positions'] == [steps]
+    assert ttl(backend, 'abc') > 100
+
+
+def test_apply_move_compare_and_set(backend):
+    backend.create_lobby('abc', new_game_state())
+    backend.apply_move('abc', 0, {'x': 0, 'y': 15}, [{'x': 0, 'y': 16}])
+
+    # A move computed from a stale position is refused and changes nothing
+    assert backend.apply_move('abc', 0, {'x': 0, 'y': 15}, [{'x': 1, 'y': 15}]) == 0
+    assert backend.load_lobby('abc', ['positions', 'version']) == {'positions': [{'x': 0, 'y': 16}], 'version': 2}
+    assert backend.apply_move('abc', 1, {'x': 0, 'y': 15}, [{'x': 1, 'y': 15}]) == -1
+    assert backend.apply_move('xyz', 0, {'x': 0, 'y': 15}, [{'x': 1, 'y': 15}]) == -1
+
+
+def test_apply_move_trims_history(backend):
+    backend.create_lobby('abc', new_game_state({'x': 0, 'y': 15}))
+    steps = [{'x': 0, 'y': 16 + step} for step in range(app.PREVIOUS_POSITIONS_LIMIT + 10)]
+    backend.apply_move('abc', 0, {'x': 0, 'y': 15}, steps)
+    previous_positions = backend.load_lobby('abc', ['previous_positions'])['previous_positions'][0]
+    assert previous_positions == steps[-app.PREVIOUS_POSITIONS_LIMIT:]
+
+
+def test_apply_move_leaves_other_players(backend):
+    backend.create_lobby('abc', new_game_state())
+    backend.join_lobby('abc', 'bob', {'x': 5, 'y': 20})
+    backend.apply_move('abc', 1, {'x': 5, 'y': 20}, [{'x': 6, 'y': 20}])
+    game_state = backend.load_lobby('abc')
+    assert game_state['positions'] == [{'x': 0, 'y': 15}, {'x': 6, 'y': 20}]
+    assert game_state['previous_positions'] == [[], [{'x': 6, 'y': 20}]]
+
+
+# Enemies
+
+def test_save_enemies(backend):
+    backend.create_lobby('abc', new_game_state())
+    set_ttl(backend, 'abc', 100)
+    enemies = [{'x': 4, 'y': 4, 'direction': 45}]
+
+    backend.save_enemies({'abc': (0, enemies)})
+    game_state = backend.load_lobby('abc')
+    assert game_state['enemies'] == enemies
+    assert game_state['enemy_tick'] == 1
+    # Enemy updates version the enemies only and never keep a lobby alive
+    assert game_state['version'] == 1
+    assert ttl(backend, 'abc') <= 100
+
+    # Enemies computed from an older tick are dropped
+    backend.save_enemies({'abc': (0, [])})
+    assert backend.load_lobby('abc', ['enemies', 'enemy_tick']) == {'enemies': enemies, 'enemy_tick': 1}
+
+
+def test_save_enemies_prunes_expired_lobbies(backend):
+    backend.create_lobby('abc', new_game_state())
+    backend.create_lobby('def', new_game_state())
+    backend.save_enemies({}, expired_lobbies=['def'])
+    assert backend.active_lobbies() == ['abc']
+
+
+# Events and leases
+
+def test_lobby_events(backend):
+    backend.create_lobby('abc', new_game_state())
+    subscription = backend.subscribe(app.lobby_events_channel('abc'))
+    try:
+        # A Redis subscription only starts receiving once its confirmation is read
+        subscription.get_message(timeout=0.1)
+        backend.apply_move('abc', 0, {'x': 0, 'y': 15}, [{'x': 0, 'y': 16}])
+        message = subscription.get_message(timeout=1)
+        assert message['type'] == 'message'
+        assert message['data'] in ('move', b'move')
+    finally:
+        subscription.close()
+
+
+def test_acquire_lease(backend):
+    assert backend.acquire_lease('lease', 10)
+    assert not backend.acquire_lease('lease', 10)
+
+
+# Backend selection and expiry
+
+def test_create_state_backend(monkeypatch):
+    monkeypatch.setattr(app, 'STATE_BACKEND', 'memory')
+    assert isinstance(app.create_state_backend(), app.MemoryStateBackend)
+    monkeypatch.setattr(app, 'STATE_BACKEND', 'sqlite')
+    with pytest.raises(ValueError):
+        app.create_state_backend()
+
+
+def test_memory_backend_expires_keys():
+    backend = app.MemoryStateBackend()
+    backend.save_session('s1', {'lobby_code': 'abc'}, 60)
+    backend.create_lobby('abc', new_game_state())
+    set_ttl(backend, 'session:s1', -1)
+    set_ttl(backend, 'abc', -1)
+    assert backend.get_session('s1') == {}
+    assert backend.load_lobby('abc') is None
+    assert backend.acquire_lease('abc', 10)  # The expired key is free again
+
+
+def test_memory_backend_sweeps_expired_keys():
+    backend = app.MemoryStateBackend()
+    backend.save_session('s1', {}, 60)
+    set_ttl(backend, 'session:s1', -1)
+    backend._next_sweep = time.monotonic()
+    backend.save_session('s2', {}, 60)
+    assert list(backend._entries) == ['session:s2']
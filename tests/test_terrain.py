@@ -0,0 +1,75 @@
+import noise
+import numpy as np
+import pytest
+
+import app
+
+
+def sample_points(count=2000, extent=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = rng.uniform(-extent, extent, count)
+    ys = rng.uniform(-extent, extent, count)
+    # Lattice corners and edges, where floor and fmod round
+    xs[:100] = np.round(xs[:100])
+    ys[:50] = np.round(ys[:50])
+    return xs, ys
+
+
+def test_pnoise2_array_matches_pnoise2():
+    xs, ys = sample_points()
+    for scale, repeat in ((app.MOUNTAIN_SCALE, 1024), (app.VEG_SCALE, 1000), (1.0, 1024)):
+        expected = [noise.pnoise2(x * scale, y * scale, repeatx=repeat, repeaty=repeat)
+                    for x, y in zip(xs.tolist(), ys.tolist())]
+        actual = app.pnoise2_array(xs * scale, ys * scale, repeatx=repeat, repeaty=repeat)
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_pnoise2_array_keeps_shape():
+    xs, ys = np.meshgrid(np.arange(3.5, 7.5), np.arange(-2.5, 0.5), indexing='ij')
+    assert app.pnoise2_array(xs, ys).shape == (4, 3)
+    assert app.pnoise2_array(1.25, 2.5).shape == ()
+
+
+def test_terrain_height_array_matches_terrain_height():
+    xs, ys = sample_points(500)
+    expected = [app.terrain_height(x, y, app.TERRAIN_MOUNTAINS) for x, y in zip(xs.tolist(), ys.tolist())]
+    np.testing.assert_allclose(app.terrain_height_array(xs, ys, app.TERRAIN_MOUNTAINS), expected, rtol=0, atol=1e-9)
+
+
+def test_vegetation_height_array_matches_vegetation_height():
+    xs, ys = sample_points(500)
+    elevations = app.terrain_height_array(xs, ys, app.TERRAIN_MOUNTAINS)
+    expected = [app.vegetation_height(x, y, elevation)
+                for x, y, elevation in zip(xs.tolist(), ys.tolist(), elevations.tolist())]
+    np.testing.assert_allclose(app.vegetation_height_array(xs, ys, elevations), expected, rtol=0, atol=1e-9)
+
+
+def finite_difference_gradient(xs, ys, h=0.1):
+    # noise.pnoise2 computes in single precision, so smaller steps difference rounding error
+    def height(x, y):
+        return app.terrain_height_array(x, y, app.TERRAIN_MOUNTAINS)
+    return (height(xs + h, ys) - height(xs - h, ys)) / (2 * h), (height(xs, ys + h) - height(xs, ys - h)) / (2 * h)
+
+
+def test_gradient_matches_finite_differences():
+    xs, ys = sample_points(500)
+    expected_x, expected_y = finite_difference_gradient(xs, ys)
+    dh_dx, dh_dy = app.terrain_gradient_array(xs, ys, app.TERRAIN_MOUNTAINS)
+    np.testing.assert_allclose(dh_dx, expected_x, rtol=0, atol=0.01)
+    np.testing.assert_allclose(dh_dy, expected_y, rtol=0, atol=0.01)
+    assert np.abs(dh_dx).max() > 1  # Not trivially flat
+    scalar = [app.terrain_gradient(x, y, app.TERRAIN_MOUNTAINS) for x, y in zip(xs.tolist(), ys.tolist())]
+    # The array version takes the lattice offsets in single precision, as pnoise2_array does
+    np.testing.assert_allclose(np.array(scalar), np.stack([dh_dx, dh_dy], axis=1), rtol=0, atol=1e-4)
+
+
+def test_slope_field_matches_gradient():
+    xs, ys = (np.round(coordinate).astype(np.int64) for coordinate in sample_points(300))
+    field = app.slope_field(xs, ys, app.TERRAIN_MOUNTAINS)
+    slope, aspect = app.terrain_slope_aspect_array(xs, ys, app.TERRAIN_MOUNTAINS)
+    np.testing.assert_allclose(field['slope'], slope, rtol=1e-6)
+    np.testing.assert_allclose(field['aspect'], aspect, rtol=0, atol=1e-6)
+    # Integer cells are read from the field, other points evaluated
+    for x, y in zip(xs[:20].tolist(), ys[:20].tolist()):
+        assert app.get_visibility_range(x, y, app.TERRAIN_MOUNTAINS) == pytest.approx(
+            app.get_visibility_range(float(x), float(y), app.TERRAIN_MOUNTAINS), abs=1e-6)
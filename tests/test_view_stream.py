@@ -0,0 +1,118 @@
+import json
+
+import numpy as np
+
+import app
+
+
+def apply_delta(view, delta):
+    """Applies a 'delta' event to a full view the way the game page does."""
+    cells = {}
+    for cell in view['visible_cells']:
+        cell = dict(cell, x=cell['x'] - delta['shift']['x'], y=cell['y'] - delta['shift']['y'])
+        cells[(cell['x'], cell['y'])] = cell
+    for x, y in delta['removed']:
+        del cells[(x, y)]
+    for cell in delta['added']:
+        cells[(cell['x'], cell['y'])] = cell
+    view = dict(view, visible_cells=list(cells.values()))
+    for key in ('previous_positions', 'lobby_code', 'sounds'):
+        if key in delta:
+            view[key] = delta[key]
+    return view
+
+
+def assert_views_match(applied, full):
+    # Elevation and vegetation may lag by up to the resend tolerances; everything else is exact
+    def by_coordinate(view):
+        return {(cell['x'], cell['y']): cell for cell in view['visible_cells']}
+    applied_cells = by_coordinate(applied)
+    full_cells = by_coordinate(full)
+    assert applied_cells.keys() == full_cells.keys()
+    for coordinate, cell in full_cells.items():
+        held = applied_cells[coordinate]
+        assert abs(held['elevation'] - cell['elevation']) <= app.VIEW_DELTA_ELEVATION_TOLERANCE
+        assert abs(held['vegetation_height'] - cell['vegetation_height']) <= app.VIEW_DELTA_VEGETATION_TOLERANCE
+        lagging = {'elevation': None, 'vegetation_height': None}
+        assert {**held, **lagging} == {**cell, **lagging}, coordinate
+    assert {key: value for key, value in applied.items() if key != 'visible_cells'} == \
+        {key: value for key, value in full.items() if key != 'visible_cells'}
+
+
+def game_state(position, enemies, version):
+    return {
+        'version': version,
+        'positions': [position],
+        'previous_positions': [[]],
+        'terrain_type': app.TERRAIN_MOUNTAINS,
+        'enemies': enemies,
+        'enemy_tick': 0,
+    }
+
+
+def full_view(visible_cells, metadata):
+    return json.loads(json.dumps({'visible_cells': visible_cells.to_dicts(), **metadata}))
+
+
+def test_delta_reproduces_full_view():
+    enemies = [{'x': 5, 'y': 20, 'direction': 90}]
+    steps = [({'x': 0, 'y': 15}, enemies),
+             ({'x': 0, 'y': 17}, enemies),  # Moved
+             ({'x': 0, 'y': 17}, [{'x': 4, 'y': 21, 'direction': 180}]),  # Enemy moved
+             ({'x': 9, 'y': 12}, [])]  # Moved further, enemy gone
+
+    visible_cells, metadata = app.build_view(game_state(*steps[0], version=1), 'delta', 0)
+    center = (steps[0][0]['x'], steps[0][0]['y'])
+    client_view = full_view(visible_cells, metadata)
+    previous = (visible_cells, metadata, center, (visible_cells.elevation, visible_cells.vegetation_height))
+    for version, (position, step_enemies) in enumerate(steps[1:], start=2):
+        visible_cells, metadata = app.build_view(game_state(position, step_enemies, version), 'delta', 0)
+        center = (position['x'], position['y'])
+        delta, held = app.diff_views(previous, (visible_cells, metadata, center))
+        client_view = apply_delta(client_view, json.loads(json.dumps(delta)))
+        assert_views_match(client_view, full_view(visible_cells, metadata))
+
+        client_cells = {(cell['x'], cell['y']): cell for cell in client_view['visible_cells']}
+        ordered = [client_cells[cell] for cell in zip(visible_cells.x.tolist(), visible_cells.y.tolist())]
+        np.testing.assert_array_equal(held[0], [cell['elevation'] for cell in ordered])
+        np.testing.assert_array_equal(held[1], [cell['vegetation_height'] for cell in ordered])
+        previous = (visible_cells, metadata, center, held)
+
+
+def test_unchanged_view_sends_empty_delta():
+    visible_cells, metadata = app.build_view(game_state({'x': 0, 'y': 15}, [], 1), 'same', 0)
+    previous = (visible_cells, metadata, (0, 15), (visible_cells.elevation, visible_cells.vegetation_height))
+    delta, _ = app.diff_views(previous, (visible_cells, metadata, (0, 15)))
+    assert delta == {'shift': {'x': 0, 'y': 0}, 'removed': [], 'added': []}
+
+
+def read_event(chunks):
+    """Returns (event, data) of the next event, skipping comments."""
+    text = ''
+    while True:
+        text += next(chunks).decode()
+        if text.startswith(':'):
+            text = text.split('\n\n', 1)[1]
+            continue
+        if text.endswith('\n\n'):
+            event_line, data_line = text.strip().split('\n')
+            return event_line[len('event: '):], json.loads(data_line[len('data: '):])
+
+
+def test_view_stream_sends_view_then_deltas():
+    client = app.app.test_client()
+    client.post('/start_game', json={'num_enemies': 0})
+    response = client.get('/view_stream', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    chunks = iter(response.response)
+    try:
+        event, view = read_event(chunks)
+        assert event == 'view'
+        assert client.post('/move', json={'direction': 'down', 'scale': 2}).status_code == 200
+
+        event, delta = read_event(chunks)
+        assert event == 'delta'
+        assert delta['shift'] == {'x': 0, 'y': 2}
+        assert_views_match(apply_delta(view, delta), client.get('/visible_cells').get_json())
+    finally:
+        response.close()
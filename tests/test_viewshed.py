@@ -0,0 +1,151 @@
+import math
+
+import numpy as np
+import pytest
+
+import app
+
+VIEWPOINTS = [(0, 15), (240, 45), (100, 100), (200, -200)]
+
+
+def reference_viewshed(center_x, center_y, terrain_type, angle_step=app.VIEWSHED_ANGLE_STEP,
+                       max_range=app.VIEWSHED_MAX_RANGE):
+    """
+    The original line_of_sight_visibility: one ray at a time, one sample at
+    a time. Returns {(x, y) relative to the viewer: cell}, keeping the last
+    sample of cells that several samples round to, as clients did.
+    """
+    viewer_terrain_elevation = app.terrain_height(center_x, center_y, terrain_type)
+    viewer_elevation = (viewer_terrain_elevation + app.vegetation_height(center_x, center_y, viewer_terrain_elevation)
+                        + app.VIEWER_HEIGHT_FT)
+    max_distance = int(app.horizon_distance(viewer_elevation) / app.SQUARE_SIZE_MILES)
+    if max_range is not None:
+        max_distance = min(max_distance, int(max_range))
+    max_distance = max(max_distance, 1)
+
+    cells = {}
+    for angle_deg in np.arange(0, 360, angle_step).tolist():
+        angle_rad = math.radians(angle_deg)
+        cos_theta = math.cos(angle_rad)
+        sin_theta = math.sin(angle_rad)
+        previous_max_angle = -math.inf
+        for d in range(max_distance + 1):
+            x = center_x + d * cos_theta
+            y = center_y + d * sin_theta
+            x_int = int(round(x))
+            y_int = int(round(y))
+            elevation = app.terrain_height(x, y, terrain_type)
+            veg_height = app.vegetation_height(x, y, elevation)
+            elevation_angle = math.degrees(math.atan2(elevation + veg_height - viewer_elevation,
+                                                      max(d * app.SQUARE_SIZE_MILES * 5280, 1)))
+            if elevation_angle <= previous_max_angle:
+                break
+            previous_max_angle = elevation_angle
+
+            water = app.is_river(x_int, y_int)
+            distance_to_player = math.hypot(x_int - center_x, y_int - center_y)
+            river_level = 0
+            if water and distance_to_player <= app.RIVER_SOUND_RANGE_NEAR:
+                river_level = 2
+            elif water and distance_to_player <= app.RIVER_SOUND_RANGE_FAR:
+                river_level = 1
+            cells[(x_int - center_x, y_int - center_y)] = (elevation, veg_height, water, river_level)
+    return cells
+
+
+def assert_matches_reference(visible_cells, expected):
+    actual = {(x, y): position for position, (x, y) in
+              enumerate(zip(visible_cells.x.tolist(), visible_cells.y.tolist()))}
+    assert actual.keys() == expected.keys()
+    positions = [actual[cell] for cell in expected]
+    elevation, veg_height, water, river_level = (np.array(column) for column in zip(*expected.values()))
+    np.testing.assert_allclose(visible_cells.elevation[positions], elevation, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(visible_cells.vegetation_height[positions], veg_height, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(visible_cells.water[positions], water)
+    np.testing.assert_array_equal(visible_cells.river_level[positions], river_level)
+
+
+@pytest.mark.parametrize('center', VIEWPOINTS)
+def test_viewshed_matches_reference(center):
+    app.viewshed_cache.clear()
+    viewshed = app.get_viewshed(*center, app.TERRAIN_MOUNTAINS)
+    assert_matches_reference(viewshed['cells'], reference_viewshed(*center, app.TERRAIN_MOUNTAINS))
+
+
+@pytest.mark.parametrize('angle_step, max_range', [(5, None), (1, 40), (0.5, 10)])
+def test_viewshed_settings_match_reference(angle_step, max_range):
+    viewshed = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS, angle_step, max_range)
+    expected = reference_viewshed(0, 15, app.TERRAIN_MOUNTAINS, angle_step, max_range)
+    assert_matches_reference(viewshed['cells'], expected)
+    if max_range is not None:
+        assert np.abs(viewshed['distance']).max() <= max_range
+
+
+def test_batched_viewpoints_match_single_viewpoints():
+    batched = app.compute_viewsheds(VIEWPOINTS, app.TERRAIN_MOUNTAINS)
+    for center, viewshed in zip(VIEWPOINTS, batched):
+        single = app.compute_viewsheds([center], app.TERRAIN_MOUNTAINS)[0]
+        assert viewshed.keys() == single.keys()
+        for key, value in single.items():
+            np.testing.assert_array_equal(viewshed[key], value, err_msg=f'{center} {key}')
+
+
+def fake_viewshed(nbytes):
+    return {'max_distance': 1, 'distance': np.zeros(nbytes, dtype=np.uint8)}
+
+
+def test_viewshed_cache_is_bounded_by_bytes():
+    cache = app.ViewshedCache(max_bytes=1000)
+    for key in range(5):
+        cache.put(key, fake_viewshed(300))
+    stats = cache.stats()
+    assert stats['entries'] == 3
+    assert stats['bytes'] == 900
+    assert stats['evictions'] == 2
+    assert cache.get(0) is None and cache.get(1) is None
+    assert cache.get(4) is not None
+
+
+def test_viewshed_cache_evicts_least_recently_used():
+    cache = app.ViewshedCache(max_bytes=1000)
+    for key in range(3):
+        cache.put(key, fake_viewshed(300))
+    cache.get(0)
+    cache.put(3, fake_viewshed(300))
+    assert cache.get(1) is None
+    assert cache.get(0) is not None
+
+
+def test_viewshed_cache_keeps_one_oversized_entry():
+    cache = app.ViewshedCache(max_bytes=100)
+    cache.put('large', fake_viewshed(300))
+    assert cache.get('large') is not None
+    cache.put('large', fake_viewshed(50))
+    assert cache.stats()['bytes'] == 50
+
+
+def test_viewshed_cache_counts_lookups():
+    cache = app.ViewshedCache(max_bytes=1000)
+    cache.put('a', fake_viewshed(10))
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
+
+
+def test_viewshed_cache_counts_visible_cells():
+    viewshed = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)
+    cells = viewshed['cells']
+    arrays = sum(value.nbytes for value in viewshed.values() if isinstance(value, np.ndarray))
+    assert app.viewshed_nbytes(viewshed) == arrays + cells.nbytes
+    assert cells.nbytes >= cells.index.nbytes + cells.elevation.nbytes
+
+
+def test_unchanged_viewpoint_is_served_from_cache():
+    app.viewshed_cache.clear()
+    first = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)
+    hits = app.viewshed_cache.stats()['hits']
+    assert app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS) is first
+    assert app.viewshed_cache.stats()['hits'] == hits + 1
+    # Other settings are other entries
+    assert app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS, angle_step=5) is not first
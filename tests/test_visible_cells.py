@@ -0,0 +1,84 @@
+import numpy as np
+
+import app
+
+
+def synthetic_viewshed(samples, max_distance=3):
+    """A viewshed dict whose samples round to the given absolute cells, in order."""
+    xs, ys = (np.array(column, dtype=np.int64) for column in zip(*samples))
+    count = len(samples)
+    return {
+        'max_distance': max_distance,
+        'x_int': xs,
+        'y_int': ys,
+        'elevation': np.arange(count, dtype=np.float64) + 100,
+        'vegetation_height': np.arange(count, dtype=np.float64),
+        'water': np.arange(count) % 2 == 0,
+        'river_level': np.arange(count) % 3,
+    }
+
+
+def test_from_viewshed_keeps_last_sample_of_each_cell():
+    # Samples 0 and 2 round to the same cell, as do 1 and 4
+    samples = [(10, 20), (11, 20), (10, 20), (10, 21), (11, 20)]
+    cells = app.VisibleCells.from_viewshed(synthetic_viewshed(samples), 10, 20)
+
+    assert len(cells) == 3
+    assert list(zip(cells.x.tolist(), cells.y.tolist())) == [(0, 0), (0, 1), (1, 0)]
+    assert cells.elevation.tolist() == [102, 103, 104]
+    assert cells.vegetation_height.tolist() == [2, 3, 4]
+    assert cells.water.tolist() == [True, False, True]
+    assert cells.river_level.tolist() == [2, 0, 1]
+
+
+def test_index_grid_locates_cells():
+    samples = [(10, 20), (13, 20), (10, 17), (8, 22)]
+    cells = app.VisibleCells.from_viewshed(synthetic_viewshed(samples), 10, 20)
+
+    assert cells.index.shape == (7, 7)
+    assert (cells.index >= 0).sum() == len(cells)
+    for position, (dx, dy) in enumerate(zip(cells.x.tolist(), cells.y.tolist())):
+        assert cells.find(dx, dy) == position
+    assert cells.find(1, 1) == -1
+    assert cells.find(4, 0) == -1  # Outside the grid
+
+    dxs = np.array([3, 0, -2, 1, 9])
+    dys = np.array([0, -3, 2, 1, 0])
+    np.testing.assert_array_equal(cells.find_many(dxs, dys) >= 0, [True, True, True, False, False])
+    np.testing.assert_array_equal(cells.contains(dxs, dys), [True, True, True, False, False])
+
+
+def test_viewshed_cells_are_unique():
+    viewshed = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)
+    cells = viewshed['cells']
+    coordinates = set(zip(cells.x.tolist(), cells.y.tolist()))
+    assert len(coordinates) == len(cells)
+    # Every sample's cell is among them
+    samples = set(zip(viewshed['x_int'].tolist(), (viewshed['y_int'] - 15).tolist()))
+    assert samples == coordinates
+    assert len(cells) < len(viewshed['x_int'])
+
+
+def test_copy_shares_cells_but_not_enemy_flags():
+    cells = app.get_viewshed(0, 15, app.TERRAIN_MOUNTAINS)['cells']
+    first = cells.copy()
+    second = cells.copy()
+    first.enemy[0] = True
+    assert not second.enemy.any()
+    assert first.elevation is second.elevation
+
+
+def test_to_dicts():
+    samples = [(10, 20), (11, 20), (10, 21)]
+    cells = app.VisibleCells.from_viewshed(synthetic_viewshed(samples), 10, 20)
+    cells.enemy[1] = True
+    cells.enemy_hearing[1] = True
+
+    assert cells.to_dicts() == [
+        {'x': 0, 'y': 0, 'elevation': 100.0, 'vegetation_height': 0.0, 'water': True, 'sound_sources': {}},
+        {'x': 1, 'y': 0, 'elevation': 101.0, 'vegetation_height': 1.0, 'water': False,
+         'sound_sources': {'river': 1}, 'enemy': True, 'enemy_hearing': True},
+        {'x': 0, 'y': 1, 'elevation': 102.0, 'vegetation_height': 2.0, 'water': True,
+         'sound_sources': {'river': 2}},
+    ]
+    assert cells.to_dicts([2]) == cells.to_dicts()[2:]